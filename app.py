@@ -16,6 +16,12 @@ from src.utils.loguru_utils import config_loguru
 from src.agent import chat, react
 from src.utils.chainlit_utils import get_model_settings
 from src.utils.mcp_client import mcp_client_instance
+from src.agent.completion_cache import completion_cache
+from src.agent.session_store import session_store
+from src.utils.llm_gateway import llm_gateway
+from src.utils.telemetry import tracer, metrics
+from chainlit.server import app as server_app
+from starlette.responses import PlainTextResponse
 
 # 加载环境变量
 load_dotenv()
@@ -30,6 +36,16 @@ agents = {
     "REACT": react,
 }
 
+@server_app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus 指标（对话 / 模型调用 / 工具调用 / 界面更新）"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Chainlit 的前端路由 /{full_path:path} 会匹配所有路径，将 /metrics 移到其之前
+metrics_route = next(route for route in server_app.router.routes if getattr(route, "path", None) == "/metrics")
+server_app.router.routes.remove(metrics_route)
+server_app.router.routes.insert(0, metrics_route)
+
 @logger.catch
 @cl.on_app_startup
 async def app_init():
@@ -42,8 +58,12 @@ async def app_init():
         # 这里只初始化一次
         await mcp_client_instance.initialize()
         logger.info("✅ MCP Client Ready.")
+        # 预取已连接 Server 的资源（如 papers://folders），使首次 @folders 命令直接命中缓存；仍在连接的 Server 接入后自动预取
+        await mcp_client_instance.prefetch_resources()
     except Exception as e:
         logger.error(f"❌ MCP Init Failed: {e}")
+    # 预热模型服务连接池，首个用户请求无需建立 TCP / TLS 连接
+    await llm_gateway.warmup()
 
 @logger.catch
 @cl.on_app_shutdown
@@ -53,6 +73,10 @@ async def app_shutdown():
     """
     logger.info("🔌 Cleaning up Global MCP Client...")
     await mcp_client_instance.cleanup()
+    completion_cache.close()
+    await session_store.close()
+    await llm_gateway.close()
+    tracer.flush()
 
 @logger.catch
 @cl.on_chat_start
@@ -66,6 +90,16 @@ async def start_chat():
     cl.user_session.set("model_settings", model_settings)
 
 
+@logger.catch
+@cl.on_chat_end
+async def end_chat():
+    """
+    当用户断开连接时触发。
+    目标：将会话的历史记录写入磁盘并释放内存（用户重新连接后发送消息时再加载）。
+    """
+    await session_store.offload(cl.user_session.get("id"))
+
+
 @logger.catch
 @cl.on_settings_update
 async def setup_agent(settings):
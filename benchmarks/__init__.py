@@ -0,0 +1,3 @@
+"""
+压测工具：模拟的 OpenAI 接口、模拟的 MCP Server 与端到端压测脚本
+"""
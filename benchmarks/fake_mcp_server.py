@@ -0,0 +1,56 @@
+"""
+File   : fake_mcp_server.py
+Desc   : 压测用的模拟 MCP Server（Stdio / Streamable HTTP），工具按配置的延迟返回固定结果
+Date   : 2026/02/22
+Author : Tianyu Chen
+
+用法：
+    python -m benchmarks.fake_mcp_server --name weather --transport streamable-http --port 8101 --latency 0.2
+    python -m benchmarks.fake_mcp_server --name research --transport stdio --latency 0.5
+"""
+
+import random
+import asyncio
+import argparse
+from mcp.server.fastmcp import FastMCP
+
+
+def create_server(name: str, latency: float, jitter: float, output_chars: int, port: int) -> FastMCP:
+    """创建模拟 Server，工具名以 name 为前缀，避免多个模拟 Server 的工具重名"""
+    mcp = FastMCP(name, port=port, log_level="WARNING")
+
+    async def simulate_latency():
+        await asyncio.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+
+    async def lookup(query: str) -> str:
+        await simulate_latency()
+        return f"[{name}] result for {query}: " + "x" * output_chars
+
+    async def search(query: str, limit: int = 5) -> str:
+        await simulate_latency()
+        return "\n".join(f"[{name}] #{i} {query}: " + "y" * (output_chars // max(1, limit)) for i in range(limit))
+
+    mcp.add_tool(lookup, name=f"{name}_lookup", description=f"Look up {name} information for a query")
+    mcp.add_tool(search, name=f"{name}_search", description=f"Search {name} records matching a query")
+
+    @mcp.resource(f"{name}://status")
+    def status() -> str:
+        return f"{name} ok"
+
+    return mcp
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MCP server for load testing")
+    parser.add_argument("--name", default="fake", help="server name, used as the tool name prefix")
+    parser.add_argument("--transport", choices=["stdio", "streamable-http"], default="stdio")
+    parser.add_argument("--port", type=int, default=8101, help="port for streamable-http")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean tool latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="uniform jitter around the mean latency in seconds")
+    parser.add_argument("--output-chars", type=int, default=500, help="size of each tool result in characters")
+    args = parser.parse_args()
+    create_server(args.name, args.latency, args.jitter, args.output_chars, args.port).run(transport=args.transport)
+
+
+if __name__ == "__main__":
+    main()
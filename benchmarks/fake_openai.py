@@ -0,0 +1,157 @@
+"""
+File   : fake_openai.py
+Desc   : 压测用的模拟 OpenAI 兼容接口（/v1/chat/completions），按配置的速率流式输出思考、正文与工具调用
+Date   : 2026/02/22
+Author : Tianyu Chen
+
+用法：
+    python -m benchmarks.fake_openai --port 8100 --token-rate 50 --reasoning-tokens 40 --answer-tokens 200 --tool-calls 2
+"""
+
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 模拟输出使用的词表（中英混合，接近真实回答的令牌分布）
+WORDS = ["天气", "晴朗", "温度", "研究", "论文", "结果", "the", "model", "data", "result", "analysis", "，", "。", "\n"]
+# 工具调用参数每个数据块的字符数
+ARGUMENT_CHUNK_CHARS = 8
+
+
+@dataclass
+class FakeModelConfig:
+    # 首个令牌前的延迟（秒）
+    ttft: float = 0.3
+    # 每秒输出的令牌数（每个数据块一个令牌）
+    token_rate: float = 50
+    # 开启深度思考时输出的思考令牌数
+    reasoning_tokens: int = 40
+    # 正文令牌数
+    answer_tokens: int = 200
+    # 提供了工具且上一条消息是用户消息时，输出的工具调用数（0 表示从不调用工具）
+    tool_calls: int = 1
+
+
+def _fake_arguments(tool: Dict) -> str:
+    """按工具参数结构生成参数（必填的字符串参数填查询词，整数参数填 3）"""
+    parameters = tool["function"].get("parameters") or {}
+    arguments = {}
+    for name, schema in (parameters.get("properties") or {}).items():
+        if name not in parameters.get("required", []):
+            continue
+        arguments[name] = 3 if isinstance(schema, dict) and schema.get("type") == "integer" else random.choice(WORDS[:6])
+    return json.dumps(arguments, ensure_ascii=False)
+
+
+def create_app(config: FakeModelConfig) -> FastAPI:
+    app = FastAPI()
+
+    def chunk(model: str, completion_id: str, delta: Dict, finish_reason=None, usage=None) -> str:
+        payload = {
+            "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+        }
+        if usage is not None:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def plan(body: Dict) -> Dict:
+        """根据请求决定本次回复的内容：思考令牌数、正文令牌数、工具调用"""
+        messages = body.get("messages") or []
+        tools = [tool for tool in body.get("tools") or [] if tool["function"]["name"] != "read_tool_output"]
+        call_tools = bool(tools) and config.tool_calls > 0 and messages and messages[-1]["role"] == "user"
+        return {
+            "reasoning": config.reasoning_tokens if body.get("enable_thinking") else 0,
+            "answer": max(1, config.answer_tokens // 10) if call_tools else config.answer_tokens,
+            "tool_calls": [random.choice(tools) for _ in range(config.tool_calls)] if call_tools else [],
+            "prompt_tokens": sum(len(str(message.get("content") or "")) for message in messages) // 4,
+        }
+
+    def usage(reply: Dict) -> Dict:
+        """令牌用量：思考 + 正文令牌数，每个工具调用按 10 个令牌计"""
+        completion_tokens = reply["reasoning"] + reply["answer"] + len(reply["tool_calls"]) * 10
+        return {
+            "prompt_tokens": reply["prompt_tokens"], "completion_tokens": completion_tokens,
+            "total_tokens": reply["prompt_tokens"] + completion_tokens, "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+    async def stream(body: Dict, reply: Dict) -> AsyncIterator[str]:
+        model, completion_id = body.get("model", "fake"), f"chatcmpl-{uuid.uuid4().hex}"
+        interval = 1 / config.token_rate if config.token_rate > 0 else 0
+        await asyncio.sleep(config.ttft)
+        for _ in range(reply["reasoning"]):
+            yield chunk(model, completion_id, {"reasoning_content": random.choice(WORDS)})
+            await asyncio.sleep(interval)
+        for _ in range(reply["answer"]):
+            yield chunk(model, completion_id, {"content": random.choice(WORDS)})
+            await asyncio.sleep(interval)
+        for index, tool in enumerate(reply["tool_calls"]):
+            arguments = _fake_arguments(tool)
+            yield chunk(model, completion_id, {"tool_calls": [{
+                "index": index, "id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                "function": {"name": tool["function"]["name"], "arguments": ""},
+            }]})
+            for start in range(0, len(arguments), ARGUMENT_CHUNK_CHARS):
+                yield chunk(model, completion_id, {"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + ARGUMENT_CHUNK_CHARS]}}]})
+                await asyncio.sleep(interval)
+        yield chunk(model, completion_id, {}, finish_reason="tool_calls" if reply["tool_calls"] else "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield chunk(model, completion_id, {}, usage=usage(reply))
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        reply = plan(body)
+        if body.get("stream"):
+            return StreamingResponse(stream(body, reply), media_type="text/event-stream")
+        # 非流式：等待完整生成时间后一次性返回
+        reasoning: List[str] = []
+        content: List[str] = []
+        tool_calls = []
+        async for event in stream({**body, "stream_options": None}, reply):
+            if event.startswith("data: {"):
+                delta = json.loads(event[6:])["choices"][0]["delta"]
+                reasoning.append(delta.get("reasoning_content") or "")
+                content.append(delta.get("content") or "")
+                for tool_call in delta.get("tool_calls") or []:
+                    if "id" in tool_call:
+                        tool_calls.append(tool_call)
+                    else:
+                        tool_calls[tool_call["index"]]["function"]["arguments"] += tool_call["function"]["arguments"]
+        message = {"role": "assistant", "content": "".join(content), "reasoning_content": "".join(reasoning) or None}
+        if tool_calls:
+            message["tool_calls"] = [{key: value for key, value in tool_call.items() if key != "index"} for tool_call in tool_calls]
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage(reply),
+        })
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming endpoint for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft", type=float, default=FakeModelConfig.ttft, help="delay before the first token in seconds")
+    parser.add_argument("--token-rate", type=float, default=FakeModelConfig.token_rate, help="tokens per second per stream")
+    parser.add_argument("--reasoning-tokens", type=int, default=FakeModelConfig.reasoning_tokens, help="reasoning tokens when thinking is enabled")
+    parser.add_argument("--answer-tokens", type=int, default=FakeModelConfig.answer_tokens)
+    parser.add_argument("--tool-calls", type=int, default=FakeModelConfig.tool_calls, help="tool calls per round when tools are offered")
+    args = parser.parse_args()
+    config = FakeModelConfig(args.ttft, args.token_rate, args.reasoning_tokens, args.answer_tokens, args.tool_calls)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
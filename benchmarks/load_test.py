@@ -0,0 +1,427 @@
+"""
+File   : load_test.py
+Desc   : 端到端压测：模拟多个并发用户驱动聊天 / ReAct 智能体，对接模拟的 OpenAI 接口与 MCP Server
+Date   : 2026/02/22
+Author : Tianyu Chen
+
+用法（在项目根目录执行）：
+    python -m benchmarks.load_test --agent react --sessions 50 --turns 3
+    python -m benchmarks.load_test --agent chat --sessions 500 --turns 2 --thinking --json .cache/bench.json
+    python -m benchmarks.load_test --agent react --temperature 0 --completion-cache
+
+统计指标：首令牌时间（用户发送消息 -> 界面出现首个内容）、模型输出速率（令牌/秒）、每轮模型调用耗时、
+每个工具的调用耗时、每轮对话的界面更新次数与发送字节数、每个会话的内存占用
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import contextvars
+from pathlib import Path
+from types import SimpleNamespace
+from statistics import mean
+from typing import Dict, List, Optional
+
+# 模型服务网关创建 Client 时需要密钥（模拟接口不校验）
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from loguru import logger
+
+import src.agent.chat_agent as chat_agent
+import src.agent.react_agent as react_agent
+import src.utils.cmd_utils as cmd_utils
+from src.utils.mcp_client import mcp_client_instance
+from src.utils.llm_gateway import llm_gateway
+from src.agent.session_store import session_store
+from src.agent.completion_cache import completion_cache
+from src.utils.spill_store import spill_store
+from src.utils.telemetry import tracer
+
+QUESTIONS = [
+    "今天北京天气怎么样？",
+    "帮我查一下最近关于大语言模型推理加速的论文",
+    "What's the weather like in Shanghai tomorrow?",
+    "总结一下检索增强生成的研究进展",
+    "Search for recent papers on speculative decoding",
+]
+
+
+class SessionMetrics:
+    """单个模拟用户的统计数据"""
+
+    def __init__(self, session_id: int):
+        self.session_id = session_id
+        self.store: Dict = {}
+        self.ttft: List[float] = []
+        self.turn_latency: List[float] = []
+        self.round_latency: List[float] = []
+        self.tokens_per_second: List[float] = []
+        self.tool_latency: Dict[str, List[float]] = {}
+        self.ui_updates: List[int] = []
+        self.ui_bytes: List[int] = []
+        self.errors = 0
+        # 当前轮次
+        self.turn_started = 0.0
+        self.turn_first_content: Optional[float] = None
+        self.turn_updates = 0
+        self.turn_bytes = 0
+
+    def start_turn(self):
+        self.turn_started = time.perf_counter()
+        self.turn_first_content = None
+        self.turn_updates = 0
+        self.turn_bytes = 0
+
+    def record_ui(self, content: str):
+        self.turn_updates += 1
+        self.turn_bytes += len(content.encode("utf-8"))
+        if content and self.turn_first_content is None:
+            self.turn_first_content = time.perf_counter()
+            self.ttft.append(self.turn_first_content - self.turn_started)
+
+    def finish_turn(self):
+        self.turn_latency.append(time.perf_counter() - self.turn_started)
+        self.ui_updates.append(self.turn_updates)
+        self.ui_bytes.append(self.turn_bytes)
+
+
+_current = contextvars.ContextVar("benchmark_session")
+
+
+def current() -> SessionMetrics:
+    return _current.get()
+
+
+# ==================== 模拟 Chainlit（每个模拟用户的会话状态通过 contextvar 隔离） ====================
+
+class FakeMessage:
+    def __init__(self, content: str = "", **kwargs):
+        self.content = content
+        self.id = f"msg-{random.getrandbits(48):x}"
+
+    async def send(self):
+        current().record_ui(self.content)
+        return self
+
+    async def update(self):
+        current().record_ui(self.content)
+        return True
+
+    async def stream_token(self, token: str, is_sequence: bool = False):
+        self.content = token if is_sequence else self.content + token
+        current().record_ui(token)
+
+
+class FakeStep:
+    def __init__(self, name: str = "", type: str = "run", **kwargs):
+        self.name = name
+        self.input = ""
+        self.output = ""
+        self.is_failed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        current().record_ui(str(self.output))
+        return False
+
+
+class FakeUserSession:
+    def get(self, key, default=None):
+        return current().store.get(key, default)
+
+    def set(self, key, value):
+        current().store[key] = value
+
+
+fake_cl = SimpleNamespace(Message=FakeMessage, Step=FakeStep, user_session=FakeUserSession())
+
+
+# ==================== 模型调用与工具调用的计时 ====================
+
+class TimedStream:
+    """包装流式响应，记录每轮模型调用的耗时与输出速率"""
+
+    def __init__(self, stream, started: float):
+        self.stream = stream
+        self.started = started
+
+    async def __aiter__(self):
+        first = None
+        tokens = 0
+        async for chunk in self.stream:
+            if chunk.choices:
+                tokens += 1
+                if first is None:
+                    first = time.perf_counter()
+            yield chunk
+        end = time.perf_counter()
+        metrics = current()
+        metrics.round_latency.append(end - self.started)
+        if first is not None and end > first and tokens > 1:
+            metrics.tokens_per_second.append((tokens - 1) / (end - first))
+
+
+def instrument():
+    create = llm_gateway.create
+
+    async def timed_create(**kwargs):
+        started = time.perf_counter()
+        response = await create(**kwargs)
+        if kwargs.get("stream"):
+            return TimedStream(response, started)
+        current().round_latency.append(time.perf_counter() - started)
+        return response
+
+    llm_gateway.create = timed_create
+
+
+def instrument_tools():
+    call_tool = mcp_client_instance.call_tool
+
+    async def timed_call_tool(tool_name, arguments, timeout=None):
+        started = time.perf_counter()
+        try:
+            return await call_tool(tool_name, arguments, timeout=timeout)
+        finally:
+            current().tool_latency.setdefault(tool_name, []).append(time.perf_counter() - started)
+
+    mcp_client_instance.call_tool = timed_call_tool
+
+
+# ==================== 模拟用户 ====================
+
+async def run_user(session_id: int, args, agent, model_settings: Dict) -> SessionMetrics:
+    metrics = SessionMetrics(session_id)
+    _current.set(metrics)
+    metrics.store["model_settings"] = dict(model_settings)
+    # 与 Chainlit 的 user_session 一致，"id" 为会话 ID（历史记录按会话 ID 存入会话存储）
+    metrics.store["id"] = f"session-{session_id}"
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    for turn in range(args.turns):
+        metrics.start_turn()
+        try:
+            await agent(FakeMessage(random.choice(QUESTIONS)))
+        except Exception as e:
+            metrics.errors += 1
+            logger.error(f"[Benchmark] Session {session_id} turn {turn} failed: {e}")
+        metrics.finish_turn()
+        await asyncio.sleep(random.uniform(0, args.think_time))
+    return metrics
+
+
+# ==================== 模拟服务 ====================
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"Fake server on port {port} did not start")
+
+
+async def start_fake_services(args, workdir: Path):
+    """启动模拟 OpenAI 接口与 Streamable HTTP MCP Server，写入 MCP 配置（含 Stdio Server），返回 (进程列表, OpenAI 地址, 配置路径)"""
+    openai_port, mcp_port = _free_port(), _free_port()
+    processes = [
+        subprocess.Popen([
+            sys.executable, "-m", "benchmarks.fake_openai", "--port", str(openai_port), "--ttft", str(args.ttft),
+            "--token-rate", str(args.token_rate), "--reasoning-tokens", str(args.reasoning_tokens),
+            "--answer-tokens", str(args.answer_tokens), "--tool-calls", str(args.tool_calls),
+        ]),
+        subprocess.Popen([
+            sys.executable, "-m", "benchmarks.fake_mcp_server", "--name", "weather", "--transport", "streamable-http",
+            "--port", str(mcp_port), "--latency", str(args.mcp_latency),
+        ]),
+    ]
+    config = {"mcpServers": {
+        "weather": {"url": f"http://127.0.0.1:{mcp_port}/mcp"},
+        "research": {
+            "command": sys.executable,
+            "args": ["-m", "benchmarks.fake_mcp_server", "--name", "research", "--transport", "stdio", "--latency", str(args.mcp_latency)],
+            "pool": {"min_replicas": 1, "max_replicas": 4},
+        },
+    }}
+    config_path = workdir / "server_config.json"
+    config_path.write_text(json.dumps(config, indent=2))
+    await _wait_for_port(openai_port)
+    await _wait_for_port(mcp_port)
+    return processes, f"http://127.0.0.1:{openai_port}/v1", str(config_path)
+
+
+# ==================== 报告 ====================
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _stats(values: List[float]) -> Dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values), "mean": mean(values),
+        "p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "p99": _percentile(values, 0.99), "max": max(values),
+    }
+
+
+def build_report(sessions: List[SessionMetrics], args, elapsed: float, memory: Dict) -> Dict:
+    tools: Dict[str, List[float]] = {}
+    for session in sessions:
+        for name, values in session.tool_latency.items():
+            tools.setdefault(name, []).extend(values)
+    collect = lambda field: [value for session in sessions for value in getattr(session, field)]
+    return {
+        "agent": args.agent, "sessions": args.sessions, "turns": args.turns, "elapsed": elapsed,
+        "errors": sum(session.errors for session in sessions),
+        "ttft": _stats(collect("ttft")),
+        "turn_latency": _stats(collect("turn_latency")),
+        "round_latency": _stats(collect("round_latency")),
+        "tokens_per_second": _stats(collect("tokens_per_second")),
+        "tool_latency": {name: _stats(values) for name, values in sorted(tools.items())},
+        "ui_updates_per_turn": _stats(collect("ui_updates")),
+        "ui_bytes_per_turn": _stats(collect("ui_bytes")),
+        "completion_cache": {"hits": completion_cache.hits, "misses": completion_cache.misses},
+        "memory": memory,
+    }
+
+
+def print_report(report: Dict):
+    def row(name: str, stats: Dict, unit: str = "", scale: float = 1):
+        if not stats.get("count"):
+            print(f"  {name:<36} -")
+            return
+        values = " ".join(f"{key}={stats[key] * scale:.1f}{unit}" for key in ("mean", "p50", "p95", "p99", "max"))
+        print(f"  {name:<36} n={stats['count']:<6} {values}")
+
+    print(f"\n===== Load test: {report['agent']} agent, {report['sessions']} sessions x {report['turns']} turns "
+          f"in {report['elapsed']:.1f}s, errors={report['errors']} =====")
+    row("time to first token", report["ttft"], "ms", 1000)
+    row("turn latency", report["turn_latency"], "ms", 1000)
+    row("model round latency", report["round_latency"], "ms", 1000)
+    row("tokens/s per stream", report["tokens_per_second"])
+    for name, stats in report["tool_latency"].items():
+        row(f"tool {name}", stats, "ms", 1000)
+    row("UI updates per turn", report["ui_updates_per_turn"])
+    row("UI bytes per turn", report["ui_bytes_per_turn"])
+    cache = report["completion_cache"]
+    if cache["hits"] or cache["misses"]:
+        print(f"  {'completion cache':<36} hits={cache['hits']} misses={cache['misses']} "
+              f"hit_rate={cache['hits'] / (cache['hits'] + cache['misses']):.1%}")
+    memory = report["memory"]
+    print(f"  {'memory per session':<36} history={memory['history_bytes_per_session'] / 1024:.1f}KB"
+          + (f" traced={memory['traced_bytes_per_session'] / 1024:.1f}KB" if "traced_bytes_per_session" in memory else "")
+          + f" in_memory={memory['sessions_in_memory']}/{report['sessions']}")
+
+
+# ==================== 入口 ====================
+
+async def run(args) -> Dict:
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    processes, base_url, config_path = await start_fake_services(args, workdir)
+    try:
+        # 模型服务网关指向模拟接口，Chainlit 替换为模拟实现
+        # 模拟模型不属于任何服务商，使用 OPENAI_BASE_URL 对应的默认连接池
+        os.environ["OPENAI_BASE_URL"] = base_url
+        await llm_gateway.warmup()
+        instrument()
+        chat_agent.cl = react_agent.cl = cmd_utils.cl = fake_cl
+        # 会话存储、能力快照、大体积工具结果、回复缓存与 Span 都写入临时目录，不覆盖项目 .cache 中的数据；
+        # 内存中保留的会话数可通过 --hot-sessions 调小以测试写入 / 加载
+        session_store.path = workdir / "sessions.sqlite3"
+        mcp_client_instance.snapshot.path = workdir / "mcp_capabilities.json"
+        spill_store.directory = workdir / "spill"
+        completion_cache.path = workdir / "completions.sqlite3"
+        tracer.path = workdir / "traces" / "spans.otlp.jsonl"
+        if args.hot_sessions is not None:
+            session_store.hot_limit = args.hot_sessions
+        await mcp_client_instance.initialize(config_path)
+        instrument_tools()
+
+        model_settings = {
+            "Model": "fake-model", "Streaming": not args.blocking, "Thinking": args.thinking, "Temperature": args.temperature,
+            "MaxTokens": 2048, "RoleSetting": "你是一个超级人工智能助手。", "CompletionCache": args.completion_cache,
+        }
+        agent = chat_agent.chat if args.agent == "chat" else react_agent.react
+        if args.trace_memory:
+            tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+
+        started = time.perf_counter()
+        sessions = await asyncio.gather(*(run_user(i, args, agent, model_settings) for i in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+
+        # 会话状态仍被引用，此时的内存增量即为全部会话的占用（已写入磁盘的会话不占内存）
+        memory = {"sessions_in_memory": len(session_store.hot)}
+        if args.trace_memory:
+            memory["traced_bytes_per_session"] = (tracemalloc.get_traced_memory()[0] - baseline) / args.sessions
+            tracemalloc.stop()
+        histories = [await session_store.load(session.store["id"]) for session in sessions]
+        memory["history_bytes_per_session"] = mean(len(json.dumps(history, ensure_ascii=False).encode("utf-8")) for history in histories)
+        return build_report(sessions, args, elapsed, memory)
+    finally:
+        await mcp_client_instance.cleanup()
+        completion_cache.close()
+        await session_store.close()
+        await llm_gateway.close()
+        tracer.flush()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test with fake OpenAI and MCP servers")
+    parser.add_argument("--agent", choices=["chat", "react"], default="react")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--turns", type=int, default=3, help="messages sent by each user")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="users start at a random time within this many seconds")
+    parser.add_argument("--think-time", type=float, default=1.0, help="max random pause between a user's messages in seconds")
+    parser.add_argument("--thinking", action="store_true", help="enable reasoning content")
+    parser.add_argument("--blocking", action="store_true", help="chat agent: use non-streaming responses")
+    parser.add_argument("--temperature", type=float, default=1, help="sampling temperature (the completion cache only serves temperature 0)")
+    parser.add_argument("--completion-cache", action="store_true", help="enable the completion cache for every session")
+    parser.add_argument("--ttft", type=float, default=0.3, help="fake model delay before the first token in seconds")
+    parser.add_argument("--token-rate", type=float, default=50, help="fake model tokens per second per stream")
+    parser.add_argument("--reasoning-tokens", type=int, default=40)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls per round when tools are offered")
+    parser.add_argument("--mcp-latency", type=float, default=0.2, help="fake MCP tool latency in seconds")
+    parser.add_argument("--trace-memory", action="store_true", help="measure memory per session with tracemalloc (slower)")
+    parser.add_argument("--hot-sessions", type=int, help="session histories kept in memory before offloading to disk")
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        Path(args.json).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,20 @@ Date   : 2025/12/21
 Author : Tianyu Chen
 """
 
-import os
 import time
+from functools import partial
 import chainlit as cl
-from openai import AsyncOpenAI
 from loguru import logger
 
 # 引入优化后的 UI 工具
-from src.ui import get_thinking_html, get_finished_thinking_html
-
-
-# 初始化 Client
-client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), base_url=os.environ.get("OPENAI_BASE_URL"))
+from src.ui import get_finished_thinking_html, ThinkingStreamRenderer
+from src.agent.history_manager import history_compactor
+from src.agent.session_store import session_store
+from src.utils.telemetry import tracer, record_llm_call, turn_duration, turn_rounds, ui_updates
+from src.agent.completion_cache import completion_cache
+from src.agent.model_router import model_router
+from src.utils.admission import admission_session, ServerBusyError
+from src.agent.prompt_assembler import ensure_system_prompt, build_user_message, prompt_cache_stats
 
 
 def get_system_prompt(model_settings: dict) -> str:
@@ -29,13 +31,13 @@ def get_system_prompt(model_settings: dict) -> str:
 
 # Background
 - This is a conversation between you (the AI agent) and a human user.
-- Current System Time (Internal Reference ONLY): {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
+- The current system time is provided in the <context> block at the end of each user message (Internal Reference ONLY).
 
 # Constraints
 - Do speak in Chinese.
 
 # Information Control
-- **DO NOT mention the Background information in your response unless the user explicitly asks for it.**
+- **DO NOT mention the Background or <context> information in your response unless the user explicitly asks for it.**
 - **Use the provided system time ONLY for calculating relative dates (e.g., if user asks about "What's the date tomorrow?").**
 - **Keep your greetings simple and natural, without reciting metadata.**
     """
@@ -47,19 +49,18 @@ async def chat(message: cl.Message):
     """
     logger.info("\n\n\n==================[System] New message received. Processing...==================")
 
-    # 获取历史记录与设置
-    message_history = cl.user_session.get("message_history", [])
+    # 获取历史记录（空闲会话的历史记录不在内存中，按需从磁盘加载）与设置
+    session_id = cl.user_session.get("id")
+    message_history = await session_store.load(session_id)
     model_settings = cl.user_session.get("model_settings")
     user_query = message.content
     logger.info(f"\n[User] {message.content}")
+    # 模型请求按会话排队（准入控制在会话间轮转放行）
+    admission_session.set(session_id or admission_session.get())
 
-    # 插入或更新系统提示词
-    system_prompt = get_system_prompt(model_settings)
-    if not message_history or message_history[0]["role"] != "system":
-        message_history.insert(0, {"role": "system", "content": system_prompt})
-    else:
-        message_history[0]["content"] = system_prompt
-    message_history.append({"role": "user", "content": user_query})
+    # 插入或更新系统提示词（不含易变内容，保证请求前缀稳定以命中提示词缓存），当前时间随用户消息写入历史
+    ensure_system_prompt(message_history, get_system_prompt(model_settings))
+    message_history.append(build_user_message(user_query))
 
     # 1. UI 消息容器
     final_answer = cl.Message(content="")
@@ -69,110 +70,136 @@ async def chat(message: cl.Message):
     answer_content = ""
     start_time = time.time()
 
-    try:
-        if model_settings["Streaming"]:
-            logger.info("\n[System] Mode: Streaming")
-            answer_content = await process_streaming_response(
-                client, model_settings, message_history, user_query, final_answer, start_time
-            )
-        else:
-            logger.info("\n[System] Mode: Blocking (Non-Streaming)")
-            answer_content = await process_blocking_response(
-                client, model_settings, message_history, user_query, final_answer, start_time
-            )
-    except Exception as e:
-        error_msg = f"Error during generation: {str(e)}"
-        logger.error(f"[System] {error_msg}")
-        final_answer.content += f"\n\n⚠️ {error_msg}"
-        await final_answer.update()
-        return
+    # 本轮对话的 Span（模型调用记录为其子 Span），界面更新次数由处理函数写入 ui.updates
+    with tracer.span("agent.turn", **{"agent": "chat", "llm.model": model_settings["Model"], "ui.updates": 1}) as turn_span:
+        try:
+            if model_settings["Streaming"]:
+                logger.info("\n[System] Mode: Streaming")
+                answer_content = await process_streaming_response(
+                    model_settings, message_history, user_query, final_answer, start_time
+                )
+            else:
+                logger.info("\n[System] Mode: Blocking (Non-Streaming)")
+                answer_content = await process_blocking_response(
+                    model_settings, message_history, user_query, final_answer, start_time
+                )
+        except ServerBusyError as e:
+            # 排队过长：请求未发出，提示用户稍后重试，本条问题不写入历史
+            logger.warning(f"[System] {e}")
+            turn_span.set_error(str(e))
+            message_history.pop()
+            final_answer.content = f"⚠️ 当前请求过多，服务繁忙（预计需排队 {e.wait:.0f} 秒），请稍后重试。"
+            await final_answer.update()
+            return
+        except Exception as e:
+            error_msg = f"Error during generation: {str(e)}"
+            logger.error(f"[System] {error_msg}")
+            turn_span.set_error(error_msg)
+            final_answer.content += f"\n\n⚠️ {error_msg}"
+            await final_answer.update()
+            return
+        finally:
+            turn_duration.observe(turn_span.duration, agent="chat")
+            turn_rounds.observe(1, agent="chat")
+            ui_updates.observe(turn_span.attributes["ui.updates"], agent="chat")
 
     # 3. 将纯回答文本存入历史记忆
     message_history.append({"role": "assistant", "content": answer_content})
-    cl.user_session.set("message_history", message_history)
+    session_store.save(session_id, message_history)
+    # 超出令牌预算时在后台压缩历史记录（不阻塞下一条消息）
+    history_compactor.schedule(session_id, message_history, model_settings["Model"])
 
     logger.info("\n==================[System] Message processing completed.]==================\n\n")
 
 
-async def call_model(client, model_settings, message_history, user_query):
+def _add_ui_updates(count: int):
+    """累加本轮对话的界面更新次数（记录在当前对话的 Span 上）"""
+    span = tracer.current_span()
+    if span is not None:
+        span.set_attribute("ui.updates", span.attributes.get("ui.updates", 0) + count)
+
+
+async def call_model(model_settings, message_history, user_query):
     """
     调用聊天模型接口
     """
-    response = await client.chat.completions.create(
+    # 流式模式下在最后一个数据块中返回令牌用量（用于统计提示词缓存命中）
+    stream_options = {"stream_options": {"include_usage": True}} if model_settings["Streaming"] else {}
+    # 开启回复缓存时，相同的请求直接回放缓存的回复；否则经模型路由请求（出错时切换同级模型，可选对冲请求）
+    response = await completion_cache.create(
+        partial(model_router.create, hedge=model_settings.get("Hedging", False)),
+        enabled=model_settings.get("CompletionCache", False),
         model=model_settings["Model"],
         messages=message_history,
         temperature=model_settings["Temperature"],
         max_tokens=int(model_settings["MaxTokens"]),
         stream=model_settings["Streaming"],
-        extra_body={"enable_thinking": model_settings["Thinking"]}
+        extra_body={"enable_thinking": model_settings["Thinking"]},
+        **stream_options
     )
     return response
 
-async def process_streaming_response(client, model_settings, message_history, user_query, final_answer, start_time):
+async def process_streaming_response(model_settings, message_history, user_query, final_answer, start_time):
     """
     处理流式输出 (Streaming = True)
+    思考与正文由渲染器增量累积，按帧率合并界面更新；思考结束（切换到正文）与流结束时立即刷新
     """
-    thinking_buffer = ""
-    answer_content = ""
-    is_thinking_phase = model_settings["Thinking"]
-
-    stream = await call_model(client, model_settings, message_history, user_query)
-
-     # === A. 处理流式响应 ===
-    async for chunk in stream:
-        delta = chunk.choices[0].delta
-        
-        # 兼容不同厂商的 reasoning 字段 (DeepSeek 通常用 reasoning_content)
-        reasoning = getattr(delta, "reasoning_content", None)
-        content = delta.content
-
-        # === A. 处理思考 (Reasoning) ===
-        if reasoning and is_thinking_phase:
-            thinking_buffer += reasoning
-            final_answer.content = get_thinking_html(thinking_buffer)
-            await final_answer.update()
-            # print(reasoning, end="", flush=True) # 可选：减少控制台噪音
-        
-        # === B. 处理正文 (Content) ===
-        elif content:
-            if is_thinking_phase:
-                duration = int(time.time() - start_time)
-                if duration < 1: duration = 1
-                
-                # 结束思考阶段，锁定 HTML
-                final_thinking_html = get_finished_thinking_html(thinking_buffer, duration)
-                final_answer.content = final_thinking_html
-
-                # 添加两个换行符，强制将后续内容与 HTML 分离
-                final_answer.content += "\n\n"
-                
-                is_thinking_phase = False 
-
-                logger.debug(f"\n[🧠 Thinking] {thinking_buffer}")
-                logger.info(f"\n[System] Thinking finished. Duration: {duration}s")
-            
-            answer_content += content
+    renderer = ThinkingStreamRenderer(final_answer, sent=True)
+    show_thinking = model_settings["Thinking"]
+
+    # 模型调用的计时与令牌用量（流结束后记录为 Span 与指标）
+    call_started = time.time_ns()
+    first_token = None
+    usage = None
+    chunks = 0
+    try:
+        stream = await call_model(model_settings, message_history, user_query)
+
+         # === A. 处理流式响应 ===
+        async for chunk in stream:
+            # 最后一个数据块只包含令牌用量
+            if chunk.usage:
+                usage = chunk.usage
+                prompt_cache_stats.record(model_settings["Model"], chunk.usage)
+            if not chunk.choices:
+                continue
+            chunks += 1
+            first_token = first_token or time.time_ns()
+            delta = chunk.choices[0].delta
             
-            # 必须重新拼接：已完成的思考HTML + 当前生成的正文
-            # 注意：final_answer.content 在上面被重置为 final_thinking_html 了，所以这里直接 += 即可
-            # 但为了防止逻辑混乱，建议总是全量赋值或确保 content 是追加模式
-            # 这里由于 is_thinking_phase 切换时已经重置了 content，所以可以直接追加
-            final_answer.content += content 
-            await final_answer.update()
-            # print(content, end="", flush=True)
-
-    # === C. 兜底处理 (如果只有思考没有内容，或者流结束时还在思考) ===
-    if is_thinking_phase and thinking_buffer:
-        duration = int(time.time() - start_time)
-        final_answer.content = get_finished_thinking_html(thinking_buffer, duration)
-        await final_answer.update()
+            # 兼容不同厂商的 reasoning 字段 (DeepSeek 通常用 reasoning_content)
+            reasoning = getattr(delta, "reasoning_content", None)
+            content = delta.content
 
+            # === A. 处理思考 (Reasoning) ===
+            if reasoning and show_thinking:
+                await renderer.add_thinking(reasoning)
+            
+            # === B. 处理正文 (Content) ===
+            elif content:
+                if renderer.is_thinking:
+                    logger.debug(f"\n[🧠 Thinking] {renderer.thinking_text}")
+                    logger.info(f"\n[System] Thinking finished. Duration: {max(1, int(time.monotonic() - renderer.started_at))}s")
+                await renderer.add_answer(content)
+    except Exception as e:
+        record_llm_call(model_settings["Model"], call_started, first_token, usage, chunks, error=f"{type(e).__name__}: {e}")
+        # 刷新已生成的内容并取消待发送的定时刷新，避免其在调用方追加错误信息后再次推送增量
+        await renderer.finish()
+        _add_ui_updates(renderer.updates)
+        raise
+    record_llm_call(model_settings["Model"], call_started, first_token, usage, chunks)
+
+    # === C. 流结束：刷新剩余内容（如果流结束时还在思考，则锁定思考块） ===
+    await renderer.finish()
+    _add_ui_updates(renderer.updates)
+
+    answer_content = renderer.answer_text
     logger.debug(f"\n[🧸 Answer] {answer_content}")
     logger.info("\n[System] Stream finished.")
     return answer_content
 
 
-async def process_blocking_response(client, model_settings, message_history, user_query, final_answer, start_time):
+async def process_blocking_response(model_settings, message_history, user_query, final_answer, start_time):
     """
     处理非流式输出 (Streaming = False)
     """
@@ -180,7 +207,14 @@ async def process_blocking_response(client, model_settings, message_history, use
     final_answer.content = "生成中..."
     await final_answer.update()
 
-    response = await call_model(client, model_settings, message_history, user_query)
+    call_started = time.time_ns()
+    try:
+        response = await call_model(model_settings, message_history, user_query)
+    except Exception as e:
+        record_llm_call(model_settings["Model"], call_started, None, error=f"{type(e).__name__}: {e}")
+        raise
+    record_llm_call(model_settings["Model"], call_started, None, response.usage)
+    prompt_cache_stats.record(model_settings["Model"], response.usage)
     message = response.choices[0].message
     
     # 获取内容和思考过程
@@ -207,6 +241,7 @@ async def process_blocking_response(client, model_settings, message_history, use
     # 一次性更新 UI
     final_answer.content = final_ui_content
     await final_answer.update()
+    _add_ui_updates(2)
 
     logger.debug(f"\n[🧸 Answer] {answer_content}")
     logger.info(f"\n[System] Request finished. Duration: {duration}s")
@@ -0,0 +1,262 @@
+"""
+File   : completion_cache.py
+Desc   : 模型回复缓存（本地 SQLite），相同的请求直接回放缓存的回复
+Date   : 2026/02/20
+Author : Tianyu Chen
+"""
+
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from loguru import logger
+
+from src.agent.prompt_assembler import strip_context, context_date
+
+# 缓存数据库路径
+COMPLETION_CACHE_PATH = ".cache/completions.sqlite3"
+# 最多缓存的回复数、缓存总大小（字节），超出时按最近使用时间淘汰
+COMPLETION_CACHE_MAX_ENTRIES = 1000
+COMPLETION_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# 缓存有效期（秒）：请求键只含当前日期、不含时间，过期后重新请求，避免时效性问题（如天气）长期返回旧回复
+COMPLETION_CACHE_TTL = 3600
+# 只缓存温度为 0 的请求（温度大于 0 时每次回复本应不同）
+COMPLETION_CACHE_DETERMINISTIC_ONLY = True
+# 回放时每个数据块的字符数
+REPLAY_CHUNK_CHARS = 32
+
+# 参与缓存键计算的请求参数（stream / stream_options 不影响回复内容，流式与非流式请求共用缓存；
+# max_tokens 每轮按剩余预算变化，而只有正常结束、未被长度截断的回复才写入缓存，不参与计算）
+_KEY_FIELDS = ("model", "tools", "tool_choice", "temperature", "extra_body")
+_MESSAGE_FIELDS = ("role", "content", "name", "tool_call_id", "tool_calls")
+# 只缓存正常结束的回复（不缓存因长度截断的回复）
+_CACHEABLE_FINISH_REASONS = ("stop", "tool_calls")
+
+
+def _normalize_message(message: Dict) -> Dict:
+    normalized = {field: message[field] for field in _MESSAGE_FIELDS if message.get(field) is not None}
+    if normalized["role"] == "user" and isinstance(normalized.get("content"), str):
+        # 去除当前时间，但保留日期：“今天”之类的相对时间问题跨天后不再命中
+        date = context_date(normalized["content"])
+        normalized["content"] = strip_context(normalized["content"]).strip()
+        if date:
+            normalized["date"] = date
+    return normalized
+
+
+def _served_by(model: str, served: Optional[str]) -> bool:
+    """回复是否由请求的模型生成（服务商可能返回带版本后缀的模型名；模型路由切换到同级模型时不同）"""
+    return not served or served == model or served.startswith(f"{model}-")
+
+
+def request_key(request: Dict) -> str:
+    """请求的规范化缓存键：模型、消息（易变上下文只保留日期）、工具与采样参数的 sha256"""
+    normalized = {field: request.get(field) for field in _KEY_FIELDS if request.get(field) is not None}
+    normalized["messages"] = [_normalize_message(message) for message in request["messages"]]
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    模型回复缓存
+
+    - 缓存键为规范化请求的摘要，只有会话开启缓存、且温度为 0（可配置）的请求参与缓存
+    - 回复以汇总形式（思考、正文、工具调用）存入 SQLite，按最近使用时间淘汰（数量与总大小上限），超过有效期后失效
+    - 命中时回放为与实时响应相同类型的对象（流式请求回放为数据块流），调用方走同一处理路径，界面表现一致
+    - 实时流式响应在完整结束后才写入缓存（超时、中断的响应不缓存）
+    - 模型路由切换到同级模型时，回复不写入请求模型的缓存
+    """
+
+    def __init__(self, path: str = COMPLETION_CACHE_PATH, max_entries: int = COMPLETION_CACHE_MAX_ENTRIES,
+                 max_bytes: int = COMPLETION_CACHE_MAX_BYTES, ttl: float = COMPLETION_CACHE_TTL):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, request: Dict) -> bool:
+        if COMPLETION_CACHE_DETERMINISTIC_ONLY and (request.get("temperature") or 0) > 0:
+            return False
+        return True
+
+    async def create(self, upstream: Callable[..., Awaitable[Any]], enabled: bool = True, **request) -> Any:
+        """
+        命中缓存时回放缓存的回复，否则通过 upstream（如 client.chat.completions.create 或模型路由）请求模型并在完整结束后写入缓存
+        enabled 为 False 或请求不可缓存时直接请求模型
+        """
+        if not enabled or not self.is_cacheable(request):
+            return await upstream(**request)
+        key = request_key(request)
+        try:
+            entry = await asyncio.to_thread(self._get, key)
+        except Exception as e:
+            logger.warning(f"[CompletionCache] Lookup failed: {e}")
+            entry = None
+        if entry is not None:
+            self.hits += 1
+            logger.info(f"[CompletionCache] Hit for {request['model']} (hits={self.hits}, misses={self.misses})")
+            return self._replay_stream(entry, request["model"]) if request.get("stream") else self._replay_completion(entry, request["model"])
+
+        self.misses += 1
+        response = await upstream(**request)
+        if request.get("stream"):
+            return self._record_stream(response, key, request["model"])
+        message = response.choices[0].message
+        await self._put(key, request["model"], getattr(response, "model", None), {
+            "reasoning": getattr(message, "reasoning_content", None) or "",
+            "content": message.content or "",
+            "tool_calls": [
+                {"id": tool_call.id, "name": tool_call.function.name, "arguments": tool_call.function.arguments}
+                for tool_call in message.tool_calls or []
+            ],
+            "finish_reason": response.choices[0].finish_reason,
+        })
+        return response
+
+    async def _record_stream(self, stream, key: str, model: str):
+        """透传实时数据块，同时汇总回复；流完整结束后写入缓存"""
+        reasoning: List[str] = []
+        content: List[str] = []
+        tool_calls: Dict[int, Dict] = {}
+        finish_reason = None
+        served = None
+        async for chunk in stream:
+            yield chunk
+            served = served or getattr(chunk, "model", None)
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta
+            if getattr(delta, "reasoning_content", None):
+                reasoning.append(delta.reasoning_content)
+            if delta.content:
+                content.append(delta.content)
+            for tool_call in delta.tool_calls or []:
+                call = tool_calls.setdefault(tool_call.index, {"id": tool_call.id, "name": "", "arguments": ""})
+                if tool_call.function.name:
+                    call["name"] = tool_call.function.name
+                if tool_call.function.arguments:
+                    call["arguments"] += tool_call.function.arguments
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        await self._put(key, model, served, {
+            "reasoning": "".join(reasoning),
+            "content": "".join(content),
+            "tool_calls": [tool_calls[index] for index in sorted(tool_calls)],
+            "finish_reason": finish_reason,
+        })
+
+    async def _replay_stream(self, entry: Dict, model: str):
+        """将缓存的回复回放为数据块流（思考 -> 正文 -> 工具调用 -> 结束）"""
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> ChatCompletionChunk:
+            return ChatCompletionChunk.model_validate({
+                "id": "cached", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        for field, text in (("reasoning_content", entry["reasoning"]), ("content", entry["content"])):
+            for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+                yield chunk({field: text[start:start + REPLAY_CHUNK_CHARS]})
+                # 让出事件循环，界面按帧率合并更新
+                await asyncio.sleep(0)
+        for index, tool_call in enumerate(entry["tool_calls"]):
+            yield chunk({"tool_calls": [{
+                "index": index, "id": tool_call["id"], "type": "function",
+                "function": {"name": tool_call["name"], "arguments": tool_call["arguments"]},
+            }]})
+        yield chunk({}, entry["finish_reason"])
+
+    def _replay_completion(self, entry: Dict, model: str) -> ChatCompletion:
+        message = {"role": "assistant", "content": entry["content"], "reasoning_content": entry["reasoning"] or None}
+        if entry["tool_calls"]:
+            message["tool_calls"] = [
+                {"id": tool_call["id"], "type": "function", "function": {"name": tool_call["name"], "arguments": tool_call["arguments"]}}
+                for tool_call in entry["tool_calls"]
+            ]
+        return ChatCompletion.model_validate({
+            "id": "cached", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": entry["finish_reason"]}],
+        })
+
+    async def _put(self, key: str, model: str, served: Optional[str], entry: Dict):
+        if entry["finish_reason"] not in _CACHEABLE_FINISH_REASONS:
+            return
+        if not _served_by(model, served):
+            logger.debug(f"[CompletionCache] Not caching {model} request served by {served}")
+            return
+        try:
+            await asyncio.to_thread(self._set, key, model, json.dumps(entry, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"[CompletionCache] Failed to store completion: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, value TEXT, size INTEGER, created REAL, last_access REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        return self._db
+
+    def _get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.ttl:
+                db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+            db.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def _set(self, key: str, model: str, value: str):
+        with self._lock:
+            db = self._connect()
+            now = time.time()
+            db.execute(
+                "INSERT OR REPLACE INTO completions (key, model, value, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, value, len(value.encode("utf-8")), now, now),
+            )
+            self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection):
+        """淘汰过期条目，以及超出数量 / 大小上限的最久未使用条目"""
+        db.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.ttl,))
+        count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in db.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM completions WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.debug(f"[CompletionCache] Evicted {evicted} least recently used completions")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# 全局单例
+completion_cache = CompletionCache()
@@ -0,0 +1,177 @@
+"""
+File   : history_manager.py
+Desc   : 会话历史管理：令牌估算，超出预算时在后台压缩（截断旧工具结果 / 摘要旧对话）
+Date   : 2026/02/14
+Author : Tianyu Chen
+"""
+
+import asyncio
+from typing import Dict, List, Optional
+from loguru import logger
+
+from src.utils.llm_gateway import llm_gateway
+from src.agent.session_store import session_store
+
+# 各模型的历史记录令牌预算（不含本轮输出），未列出的模型使用默认值
+MODEL_HISTORY_TOKEN_BUDGETS = {
+    "qwen-plus": 64000,
+    "qwen3-max": 64000,
+    "deepseek-v3.2": 48000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 32000
+# 超出预算后压缩到预算的比例（留出余量，避免每轮都触发压缩）
+COMPACTION_TARGET_RATIO = 0.6
+# 最近几轮对话（以用户消息划分）保持原样，不参与压缩
+KEEP_RECENT_TURNS = 2
+# 旧工具结果截断后保留的字符数
+TOOL_OUTPUT_KEEP_CHARS = 200
+# 摘要请求中每条消息的最大字符数、摘要的最大令牌数
+SUMMARY_INPUT_MESSAGE_CHARS = 2000
+SUMMARY_MAX_TOKENS = 1024
+
+SUMMARY_PREFIX = "[Summary of the earlier conversation]"
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an AI assistant. "
+    "Keep the user's goals, preferences, key facts, decisions, tool results that may still matter, and any open questions. "
+    "Write a concise summary in the same language as the conversation."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的令牌数：中日韩字符约 1 个令牌 / 字，其他字符约 4 个字符 / 令牌"""
+    if not text:
+        return 0
+    cjk = sum(1 for char in text if "　" <= char <= "鿿" or "＀" <= char <= "￯")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: Dict) -> int:
+    """估算单条消息的令牌数（含角色等格式开销与工具调用参数）"""
+    tokens = 4 + estimate_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        tokens += estimate_tokens(tool_call["function"]["name"]) + estimate_tokens(tool_call["function"]["arguments"])
+    return tokens
+
+
+def history_tokens(messages: List[Dict]) -> int:
+    return sum(message_tokens(message) for message in messages)
+
+
+def history_budget(model: str) -> int:
+    return MODEL_HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+
+def _turn_starts(messages: List[Dict]) -> List[int]:
+    """每轮对话（用户消息）的起始下标"""
+    return [index for index, message in enumerate(messages) if message["role"] == "user"]
+
+
+def _truncate_tool_output(message: Dict) -> Dict:
+    content = message.get("content") or ""
+    if len(content) <= TOOL_OUTPUT_KEEP_CHARS:
+        return message
+    return {**message, "content": f"{content[:TOOL_OUTPUT_KEEP_CHARS]}\n...[earlier tool output truncated, {len(content)} chars]"}
+
+
+def _render_for_summary(messages: List[Dict]) -> str:
+    lines = []
+    for message in messages:
+        content = (message.get("content") or "")[:SUMMARY_INPUT_MESSAGE_CHARS]
+        if message["role"] == "tool":
+            lines.append(f"Tool ({message.get('name', 'tool')}) result: {content}")
+        elif message["role"] == "assistant":
+            calls = ", ".join(tool_call["function"]["name"] for tool_call in message.get("tool_calls") or [])
+            if calls:
+                lines.append(f"Assistant called tools: {calls}")
+            if content:
+                lines.append(f"Assistant: {content}")
+        else:
+            lines.append(f"User: {content}")
+    return "\n".join(lines)
+
+
+class HistoryCompactor:
+    """
+    会话历史压缩
+
+    每轮对话结束后检查历史记录的令牌数，超出模型预算时在后台压缩（不阻塞用户的下一条消息）：
+    1. 截断最近几轮之前的工具结果
+    2. 仍超出目标时，将最近几轮之前的对话（含之前的摘要）摘要为一条助手消息；摘要失败则直接丢弃
+    压缩只替换历史记录的旧对话部分（系统提示词之后、最近几轮之前），替换前确认该部分未被修改，
+    压缩期间新追加的消息不受影响；替换后写回会话存储，更新历史记录的大小。
+    """
+
+    def __init__(self):
+        # 进行中的压缩任务：id(历史记录) -> Task
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, session_id: str, messages: List[Dict], model: str):
+        """历史记录超出预算时，在后台启动压缩"""
+        key = id(messages)
+        if key in self._tasks:
+            return
+        budget = history_budget(model)
+        tokens = history_tokens(messages)
+        if tokens <= budget:
+            return
+        logger.info(f"[History] {tokens} tokens exceeds budget {budget} for {model}, compacting in background")
+        task = asyncio.create_task(self._compact(session_id, messages, model, budget))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _compact(self, session_id: str, messages: List[Dict], model: str, budget: int):
+        try:
+            turn_starts = _turn_starts(messages)
+            if len(turn_starts) <= KEEP_RECENT_TURNS:
+                return
+            # 旧对话范围：[start, end)，系统提示词（下标 0）不参与压缩
+            start = 1 if messages and messages[0]["role"] == "system" else 0
+            end = turn_starts[-KEEP_RECENT_TURNS]
+            old = messages[start:end]
+            if not old or (len(old) == 1 and (old[0].get("content") or "").startswith(SUMMARY_PREFIX)):
+                return
+            target = int(budget * COMPACTION_TARGET_RATIO)
+            recent_tokens = history_tokens(messages) - history_tokens(old)
+
+            # 1. 截断旧工具结果
+            compacted = [_truncate_tool_output(message) if message["role"] == "tool" else message for message in old]
+            if recent_tokens + history_tokens(compacted) > target:
+                # 2. 摘要旧对话
+                summary = await self._summarize(compacted, model)
+                # 以助手消息的形式保留摘要，避免模型将其当作用户的发言
+                compacted = [{"role": "assistant", "content": f"{SUMMARY_PREFIX}\n{summary}"}] if summary else []
+
+            # 替换前确认旧对话部分未被修改（进行中的请求只会在末尾追加消息）
+            if len(messages) < end or any(a is not b for a, b in zip(messages[start:end], old)):
+                logger.warning("[History] History changed during compaction, discarding result")
+                return
+            # 压缩期间会话被移出内存并重新加载（内存中已是另一个列表）时，放弃本次结果
+            if not session_store.holds(session_id, messages):
+                logger.warning(f"[History] Session {session_id} was reloaded during compaction, discarding result")
+                return
+            messages[start:end] = compacted
+            session_store.save(session_id, messages)
+            logger.info(f"[History] Compacted {len(old)} messages into {len(compacted)}, now {history_tokens(messages)} tokens")
+        except Exception as e:
+            logger.error(f"[History] Compaction failed: {e}")
+
+    async def _summarize(self, messages: List[Dict], model: str) -> Optional[str]:
+        try:
+            response = await llm_gateway.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": _render_for_summary(messages)},
+                ],
+                max_tokens=SUMMARY_MAX_TOKENS,
+                temperature=0.3,
+                extra_body={"enable_thinking": False},
+            )
+            return response.choices[0].message.content
+        except Exception as e:
+            logger.warning(f"[History] Summarization failed, dropping old turns instead: {e}")
+            return None
+
+
+# 全局单例
+history_compactor = HistoryCompactor()
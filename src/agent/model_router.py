@@ -0,0 +1,290 @@
+"""
+File   : model_router.py
+Desc   : 模型路由：按模型统计首令牌时间与错误率，出错或超时时切换到同级模型，可选对冲请求（首令牌过慢时并发请求备用模型）
+Date   : 2026/02/26
+Author : Tianyu Chen
+"""
+
+import time
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+import openai
+from loguru import logger
+
+from src.utils.mcp_health import CircuitBreaker
+from src.utils.llm_gateway import llm_gateway
+from src.utils.admission import ServerBusyError
+from src.utils.telemetry import tracer, llm_fallbacks, llm_hedges
+
+# 同级模型（能力相近，可互相替代），按优先级排列
+MODEL_FALLBACKS = {
+    "qwen-plus": ["qwen3-max", "deepseek-v3.2"],
+    "qwen3-max": ["qwen-plus", "deepseek-v3.2"],
+    "deepseek-v3.2": ["qwen3-max", "qwen-plus"],
+}
+# 等待首个数据块的超时时间（秒），超时视为失败并切换模型
+FIRST_TOKEN_TIMEOUT = 30
+# 首令牌时间的统计窗口（最近 N 次请求）与错误率的统计窗口
+TTFT_WINDOW = 200
+OUTCOME_WINDOW = 50
+# 对冲延迟：主模型的首令牌时间超过其历史 P95 时发出对冲请求；样本不足时使用默认值，且不低于最小值
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 3.0
+HEDGE_MIN_DELAY = 0.5
+# 连续失败多少次后暂停使用该模型，暂停多久（秒）后放行一个试探请求
+MODEL_FAILURE_THRESHOLD = 3
+MODEL_RECOVERY_TIMEOUT = 30
+
+# 可通过切换模型解决的错误（请求本身有误，如 400，切换模型也无济于事）
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    TimeoutError,
+)
+
+
+class ModelUnavailableError(Exception):
+    """请求的模型及其同级模型均失败（连接错误、限流、服务端错误或首令牌超时）"""
+
+    def __init__(self, model: str, error: BaseException):
+        super().__init__(f"{model} and its fallbacks are unavailable ({type(error).__name__}: {error})")
+        self.model = model
+        self.error = error
+
+
+class ModelStats:
+    """单个模型的首令牌时间、错误率与熔断状态"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.ttfts: Deque[float] = deque(maxlen=TTFT_WINDOW)
+        self.outcomes: Deque[bool] = deque(maxlen=OUTCOME_WINDOW)
+        self.breaker = CircuitBreaker(f"model:{model}", MODEL_FAILURE_THRESHOLD, MODEL_RECOVERY_TIMEOUT)
+
+    def record_success(self, ttft: Optional[float] = None):
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        self.outcomes.append(True)
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.outcomes.append(False)
+        self.breaker.record_failure()
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def ttft_percentile(self, q: float) -> Optional[float]:
+        if len(self.ttfts) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.ttfts)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def hedge_delay(self) -> float:
+        percentile = self.ttft_percentile(HEDGE_PERCENTILE)
+        return max(HEDGE_MIN_DELAY, percentile if percentile is not None else HEDGE_DEFAULT_DELAY)
+
+
+async def _prepend(first, chunks: AsyncIterator) -> AsyncIterator:
+    """将已读取的首个数据块放回流的开头（chunks 为读取首个数据块时使用的迭代器）"""
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+async def _close(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception:
+            pass
+
+
+class ModelRouter:
+    """
+    模型路由（聊天智能体与 ReAct 智能体共用）
+
+    - 按会话设置的模型发起请求，记录每个模型的首令牌时间与成功 / 失败
+    - 连接错误、限流、服务端错误或首令牌超时时，依次切换到同级模型（近期错误率高的排在后面）；连续失败的模型暂停使用一段时间
+    - 对冲（可选，仅流式请求）：主模型超过其历史 P95 首令牌时间仍未返回数据块时，并发请求下一个同级模型，
+      先返回首个数据块的请求胜出，另一个请求被取消
+    已经开始输出后的错误不再切换模型（界面上已有内容），直接抛给调用方；所有候选模型均失败时抛出 ModelUnavailableError。
+    准入排队与网关的重试退避不计入首令牌时间、首令牌超时与对冲延迟：排队说明本地繁忙，并不代表模型慢，
+    此时对冲只会加重负载。
+    """
+
+    def __init__(self, fallbacks: Dict[str, List[str]] = MODEL_FALLBACKS):
+        self.fallbacks = fallbacks
+        self.stats: Dict[str, ModelStats] = {}
+
+    def get_stats(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats(model)
+        return self.stats[model]
+
+    def candidates(self, model: str) -> List[str]:
+        """候选模型：请求的模型在前，同级模型按近期错误率从低到高排列（错误率相同时保持配置的优先级）"""
+        fallbacks = [fallback for fallback in self.fallbacks.get(model, []) if fallback != model]
+        return [model] + sorted(fallbacks, key=lambda fallback: self.get_stats(fallback).error_rate)
+
+    async def create(self, hedge: bool = False, **request) -> Any:
+        """代替 client.chat.completions.create：按路由策略选择模型，经模型服务网关发起请求，返回首个成功的响应"""
+        requested = request["model"]
+        pending = self.candidates(requested)
+        last_error: Optional[BaseException] = None
+        while pending:
+            model = self._next_available(pending)
+            if model != requested:
+                llm_fallbacks.inc(requested=requested, served=model)
+                logger.warning(f"[ModelRouter] Falling back from {requested} to {model}: {last_error or 'circuit open'}")
+            try:
+                request = {**request, "model": model}
+                if not request.get("stream"):
+                    return await self._attempt_blocking(request)
+                hedge_model = self._next_available(pending, reserve=True) if hedge else None
+                if hedge_model is None:
+                    return await self._attempt_stream(request)
+                return await self._attempt_hedged(request, hedge_model, pending)
+            except (*RETRYABLE_ERRORS, ServerBusyError) as e:
+                # 排队过长（本地准入控制拒绝）也切换到同级模型，但不计为该模型的失败
+                last_error = e
+        # 全部因排队过长被拒绝时保留 ServerBusyError（界面提示繁忙）；
+        # 其他错误统一包装，避免首令牌超时的 TimeoutError 被调用方误认为本轮时间预算耗尽
+        if isinstance(last_error, ServerBusyError):
+            raise last_error
+        raise ModelUnavailableError(requested, last_error) from last_error
+
+    def _next_available(self, pending: List[str], reserve: bool = False) -> Optional[str]:
+        """从候选列表中取出下一个可用模型（熔断中的模型跳过；全部熔断时仍使用第一个）；reserve 时不占用试探名额"""
+        for model in list(pending):
+            breaker = self.get_stats(model).breaker
+            if (not breaker.is_open) if reserve else breaker.allow_request():
+                pending.remove(model)
+                return model
+        if reserve:
+            return None
+        return pending.pop(0)
+
+    async def _send(self, request: Dict, deadline: Optional[asyncio.Timeout] = None) -> Tuple[Any, float]:
+        """
+        经网关发出已准入的请求，返回 (响应, 计时起点)
+        网关重试时的排队与退避期间暂停首令牌超时，等待时间从计时中扣除
+        """
+        started = time.perf_counter()
+
+        @contextmanager
+        def pause():
+            nonlocal started
+            when = deadline.when() if deadline is not None else None
+            if when is not None:
+                deadline.reschedule(None)
+            paused = time.perf_counter()
+            try:
+                yield
+            finally:
+                waited = time.perf_counter() - paused
+                started += waited
+                if when is not None:
+                    deadline.reschedule(when + waited)
+
+        response = await llm_gateway.create(admitted=True, pause=pause, **request)
+        return response, started
+
+    async def _attempt_blocking(self, request: Dict):
+        await llm_gateway.admit(request)
+        try:
+            response, started = await self._send(request)
+        except RETRYABLE_ERRORS:
+            self.get_stats(request["model"]).record_failure()
+            raise
+        self.get_stats(request["model"]).record_success(time.perf_counter() - started)
+        return response
+
+    async def _first_chunk(self, request: Dict, admitted: bool = False) -> Tuple[Any, Any]:
+        """发起流式请求并读取首个数据块（受首令牌超时约束，准入排队不计入），返回 (数据块, 流的迭代器)"""
+        if not admitted:
+            await llm_gateway.admit(request)
+        stats = self.get_stats(request["model"])
+        stream = None
+        try:
+            async with asyncio.timeout(FIRST_TOKEN_TIMEOUT) as deadline:
+                stream, started = await self._send(request, deadline)
+                chunks = aiter(stream)
+                first = await anext(chunks)
+        except asyncio.CancelledError:
+            if stream is not None:
+                await _close(stream)
+            raise
+        except RETRYABLE_ERRORS:
+            stats.record_failure()
+            if stream is not None:
+                await _close(stream)
+            raise
+        stats.record_success(time.perf_counter() - started)
+        return first, chunks
+
+    async def _attempt_stream(self, request: Dict):
+        return _prepend(*await self._first_chunk(request))
+
+    async def _attempt_hedged(self, request: Dict, hedge_model: str, pending: List[str]):
+        model = request["model"]
+        delay = self.get_stats(model).hedge_delay()
+        # 对冲延迟从主请求准入后开始计算
+        try:
+            await llm_gateway.admit(request)
+        except ServerBusyError:
+            pending.insert(0, hedge_model)
+            raise
+        primary = asyncio.create_task(self._first_chunk(request, admitted=True))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            # 主模型在对冲延迟内返回（或失败），备用模型放回候选列表
+            pending.insert(0, hedge_model)
+            return _prepend(*primary.result())
+
+        logger.info(f"[ModelRouter] No first token from {model} after {delay:.2f}s, hedging with {hedge_model}")
+        span = tracer.current_span()
+        if span is not None:
+            span.add_event("llm.hedge", **{"llm.model": model, "llm.hedge_model": hedge_model, "llm.hedge_delay": delay})
+        if not self.get_stats(hedge_model).breaker.allow_request():
+            pending.insert(0, hedge_model)
+            return _prepend(*await primary)
+        secondary = asyncio.create_task(self._first_chunk({**request, "model": hedge_model}))
+        attempts = {primary: model, secondary: hedge_model}
+        errors = []
+        while attempts:
+            try:
+                done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                for task in attempts:
+                    task.cancel()
+                raise
+            for task in done:
+                winner = attempts.pop(task)
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                # 取消落后的请求
+                for loser, loser_model in attempts.items():
+                    loser.cancel()
+                    llm_hedges.inc(model=loser_model, result="lost")
+                llm_hedges.inc(model=winner, result="won")
+                if winner != model:
+                    logger.info(f"[ModelRouter] Hedged request to {winner} won over {model}")
+                return _prepend(*task.result())
+        raise errors[-1]
+
+
+# 全局单例
+model_router = ModelRouter()
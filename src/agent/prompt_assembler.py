@@ -0,0 +1,81 @@
+"""
+File   : prompt_assembler.py
+Desc   : 前缀缓存友好的提示词组装，以及提示词缓存命中统计
+Date   : 2026/02/17
+Author : Tianyu Chen
+"""
+
+import re
+import time
+from typing import Any, Dict, List, Optional
+from loguru import logger
+
+# 附加在用户消息末尾的易变上下文（当前时间等）
+CONTEXT_TEMPLATE = "\n\n<context>\nCurrent System Time: {time}\n</context>"
+_CONTEXT_RE = re.compile(r"\n\n<context>\n.*?\n</context>$", re.S)
+_CONTEXT_DATE_RE = re.compile(r"\n\n<context>\nCurrent System Time: (\d{4}-\d{2}-\d{2})[^\n]*\n</context>$")
+
+
+def ensure_system_prompt(message_history: List[Dict], system_prompt: str):
+    """
+    插入或更新系统提示词
+    系统提示词不包含任何易变内容，只有角色设定等被用户修改时才会变化，保证请求前缀（系统提示词、工具、历史对话）逐字节稳定，
+    以命中服务端的提示词缓存
+    """
+    if not message_history or message_history[0]["role"] != "system":
+        message_history.insert(0, {"role": "system", "content": system_prompt})
+    elif message_history[0]["content"] != system_prompt:
+        message_history[0]["content"] = system_prompt
+
+
+def build_user_message(content: str) -> Dict:
+    """
+    构造用户消息，易变上下文（当前时间）附加在消息末尾
+    上下文随消息一起写入历史记录且之后不再修改，后续请求中该消息保持不变
+    """
+    context = CONTEXT_TEMPLATE.format(time=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+    return {"role": "user", "content": f"{content}{context}"}
+
+
+def strip_context(content: str) -> str:
+    """去除 build_user_message 附加的易变上下文，得到用户的原始输入"""
+    return _CONTEXT_RE.sub("", content)
+
+
+def context_date(content: str) -> Optional[str]:
+    """build_user_message 附加的上下文中的日期（YYYY-MM-DD），没有上下文时返回 None"""
+    match = _CONTEXT_DATE_RE.search(content)
+    return match.group(1) if match else None
+
+
+class PromptCacheStats:
+    """按模型统计提示词缓存命中情况（基于接口返回的 usage.prompt_tokens_details.cached_tokens）"""
+
+    def __init__(self):
+        # 模型 -> {"requests", "prompt_tokens", "cached_tokens"}
+        self.models: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, usage: Any):
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        stats = self.models.setdefault(model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        logger.info(
+            f"[PromptCache] {model}: cached {cached_tokens}/{prompt_tokens} prompt tokens, "
+            f"hit rate {self.hit_rate(model):.1%} over {stats['requests']} requests"
+        )
+
+    def hit_rate(self, model: str) -> float:
+        stats = self.models.get(model)
+        if not stats or not stats["prompt_tokens"]:
+            return 0.0
+        return stats["cached_tokens"] / stats["prompt_tokens"]
+
+
+# 全局单例
+prompt_cache_stats = PromptCacheStats()
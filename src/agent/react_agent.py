@@ -7,20 +7,31 @@ Author : Tianyu Chen
 
 import sys
 import json
+import asyncio
 import time
 import shlex
 from pathlib import Path
+from functools import partial
+from typing import Optional
 import chainlit as cl
-from openai import AsyncOpenAI
 from loguru import logger
 
 # 引入基础设施层
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 from src.utils.mcp_client import mcp_client_instance
 from src.utils.cmd_utils import parse_help_cmd, parse_resource_cmd, parse_prompts_cmd, parse_prompt_cmd
-
-# 初始化 Client
-client = AsyncOpenAI()
+from src.utils.tool_selector import tool_selector, recent_context
+from src.utils.spill_store import spill_store, SPILL_TOOL_NAME, SPILL_TOOL_DEFINITION
+from src.agent.turn_budget import TurnBudget, FINAL_ANSWER_PROMPT
+from src.agent.history_manager import history_compactor
+from src.agent.session_store import session_store
+from src.utils.telemetry import tracer, record_llm_call, turn_duration, turn_rounds, ui_updates
+from src.agent.completion_cache import completion_cache
+from src.agent.model_router import model_router
+from src.utils.admission import admission_session, ServerBusyError
+from src.agent.tool_call_stream import ToolCallCollector
+from src.agent.prompt_assembler import ensure_system_prompt, build_user_message, prompt_cache_stats
+from src.ui import QuoteStreamRenderer
 
 async def react(message: cl.Message):
     """
@@ -49,8 +60,17 @@ async def react(message: cl.Message):
     elif prompt_cmd_result:
         user_input = prompt_cmd_result
 
+    # 模型请求按会话排队（准入控制在会话间轮转放行）
+    admission_session.set(cl.user_session.get("id") or admission_session.get())
+
     # 进入 ReAct 循环逻辑
-    await run_react_cycle(user_input)
+    with tracer.span("agent.turn", **{"agent": "react", "llm.model": cl.user_session.get("model_settings")["Model"]}) as turn_span:
+        try:
+            await run_react_cycle(user_input)
+        finally:
+            turn_duration.observe(turn_span.duration, agent="react")
+            turn_rounds.observe(turn_span.attributes.get("rounds", 0), agent="react")
+            ui_updates.observe(turn_span.attributes.get("ui.updates", 0), agent="react")
     logger.info("\n==================[System] Message processing completed.]==================\n\n")
 
 def get_system_prompt(model_settings):
@@ -62,7 +82,7 @@ def get_system_prompt(model_settings):
 {model_settings['RoleSetting']}
 
 # Background
-- Current System Time: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
+- The current system time is provided in the <context> block at the end of each user message.
 
 # Workflow
 - You will alternate between thinking, acting (using tools available), observing (tool results), and answering.
@@ -79,161 +99,238 @@ async def run_react_cycle(user_query: str):
     ReAct 核心循环 (Text -> Tool -> Text)
     """
     # 获取上下文
-    message_history = cl.user_session.get("message_history", [])
+    session_id = cl.user_session.get("id")
+    message_history = await session_store.load(session_id)
     model_settings = cl.user_session.get("model_settings")
     
-    # 构造 System Prompt
-    system_prompt = get_system_prompt(model_settings)
-    if not message_history or message_history[0]["role"] != "system":
-        message_history.insert(0, {"role": "system", "content": system_prompt})
-    else:
-        message_history[0]["content"] = system_prompt
+    # 构造 System Prompt（不含易变内容，保证请求前缀稳定以命中提示词缓存）
+    ensure_system_prompt(message_history, get_system_prompt(model_settings))
     
-    message_history.append({"role": "user", "content": user_query})
+    # 工具筛选的查询：近期历史 + 当前问题（须在写入当前问题之前取历史）
+    selection_query = f"{recent_context(message_history)}\n{user_query}"
+    message_history.append(build_user_message(user_query))
+    # 本轮已调用过的工具，后续轮次始终提供
+    used_tools = set()
+    # 分页读取的大体积工具结果：随下一次请求发给模型后替换为简短说明，不在之后的请求中重复发送
+    read_pages = []
     
     # 懒加载消息对象（不立即发送）
     current_message = cl.Message(content="")
 
-    MAX_ROUNDS = 10
-    current_round = 0
-    
-    while current_round < MAX_ROUNDS:
-        current_round += 1
-        message_sent = False
-        tools = mcp_client_instance.get_tools_definitions()
-        
-        # --- 1. 调用模型 ---
-        try:
-            stream = await client.chat.completions.create(
-                model=model_settings["Model"],
-                messages=message_history,
-                tools=tools if tools else None,
-                tool_choice="auto" if tools else None,
-                stream=True,
-                temperature=model_settings["Temperature"],
-                extra_body={"enable_thinking": model_settings["Thinking"]} 
+    # 本轮对话的预算：总耗时、输出令牌数、单次工具调用时限
+    budget = TurnBudget(max_tokens_per_call=model_settings["MaxTokens"])
+    # 本轮对话的界面更新次数
+    ui_update_count = 0
+
+    while True:
+        # 每一轮（一次模型调用 + 本轮的工具调用）一个 Span，工具调用的 Span 为其子 Span
+        with tracer.span("react.round", **{"round": budget.rounds + 1}) as round_span:
+            # 剩余轮次 / 时间 / 令牌不足时，不再提供工具，强制模型给出最终回答
+            is_final_round = budget.should_finalize
+            budget.start_round()
+            tools = None if is_final_round else mcp_client_instance.get_tools_definitions()
+            if tools:
+                if model_settings.get("ToolSelection", False):
+                    # 只提供与问题最相关的工具（固定工具与已调用过的工具始终保留，保持注册表顺序）；
+                    # 不同问题的工具子集不同，位于消息之前的工具列表随之变化，提示词缓存只能在同一轮对话内命中
+                    pinned = used_tools.union(mcp_client_instance.get_pinned_tools())
+                    tools = tool_selector.select(tools, selection_query, pinned=pinned)
+                # 内置工具：分页读取被截断的大体积工具结果
+                tools = tools + [SPILL_TOOL_DEFINITION]
+            messages = message_history
+            if is_final_round and message_history[-1]["role"] == "tool":
+                logger.warning(f"[Budget] Nearly spent ({budget.summary()}), forcing final answer")
+                messages = message_history + [{"role": "user", "content": FINAL_ANSWER_PROMPT}]
+
+            # [State] 本轮数据缓存（思考与正文由渲染器增量累积，按帧率刷新界面）
+            renderer = QuoteStreamRenderer(current_message)
+            # 只读工具的参数完整后立即执行（时限按启动时的剩余预算计算），与模型的后续输出并行
+            tool_calls = ToolCallCollector(
+                lambda tool: execute_tool_call(tool, budget.tool_call_timeout()),
+                speculative=lambda name: name == SPILL_TOOL_NAME or mcp_client_instance.is_read_only_tool(name)
             )
-        except Exception as e:
-            err_msg = f"⚠️ Model API Error: {str(e)}"
-            logger.error(err_msg)
-            if not message_sent:
-                await current_message.send()
-            current_message.content += f"\n{err_msg}"
-            await current_message.update()
-            break
-
-        # [State] 本轮数据缓存
-        current_thought = ""
-        current_answer = ""
-        tool_calls_buffer = {}
-        
-        # --- 2. 处理流式响应 ---
-        async for chunk in stream:
-            delta = chunk.choices[0].delta
-            
-            # A. 收集思考 (Reasoning)
-            reasoning = getattr(delta, "reasoning_content", None)
-            if reasoning and model_settings["Thinking"]:
-                current_thought += reasoning
-            
-            # B. 收集正文 (Content)
-            if delta.content:
-                current_answer += delta.content
-            
-            # C. 收集工具调用 (Tool Calls)
-            if delta.tool_calls:
-                for tool_call in delta.tool_calls:
-                    idx = tool_call.index
-                    if idx not in tool_calls_buffer:
-                        tool_calls_buffer[idx] = {
-                            "id": tool_call.id,
-                            "name": tool_call.function.name or "",
-                            "args": tool_call.function.arguments or ""
-                        }
-                    else:
-                        if tool_call.function.name:
-                            tool_calls_buffer[idx]["name"] = tool_call.function.name
-                        if tool_call.function.arguments:
-                            tool_calls_buffer[idx]["args"] += tool_call.function.arguments
-
-            # === 渲染逻辑：Markdown 引用块格式 ===
-            # 格式： > 思考内容 \n\n 正文内容
-
-            display_parts = []
+            usage = None
+            streamed_chunks = 0
+            call_started = time.time_ns()
+            first_token = None
+            call_error = None
+
+            try:
+                # 模型调用与整个流式响应都受本轮剩余时间约束
+                async with asyncio.timeout(budget.remaining_time):
+                    # --- 1. 调用模型（开启回复缓存时，相同的请求直接回放缓存的回复；否则经模型路由请求） ---
+                    stream = await completion_cache.create(
+                        partial(model_router.create, hedge=model_settings.get("Hedging", False)),
+                        enabled=model_settings.get("CompletionCache", False),
+                        model=model_settings["Model"],
+                        messages=messages,
+                        tools=tools if tools else None,
+                        tool_choice="auto" if tools else None,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        temperature=model_settings["Temperature"],
+                        max_tokens=budget.model_max_tokens(),
+                        extra_body={"enable_thinking": model_settings["Thinking"]} 
+                    )
 
+                    # --- 2. 处理流式响应 ---
+                    async for chunk in stream:
+                        # 最后一个数据块只携带令牌用量，没有 choices
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            continue
+                        streamed_chunks += 1
+                        first_token = first_token or time.time_ns()
+                        delta = chunk.choices[0].delta
+                    
+                        # A. 收集思考 (Reasoning)
+                        reasoning = getattr(delta, "reasoning_content", None)
+                        if reasoning and model_settings["Thinking"]:
+                            await renderer.add_thinking(reasoning)
+                    
+                        # B. 收集正文 (Content)
+                        if delta.content:
+                            await renderer.add_answer(delta.content)
+                    
+                        # C. 收集工具调用 (Tool Calls)，参数完整的调用立即开始执行
+                        if delta.tool_calls:
+                            tool_calls.add(delta.tool_calls)
+
+                    # 流结束：刷新剩余内容
+                    await renderer.finish()
+            except TimeoutError:
+                # 超出本轮时间预算（模型的首令牌超时已由模型路由包装为 ModelUnavailableError，走下方的错误处理）：保留已生成的正文，丢弃未启动的工具调用（已启动的等待完成后写入历史，随后结束本轮）
+                tool_calls.abandon()
+                call_error = "turn time limit reached"
+                logger.warning(f"[Budget] Time limit reached ({budget.summary()}), stopping generation")
+                await renderer.finish()
+                if not renderer.sent:
+                    await current_message.send()
+                current_message.content += "\n\n⚠️ 已达到本轮对话的时间上限，回答可能不完整。"
+                await current_message.update()
+            except ServerBusyError as e:
+                # 排队过长：请求未发出，提示用户稍后重试；第一轮即被拒绝时本条问题不写入历史
+                logger.warning(f"[Admission] {e}")
+                round_span.set_error(str(e))
+                if message_history[-1]["role"] == "user":
+                    message_history.pop()
+                if not renderer.sent:
+                    await current_message.send()
+                current_message.content += f"\n⚠️ 当前请求过多，服务繁忙（预计需排队 {e.wait:.0f} 秒），请稍后重试。"
+                await current_message.update()
+                ui_update_count += 1
+                break
+            except Exception as e:
+                err_msg = f"⚠️ Model API Error: {str(e)}"
+                logger.error(err_msg)
+                # 丢弃未启动的工具调用；已启动的等待完成后写入历史，保证历史与已产生的副作用一致
+                tool_calls.abandon()
+                if tool_calls:
+                    launched_calls, tool_messages = await tool_calls.results()
+                    message_history.append({"role": "assistant", "content": renderer.answer_text, "tool_calls": launched_calls})
+                    message_history.extend(tool_messages)
+                record_llm_call(model_settings["Model"], call_started, first_token, usage, streamed_chunks, error=f"{type(e).__name__}: {e}")
+                round_span.set_error(err_msg)
+                await renderer.finish()
+                if not renderer.sent:
+                    await current_message.send()
+                current_message.content += f"\n{err_msg}"
+                await current_message.update()
+                ui_update_count += renderer.updates + 1
+                break
+
+            # 未返回令牌用量时，按流式数据块数估算
+            budget.record_usage(usage.completion_tokens if usage else streamed_chunks)
+            record_llm_call(model_settings["Model"], call_started, first_token, usage, streamed_chunks, error=call_error)
+            ui_update_count += renderer.updates
+            prompt_cache_stats.record(model_settings["Model"], usage)
+            _stub_read_pages(read_pages)
+
+            # 流结束后的最终状态记录
+            current_thought = renderer.thinking_text
+            current_answer = renderer.answer_text
+            assistant_msg = {"role": "assistant", "content": current_answer} # 历史记录里只存正文，不存思考过程(可选)
             if current_thought:
-                # 简单处理：给每一行加 >，或者直接全块加 >
-                # 为了流式效果好，通常直接前面加 >，换行符替换为 \n>
-                formatted_thought = "> " + current_thought.replace("\n", "\n> ")
-                display_parts.append(formatted_thought)
-            
+                logger.debug(f"\n[🧠 Thinking] {current_thought}")
             if current_answer:
-                display_parts.append(current_answer)
-            
-            full_content = "\n\n".join(display_parts)
-            
-            if full_content:
-                current_message.content = full_content
-                if not message_sent:
-                    await current_message.send()
-                    message_sent = True
-                else:
-                    await current_message.update()
-
-        # 流结束后的最终状态记录
-        full_content = current_message.content
-        assistant_msg = {"role": "assistant", "content": current_answer} # 历史记录里只存正文，不存思考过程(可选)
-        if current_thought:
-            logger.debug(f"\n[🧠 Thinking] {current_thought}")
-        if current_answer:
-            logger.debug(f"\n[🧸 Answer] {current_answer}")
-
-        # --- 3. 工具调用与循环控制 ---
-        if tool_calls_buffer:
-            # 整理工具调用参数
-            proper_tool_calls = []
-            for idx, data in tool_calls_buffer.items():
-                proper_tool_calls.append({
-                    "id": data["id"],
-                    "type": "function",
-                    "function": {"name": data["name"], "arguments": data["args"]}
-                })
-
-            # 记录 Assistant 消息（带 ToolCall）
-            assistant_msg["tool_calls"] = proper_tool_calls
-            message_history.append(assistant_msg) 
-
-            # 执行工具
-            for tool in proper_tool_calls:
-                func_name = tool["function"]["name"]
-                call_id = tool["id"]
-                args_str = tool["function"]["arguments"]
- 
-                async with cl.Step(name=func_name, type="tool") as step:
-                    step.input = args_str
-                    try:
-                        args = json.loads(args_str)
-                        tool_result = await mcp_client_instance.call_tool(func_name, args)
-                        # 确保结果是字符串
-                        if not isinstance(tool_result, str):
-                            tool_result = json.dumps(tool_result, ensure_ascii=False)
-                        step.output = tool_result
-                    except Exception as e:
-                        tool_result = f"Error: {str(e)}"
-                        step.output = tool_result
-                        step.is_failed = True
-
-                    message_history.append({
-                        "role": "tool",
-                        "tool_call_id": call_id,
-                        "name": func_name,
-                        "content": tool_result
-                    })
-
-            # 准备下一轮：创建新的消息对象，但不立即发送
-            current_message = cl.Message(content="")
-
-        else:
-            # 没有工具调用，对话结束
-            message_history.append(assistant_msg)
-            break
+                logger.debug(f"\n[🧸 Answer] {current_answer}")
+
+            # --- 3. 工具调用与循环控制 ---
+            if tool_calls:
+                # 等待所有工具执行完成（各 Server 的并发上限由 MCP Client 控制），结果按原调用顺序写入历史
+                proper_tool_calls, tool_messages = await tool_calls.results()
+
+                used_tools.update(tool["function"]["name"] for tool in proper_tool_calls)
+
+                # 记录 Assistant 消息（带 ToolCall）
+                assistant_msg["tool_calls"] = proper_tool_calls
+                message_history.append(assistant_msg) 
+                message_history.extend(tool_messages)
+                read_pages.extend(message for message in tool_messages if message["name"] == SPILL_TOOL_NAME)
+
+                # 准备下一轮：创建新的消息对象，但不立即发送
+                current_message = cl.Message(content="")
+
+            else:
+                # 没有工具调用，对话结束
+                message_history.append(assistant_msg)
+                break
+
+            if is_final_round or call_error:
+                break
+
+    logger.info(f"[Budget] Turn finished: {budget.summary()}")
+    turn_span = tracer.current_span()
+    if turn_span is not None:
+        turn_span.set_attributes(**{"rounds": budget.rounds, "budget": budget.summary(), "ui.updates": ui_update_count})
+
+    # 保存历史记录，超出令牌预算时在后台压缩（不阻塞下一条消息）
+    _stub_read_pages(read_pages)
+    session_store.save(session_id, message_history)
+    history_compactor.schedule(session_id, message_history, model_settings["Model"])
+
+
+def _stub_read_pages(read_pages: list):
+    """将已发给模型的分页内容替换为范围说明"""
+    for message in read_pages:
+        message["content"] = spill_store.stub(message["content"])
+    read_pages.clear()
+
+
+async def execute_tool_call(tool: dict, timeout: Optional[float] = None) -> dict:
+    """
+    执行单个工具调用（在独立的 Step 中展示），返回 role=tool 的历史消息
+    timeout 为本次调用的时限（由本轮对话的预算决定）
+    """
+    func_name = tool["function"]["name"]
+    call_id = tool["id"]
+    args_str = tool["function"]["arguments"]
+
+    async with cl.Step(name=func_name, type="tool") as step:
+        step.input = args_str
+        try:
+            args = json.loads(args_str) if args_str else {}
+            if func_name == SPILL_TOOL_NAME:
+                tool_result = await spill_store.read(**args)
+            else:
+                tool_result = await mcp_client_instance.call_tool(func_name, args, timeout=timeout)
+            # 确保结果是字符串
+            if not isinstance(tool_result, str):
+                tool_result = json.dumps(tool_result, ensure_ascii=False)
+            step.output = tool_result
+        except Exception as e:
+            tool_result = f"Error: {str(e)}"
+            step.output = tool_result
+            step.is_failed = True
+
+    # 界面展示完整结果，历史记录中大体积结果只保留预览 + 句柄（分页读取的结果本身不再转存）
+    if func_name != SPILL_TOOL_NAME:
+        tool_result = await spill_store.spill(tool_result)
+
+    return {
+        "role": "tool",
+        "tool_call_id": call_id,
+        "name": func_name,
+        "content": tool_result
+    }
@@ -0,0 +1,233 @@
+"""
+File   : session_store.py
+Desc   : 会话历史存储：活跃会话的历史记录保留在内存（LRU），空闲会话压缩后写入本地 SQLite，下一条消息到达时再加载
+Date   : 2026/03/04
+Author : Tianyu Chen
+"""
+
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from loguru import logger
+
+from src.utils.telemetry import session_count, session_memory, session_history_bytes, session_offloads, session_loads
+
+# 会话数据库路径
+SESSION_STORE_PATH = ".cache/sessions.sqlite3"
+# 内存中最多保留的会话数与历史记录总大小（序列化后的字节数），超出时将最久未使用的会话写入磁盘
+SESSION_HOT_LIMIT = 200
+SESSION_HOT_MAX_BYTES = 200 * 1024 * 1024
+# 会话空闲超过该时间（秒）后写入磁盘，检查间隔（秒）
+SESSION_IDLE_TIMEOUT = 600
+SESSION_SWEEP_INTERVAL = 60
+# 磁盘上的会话保留时间（秒），与 .chainlit/config.toml 中的 user_session_timeout 一致
+SESSION_RETENTION = 1296000
+# zlib 压缩级别
+SESSION_COMPRESSION_LEVEL = 6
+
+
+class _Entry:
+    __slots__ = ("history", "size", "last_used")
+
+    def __init__(self, history: List[Dict], size: int):
+        self.history = history
+        # 序列化后的字节数（save() 时更新）
+        self.size = size
+        self.last_used = time.monotonic()
+
+
+def _serialize(history: List[Dict]) -> bytes:
+    return json.dumps(history, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+class SessionStore:
+    """
+    会话历史存储（代替 cl.user_session 中的 message_history）
+
+    - load() 返回会话的历史记录（列表对象），智能体在本轮对话中直接修改，结束时调用 save()
+    - 内存中按最近使用顺序保留活跃会话，超出数量 / 大小上限或空闲超过 SESSION_IDLE_TIMEOUT 的会话
+      序列化为 JSON 并以 zlib 压缩写入 SQLite，从内存中移除；下次 load() 时从磁盘加载
+    - 用户断开连接（on_chat_end）时立即写入磁盘
+    对话进行中的会话在 save() 之前被移出内存时，save() 会将其重新放回内存并在之后写回，不会丢失本轮内容。
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, hot_limit: int = SESSION_HOT_LIMIT,
+                 hot_max_bytes: int = SESSION_HOT_MAX_BYTES, idle_timeout: float = SESSION_IDLE_TIMEOUT):
+        self.path = Path(path)
+        self.hot_limit = hot_limit
+        self.hot_max_bytes = hot_max_bytes
+        self.idle_timeout = idle_timeout
+        # 会话 ID -> 内存中的历史记录，按最近使用顺序排列
+        self.hot: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hot_bytes = 0
+        # 正在写入磁盘的会话，加载前须等待写入完成
+        self._writing: Dict[str, asyncio.Task] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        session_count.set_function(lambda: len(self.hot), state="memory")
+        session_memory.set_function(lambda: self.hot_bytes)
+
+    async def load(self, session_id: str) -> List[Dict]:
+        """获取会话的历史记录：优先从内存读取，否则从磁盘加载，都没有时返回新的空列表"""
+        entry = self.hot.get(session_id)
+        if entry is None:
+            if session_id in self._writing:
+                await asyncio.shield(self._writing[session_id])
+            history, size = None, 0
+            try:
+                blob = await asyncio.to_thread(self._read, session_id)
+                if blob is not None:
+                    payload = zlib.decompress(blob)
+                    history, size = json.loads(payload), len(payload)
+            except Exception as e:
+                logger.warning(f"[SessionStore] Failed to load session {session_id}, starting empty: {e}")
+            # 加载期间可能已有同一会话的请求放入内存
+            entry = self.hot.get(session_id)
+            if entry is None:
+                session_loads.inc(source="disk" if history is not None else "new")
+                entry = self._insert(session_id, history or [], size)
+                logger.debug(f"[SessionStore] Loaded session {session_id} ({len(entry.history)} messages) from {'disk' if history is not None else 'scratch'}")
+        else:
+            session_loads.inc(source="memory")
+        entry.last_used = time.monotonic()
+        self.hot.move_to_end(session_id)
+        self._enforce_limits()
+        self._start_sweeper()
+        return entry.history
+
+    def save(self, session_id: str, history: List[Dict]):
+        """本轮对话结束：更新历史记录的大小与最近使用时间，超出内存上限时将最久未使用的会话写入磁盘"""
+        size = len(_serialize(history))
+        session_history_bytes.observe(size)
+        entry = self.hot.get(session_id)
+        if entry is None:
+            self._insert(session_id, history, size)
+        else:
+            self.hot_bytes += size - entry.size
+            entry.history, entry.size = history, size
+            entry.last_used = time.monotonic()
+            self.hot.move_to_end(session_id)
+        self._enforce_limits()
+
+    def holds(self, session_id: str, history: List[Dict]) -> bool:
+        """history 是否仍是该会话的历史记录（会话被移出内存后又从磁盘重新加载时，内存中是另一个列表）"""
+        entry = self.hot.get(session_id)
+        return entry is None or entry.history is history
+
+    async def offload(self, session_id: str):
+        """立即将会话写入磁盘并移出内存（如用户断开连接时）"""
+        if session_id in self.hot:
+            self._offload(session_id, "chat_end")
+        if session_id in self._writing:
+            await asyncio.shield(self._writing[session_id])
+
+    def _insert(self, session_id: str, history: List[Dict], size: int) -> _Entry:
+        entry = _Entry(history, size)
+        self.hot[session_id] = entry
+        self.hot_bytes += size
+        return entry
+
+    def _enforce_limits(self):
+        # 最近使用的会话（刚加载 / 保存的会话）始终保留
+        while len(self.hot) > 1 and (len(self.hot) > self.hot_limit or self.hot_bytes > self.hot_max_bytes):
+            self._offload(next(iter(self.hot)), "lru")
+
+    def _offload(self, session_id: str, reason: str):
+        """移出内存；在事件循环中序列化（此时历史记录不会被并发修改），压缩与写入在线程中进行"""
+        entry = self.hot.pop(session_id)
+        self.hot_bytes -= entry.size
+        if not entry.history:
+            return
+        session_offloads.inc(reason=reason)
+        payload = _serialize(entry.history)
+        previous = self._writing.get(session_id)
+
+        async def write():
+            if previous is not None:
+                await previous
+            try:
+                await asyncio.to_thread(self._write, session_id, payload)
+            except Exception as e:
+                logger.warning(f"[SessionStore] Failed to offload session {session_id}: {e}")
+            finally:
+                if self._writing.get(session_id) is task:
+                    del self._writing[session_id]
+
+        task = asyncio.create_task(write())
+        self._writing[session_id] = task
+
+    def _start_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        """定期将空闲会话写入磁盘，并清理超过保留时间的会话"""
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            now = time.monotonic()
+            idle = [session_id for session_id, entry in self.hot.items() if now - entry.last_used > self.idle_timeout]
+            for session_id in idle:
+                self._offload(session_id, "idle")
+            if idle:
+                logger.info(f"[SessionStore] Offloaded {len(idle)} idle sessions, {len(self.hot)} remain in memory ({self.hot_bytes / 1024 / 1024:.1f}MB)")
+            try:
+                stored = await asyncio.to_thread(self._purge)
+                session_count.set(stored, state="disk")
+            except Exception as e:
+                logger.warning(f"[SessionStore] Failed to purge expired sessions: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, history BLOB, size INTEGER, stored_size INTEGER, updated REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        return self._db
+
+    def _read(self, session_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connect().execute("SELECT history FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            return row[0] if row is not None else None
+
+    def _write(self, session_id: str, payload: bytes):
+        blob = zlib.compress(payload, SESSION_COMPRESSION_LEVEL)
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO sessions (session_id, history, size, stored_size, updated) VALUES (?, ?, ?, ?, ?)",
+                (session_id, blob, len(payload), len(blob), time.time()),
+            )
+
+    def _purge(self) -> int:
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - SESSION_RETENTION,))
+            return db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def close(self):
+        """停止定期检查，将内存中的会话全部写入磁盘"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for session_id in list(self.hot):
+            self._offload(session_id, "shutdown")
+        if self._writing:
+            await asyncio.gather(*self._writing.values(), return_exceptions=True)
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# 全局单例
+session_store = SessionStore()
@@ -0,0 +1,136 @@
+"""
+File   : tool_call_stream.py
+Desc   : 流式工具调用收集：增量解析工具调用参数，只读工具的参数完整后立即执行（与模型的后续输出并行）
+Date   : 2026/02/18
+Author : Tianyu Chen
+"""
+
+import json
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+
+# 是否在参数完整后立即执行只读工具（False 时等待模型输出结束后再统一执行）
+SPECULATIVE_TOOL_EXECUTION = True
+
+
+class StreamedToolCall:
+    """
+    单个流式工具调用
+
+    参数片段到达时增量扫描 JSON（只处理新增片段，记录嵌套深度与字符串 / 转义状态），
+    顶层对象闭合且能完整解析时视为参数完整。
+    """
+
+    def __init__(self, call_id: Optional[str], name: str):
+        self.id = call_id
+        self.name = name
+        self._args: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._closed = False
+        # 已启动的执行任务及其使用的参数
+        self.task: Optional[asyncio.Task] = None
+        self.launched_args: Optional[str] = None
+
+    @property
+    def arguments(self) -> str:
+        return "".join(self._args)
+
+    @property
+    def is_complete(self) -> bool:
+        if not self._closed:
+            return False
+        try:
+            json.loads(self.arguments)
+            return True
+        except ValueError:
+            return False
+
+    def feed(self, text: str):
+        self._args.append(text)
+        for char in text:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._closed = True
+            elif not char.isspace() and self._closed:
+                # 闭合后仍有非空白内容：参数不是单个 JSON 对象，等待流结束后再执行
+                self._closed = False
+
+    def to_message(self, arguments: Optional[str] = None) -> Dict:
+        """OpenAI 格式的工具调用（写入 assistant 消息），arguments 默认为当前已收到的参数"""
+        return {"id": self.id, "type": "function", "function": {"name": self.name, "arguments": self.arguments if arguments is None else arguments}}
+
+
+class ToolCallCollector:
+    """
+    流式工具调用收集器
+
+    按 index 合并 delta.tool_calls 片段；只读工具（speculative(name) 为 True）的参数完整时，
+    立即通过 launch 启动该工具，工具的执行时间与模型继续输出其他调用 / 正文的时间重叠。
+    有副作用的工具（如写文件）等流结束后由 results() 统一启动，结果按原顺序返回。
+    已启动的调用不会重新执行，也不会被丢弃：写入历史的始终是实际执行时使用的参数。
+    """
+
+    def __init__(self, launch: Callable[[Dict], Awaitable[Dict]], speculative: Callable[[str], bool] = lambda name: False):
+        self.launch = launch
+        self.speculative = speculative
+        self.calls: Dict[int, StreamedToolCall] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.calls)
+
+    def add(self, delta_tool_calls):
+        """合并一个数据块中的工具调用片段"""
+        for tool_call in delta_tool_calls:
+            idx = tool_call.index
+            call = self.calls.get(idx)
+            if call is None:
+                call = self.calls[idx] = StreamedToolCall(tool_call.id, tool_call.function.name or "")
+            elif tool_call.function.name:
+                call.name = tool_call.function.name
+            if tool_call.function.arguments:
+                call.feed(tool_call.function.arguments)
+            self._start(call)
+
+    def _start(self, call: StreamedToolCall, final: bool = False):
+        if call.task is not None:
+            return
+        if not final:
+            # 提前执行：仅限参数已完整解析的只读工具
+            if not (SPECULATIVE_TOOL_EXECUTION and call.name and call.is_complete and self.speculative(call.name)):
+                return
+        call.launched_args = call.arguments
+        call.task = asyncio.create_task(self.launch(call.to_message()))
+        logger.debug(f"[ToolStream] Started {call.name or '<unnamed>'} (speculative: {not final})")
+
+    async def results(self) -> Tuple[List[Dict], List[Dict]]:
+        """流结束后调用：返回 (工具调用列表, 工具结果消息列表)，均按调用顺序排列"""
+        calls = [self.calls[idx] for idx in sorted(self.calls)]
+        for call in calls:
+            if call.task is not None and call.arguments.strip() != call.launched_args.strip():
+                # 不重新执行：历史中记录实际执行时的参数，与工具结果保持一致
+                logger.warning(f"[ToolStream] Arguments of {call.name} changed after launch, keeping the launched call")
+            self._start(call, final=True)
+        messages = await asyncio.gather(*(call.task for call in calls))
+        return [call.to_message(call.launched_args) for call in calls], list(messages)
+
+    def abandon(self):
+        """
+        放弃本轮尚未启动的工具调用（如超时或模型调用失败）；已启动的调用保留，
+        由调用方通过 results() 等待其完成并写入历史，避免已发出的请求从历史中消失
+        """
+        self.calls = {idx: call for idx, call in self.calls.items() if call.task is not None}
@@ -0,0 +1,99 @@
+"""
+File   : turn_budget.py
+Desc   : 单轮对话的预算（总耗时、输出令牌数、单次工具调用时限）
+Date   : 2026/01/27
+Author : Tianyu Chen
+"""
+
+import time
+from typing import Optional
+
+# 单轮对话最多的 ReAct 轮次
+TURN_MAX_ROUNDS = 10
+# 单轮对话的总耗时上限（秒）
+TURN_TIME_LIMIT = 180
+# 单轮对话的输出令牌总数上限（含思考过程）
+TURN_MAX_OUTPUT_TOKENS = 16384
+# 单次工具调用的时限（秒）
+TOOL_CALL_TIMEOUT = 60
+# 为最终回答预留的时间（秒）与令牌数：剩余预算低于该值时强制进入最终回答轮
+FINAL_ANSWER_TIME_RESERVE = 30
+FINAL_ANSWER_TOKEN_RESERVE = 1024
+
+# 强制最终回答时追加的提示（仅用于本次模型调用，不写入历史）
+FINAL_ANSWER_PROMPT = (
+    "The budget for this turn is nearly spent. Do not call any more tools. "
+    "Answer the user's question now based on the information gathered so far, "
+    "and briefly mention anything you could not finish."
+)
+
+
+class TurnBudget:
+    """
+    单轮对话（一条用户消息）的预算
+
+    - 总耗时：从收到消息开始计时，所有模型调用和工具调用共享同一个截止时间
+    - 输出令牌：每次模型调用的 max_tokens 取 MaxTokens 设置与剩余预算的较小值
+    - 工具调用：单次调用的时限取 TOOL_CALL_TIMEOUT 与剩余时间（扣除最终回答预留）的较小值
+    剩余轮次、时间或令牌不足时，should_finalize 为 True，调用方应不带工具地请求最终回答
+    """
+
+    def __init__(
+        self,
+        max_tokens_per_call: int,
+        max_rounds: int = TURN_MAX_ROUNDS,
+        time_limit: float = TURN_TIME_LIMIT,
+        max_output_tokens: int = TURN_MAX_OUTPUT_TOKENS,
+        tool_timeout: float = TOOL_CALL_TIMEOUT,
+    ):
+        self.max_tokens_per_call = int(max_tokens_per_call)
+        self.max_rounds = max_rounds
+        self.max_output_tokens = max(max_output_tokens, self.max_tokens_per_call)
+        self.tool_timeout = tool_timeout
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + time_limit
+        self.rounds = 0
+        self.output_tokens = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def remaining_time(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def remaining_tokens(self) -> int:
+        return max(0, self.max_output_tokens - self.output_tokens)
+
+    @property
+    def is_exhausted(self) -> bool:
+        return self.remaining_time <= 0 or self.remaining_tokens <= 0
+
+    @property
+    def should_finalize(self) -> bool:
+        """下一轮是否应为最终回答轮（不再调用工具）"""
+        return (
+            self.rounds + 1 >= self.max_rounds
+            or self.remaining_time <= FINAL_ANSWER_TIME_RESERVE
+            or self.remaining_tokens <= FINAL_ANSWER_TOKEN_RESERVE
+        )
+
+    def start_round(self):
+        self.rounds += 1
+
+    def record_usage(self, completion_tokens: Optional[int]):
+        """记录一次模型调用的输出令牌数"""
+        self.output_tokens += completion_tokens or 0
+
+    def model_max_tokens(self) -> int:
+        """本次模型调用的 max_tokens"""
+        return max(1, min(self.max_tokens_per_call, self.remaining_tokens))
+
+    def tool_call_timeout(self) -> float:
+        """本次工具调用的时限（为最终回答预留时间）"""
+        return max(1.0, min(self.tool_timeout, self.remaining_time - FINAL_ANSWER_TIME_RESERVE))
+
+    def summary(self) -> str:
+        return f"rounds={self.rounds}, elapsed={self.elapsed:.1f}s, output_tokens={self.output_tokens}"
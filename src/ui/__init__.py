@@ -1,9 +1,14 @@
 """个性化 UI 模块"""
 
 from .thinking_ui import get_finished_thinking_html, get_thinking_html
+from .stream_renderer import StreamRenderer, QuoteStreamRenderer, ThinkingStreamRenderer
 
 __all__ = [
     # 深度思考 UI 组件
     "get_finished_thinking_html",
     "get_thinking_html",
+    # 流式输出渲染器
+    "StreamRenderer",
+    "QuoteStreamRenderer",
+    "ThinkingStreamRenderer",
 ]
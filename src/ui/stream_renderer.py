@@ -0,0 +1,184 @@
+"""
+File   : stream_renderer.py
+Desc   : 流式输出渲染器（增量格式化 + 按帧率合并界面更新 + 增量发送）
+Date   : 2026/02/10
+Author : Tianyu Chen
+"""
+
+import time
+import asyncio
+from typing import List, Optional
+import chainlit as cl
+
+from .thinking_ui import get_thinking_html, get_finished_thinking_html
+
+# 界面刷新帧率（次/秒），两次刷新之间到达的数据块合并为一次更新
+STREAM_FPS = 20
+# 未刷新的内容超过该长度（字符数）时立即刷新
+STREAM_FLUSH_CHARS = 512
+
+THINKING = "thinking"
+ANSWER = "answer"
+
+
+class StreamRenderer:
+    """
+    流式输出渲染器（聊天智能体与 ReAct 智能体共用）
+
+    - 增量格式化：每个数据块只处理自身，不重新格式化已有内容
+    - 合并更新：按帧率（或未刷新内容达到阈值时）刷新界面，而不是每个数据块都发送一次完整内容
+    - 增量发送：新内容是已发送内容的延续时，只发送新增部分（stream_token），每个令牌的传输量与回答长度无关；
+      只有已发送内容需要改变时（如思考块结束后折叠并显示用时）才发送一次完整内容
+    - 阶段切换（思考 -> 正文）和流结束时总是立即刷新；流结束时发送一次完整内容以结束流式状态并持久化消息
+    子类通过 _format_thinking / render 决定展示格式。
+    """
+
+    def __init__(self, message: cl.Message, fps: float = STREAM_FPS, flush_chars: int = STREAM_FLUSH_CHARS, sent: bool = False):
+        self.message = message
+        self.frame_interval = 1 / fps if fps > 0 else 0
+        self.flush_chars = flush_chars
+        # 消息是否已发送（未发送的消息在流结束时发送）
+        self.sent = sent
+        # 客户端当前展示的内容（None 表示尚未展示）
+        self._client_content: Optional[str] = "" if sent else None
+        self.phase: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.thinking_duration: Optional[float] = None
+        # 界面更新次数（发送、更新完整内容与增量发送）
+        self.updates = 0
+
+        self._thinking: List[str] = []
+        self._answer: List[str] = []
+        # 已格式化的思考内容片段
+        self._formatted_thinking: List[str] = []
+        self._pending = 0
+        self._last_flush = 0.0
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def thinking_text(self) -> str:
+        return "".join(self._thinking)
+
+    @property
+    def answer_text(self) -> str:
+        return "".join(self._answer)
+
+    @property
+    def is_thinking(self) -> bool:
+        return self.phase == THINKING
+
+    async def add_thinking(self, text: str):
+        await self._add(THINKING, text)
+
+    async def add_answer(self, text: str):
+        await self._add(ANSWER, text)
+
+    @property
+    def is_visible(self) -> bool:
+        """消息是否已展示在界面上"""
+        return self._client_content is not None
+
+    async def finish(self):
+        """流结束：结束思考阶段，发送完整内容"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.phase == THINKING:
+            self.thinking_duration = time.monotonic() - self.started_at
+        async with self._lock:
+            content = self.render()
+            if not content and not self.sent:
+                return
+            self.message.content = content
+            if not self.sent:
+                await self.message.send()
+                self.sent = True
+            else:
+                await self.message.update()
+            self.updates += 1
+            self._client_content = content
+            self._pending = 0
+
+    async def _add(self, phase: str, text: str):
+        if not text:
+            return
+        phase_changed = self.phase is not None and self.phase != phase
+        if phase_changed and self.phase == THINKING:
+            self.thinking_duration = time.monotonic() - self.started_at
+        self.phase = phase
+
+        if phase == THINKING:
+            self._formatted_thinking.append(self._format_thinking(text, first=not self._thinking))
+            self._thinking.append(text)
+        else:
+            self._answer.append(text)
+        self._pending += len(text)
+
+        if phase_changed or self._pending >= self.flush_chars or time.monotonic() - self._last_flush >= self.frame_interval:
+            await self.flush()
+        elif self._timer is None:
+            # 数据块暂停时（如模型正在输出工具调用参数），到下一帧时补刷新
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(0.0, self._last_flush + self.frame_interval - time.monotonic()))
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """将已缓冲的内容刷新到界面"""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._pending:
+                return
+            content = self.render()
+            if not content:
+                return
+            if self._client_content is not None and content.startswith(self._client_content):
+                # 只发送新增部分（首次调用 stream_token 时会发送一次当前完整内容以开始流式状态）
+                await self.message.stream_token(content[len(self._client_content):])
+            else:
+                # 已展示的内容发生变化（或消息尚未展示）：发送一次完整内容，之后继续增量发送
+                await self.message.stream_token(content, is_sequence=True)
+            self.updates += 1
+            self._client_content = content
+            self._pending = 0
+            self._last_flush = time.monotonic()
+
+    def _format_thinking(self, text: str, first: bool) -> str:
+        return text
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+
+class QuoteStreamRenderer(StreamRenderer):
+    """ReAct 智能体：思考过程以 Markdown 引用块展示，格式： > 思考内容 \\n\\n 正文内容"""
+
+    def _format_thinking(self, text: str, first: bool) -> str:
+        formatted = text.replace("\n", "\n> ")
+        return f"> {formatted}" if first else formatted
+
+    def render(self) -> str:
+        parts = []
+        if self._formatted_thinking:
+            parts.append("".join(self._formatted_thinking))
+        if self._answer:
+            parts.append(self.answer_text)
+        return "\n\n".join(parts)
+
+
+class ThinkingStreamRenderer(StreamRenderer):
+    """聊天智能体：思考过程以可折叠的思考块展示，思考结束后显示用时"""
+
+    def render(self) -> str:
+        if self.thinking_duration is None:
+            if self._thinking:
+                return get_thinking_html(self.thinking_text)
+            return self.answer_text
+        duration = max(1, int(self.thinking_duration))
+        # 添加两个换行符，强制将后续内容与 HTML 分离
+        return get_finished_thinking_html(self.thinking_text, duration) + "\n\n" + self.answer_text
@@ -0,0 +1,184 @@
+"""
+File   : admission.py
+Desc   : 模型请求准入控制：按模型的每分钟请求数 / 令牌数限流（令牌桶），排队请求在会话间轮转放行，预计等待过长时快速拒绝
+Date   : 2026/03/02
+Author : Tianyu Chen
+"""
+
+import json
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+from loguru import logger
+
+from src.utils.telemetry import admission_wait, admission_rejections
+
+# 各模型的限流配置：每分钟请求数（rpm）与每分钟令牌数（tpm），略低于服务商账号的配额，未列出的模型使用默认值
+MODEL_RATE_LIMITS = {
+    "qwen-plus": {"rpm": 600, "tpm": 1_000_000},
+    "qwen3-max": {"rpm": 600, "tpm": 1_000_000},
+    "deepseek-v3.2": {"rpm": 300, "tpm": 500_000},
+}
+DEFAULT_RATE_LIMIT = {"rpm": 600, "tpm": 1_000_000}
+# 令牌桶容量（秒）：空闲后允许的突发请求量，相当于该时长的配额
+ADMISSION_BURST_SECONDS = 10
+# 每个模型的最大排队请求数
+ADMISSION_QUEUE_LIMIT = 200
+# 预计排队时间超过该值（秒）时直接拒绝，界面提示服务繁忙
+ADMISSION_MAX_WAIT = 15
+# 估算请求令牌数：按字符数估算提示词令牌（偏保守），输出令牌按 max_tokens 计，但不超过该值
+ESTIMATED_CHARS_PER_TOKEN = 3
+ESTIMATED_COMPLETION_TOKENS = 1024
+
+# 当前请求所属的会话（由智能体在每轮对话开始时设置），用于会话间的公平调度
+admission_session: ContextVar[str] = ContextVar("admission_session", default="anonymous")
+
+
+class ServerBusyError(Exception):
+    """模型请求排队过长或队列已满，未发出请求"""
+
+    def __init__(self, model: str, wait: float):
+        super().__init__(f"{model} is busy (estimated queue wait {wait:.1f}s)")
+        self.model = model
+        self.wait = wait
+
+
+def estimate_request_tokens(request: Dict) -> int:
+    """估算一次请求消耗的令牌数（提示词 + 预计输出）"""
+    prompt = json.dumps([request.get("messages"), request.get("tools")], ensure_ascii=False, default=str)
+    completion = min(request.get("max_tokens") or ESTIMATED_COMPLETION_TOKENS, ESTIMATED_COMPLETION_TOKENS)
+    return len(prompt) // ESTIMATED_CHARS_PER_TOKEN + completion
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """积累到 amount 个令牌还需等待的时间（秒）"""
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+
+class _Waiter:
+    __slots__ = ("future", "cost", "enqueued")
+
+    def __init__(self, future: asyncio.Future, cost: int):
+        self.future = future
+        self.cost = cost
+        self.enqueued = time.monotonic()
+
+
+class ModelAdmission:
+    """
+    单个模型的准入控制
+
+    - 请求数与令牌数各一个令牌桶，两者都有余量时才放行
+    - 无排队且有余量时直接放行；否则按会话排队，由调度任务在会话间轮转放行（每个会话每次放行一个请求），
+      请求多的会话不会挤占其他会话
+    - 队列已满或预计等待超过 ADMISSION_MAX_WAIT 时抛出 ServerBusyError，不再排队
+    """
+
+    def __init__(self, model: str, rpm: float, tpm: float):
+        self.model = model
+        self.requests = TokenBucket(rpm / 60, rpm / 60 * ADMISSION_BURST_SECONDS)
+        self.tokens = TokenBucket(tpm / 60, tpm / 60 * ADMISSION_BURST_SECONDS)
+        # 会话 -> 该会话的排队请求，按轮转顺序排列
+        self.queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self.queued = 0
+        self.queued_tokens = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def estimated_wait(self, cost: int) -> float:
+        """排在前面的请求全部放行后，再放行 cost 个令牌的请求需要等待的时间（秒）"""
+        return max(self.requests.wait_time(self.queued + 1), self.tokens.wait_time(self.queued_tokens + cost))
+
+    def _ready_in(self, cost: int) -> float:
+        return max(self.requests.wait_time(1), self.tokens.wait_time(cost))
+
+    def _consume(self, cost: int):
+        self.requests.consume(1)
+        self.tokens.consume(cost)
+
+    async def acquire(self, session: str, cost: int):
+        # 超出桶容量的大请求按容量计，避免永远无法放行
+        cost = min(cost, int(self.tokens.capacity))
+        if not self.queued and self._ready_in(cost) == 0:
+            self._consume(cost)
+            admission_wait.observe(0, model=self.model)
+            return
+
+        wait = self.estimated_wait(cost)
+        if self.queued >= ADMISSION_QUEUE_LIMIT or wait > ADMISSION_MAX_WAIT:
+            admission_rejections.inc(model=self.model, reason="queue_full" if self.queued >= ADMISSION_QUEUE_LIMIT else "wait")
+            logger.warning(f"[Admission] Rejecting {self.model} request from {session}: {self.queued} queued, estimated wait {wait:.1f}s")
+            raise ServerBusyError(self.model, wait)
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), cost)
+        self.queues.setdefault(session, deque()).append(waiter)
+        self.queued += 1
+        self.queued_tokens += cost
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        # 调用方取消时 future 随之取消，调度任务跳过该请求
+        await waiter.future
+        admission_wait.observe(time.monotonic() - waiter.enqueued, model=self.model)
+
+    async def _dispatch(self):
+        while self.queues:
+            session, queue = next(iter(self.queues.items()))
+            waiter = queue[0]
+            if not waiter.future.done():
+                delay = self._ready_in(waiter.cost)
+                if delay > 0:
+                    # 等待期间该请求可能被取消，醒来后重新检查队首
+                    await asyncio.sleep(delay)
+                    continue
+            queue.popleft()
+            self.queued -= 1
+            self.queued_tokens -= waiter.cost
+            # 轮转：放行一个请求后，该会话移到队尾
+            del self.queues[session]
+            if queue:
+                self.queues[session] = queue
+            if not waiter.future.done():
+                self._consume(waiter.cost)
+                waiter.future.set_result(None)
+
+
+class AdmissionController:
+    """模型请求准入控制（全局单例，由模型服务网关在每次发出请求前调用）"""
+
+    def __init__(self, limits: Dict[str, Dict] = MODEL_RATE_LIMITS):
+        self.limits = limits
+        self.models: Dict[str, ModelAdmission] = {}
+
+    def get(self, model: str) -> ModelAdmission:
+        if model not in self.models:
+            limit = self.limits.get(model, DEFAULT_RATE_LIMIT)
+            self.models[model] = ModelAdmission(model, limit["rpm"], limit["tpm"])
+        return self.models[model]
+
+    async def acquire(self, model: str, request: Dict):
+        """等待放行（按当前会话排队）；排队过长时抛出 ServerBusyError"""
+        await self.get(model).acquire(admission_session.get(), estimate_request_tokens(request))
+
+
+# 全局单例
+admission_controller = AdmissionController()
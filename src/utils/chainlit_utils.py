@@ -45,6 +45,16 @@ async def chat_model_settings():
                 label="深度思考",
                 initial=True
             ),
+            Switch(
+                id="Hedging",
+                label="对冲请求（首令牌过慢时同时请求备用模型）",
+                initial=False
+            ),
+            Switch(
+                id="CompletionCache",
+                label="回复缓存（温度为 0 时相同问题直接返回缓存的回复）",
+                initial=False
+            ),
             Slider(
                 id="Temperature",
                 label="温度",
@@ -88,6 +98,21 @@ async def react_model_settings():
                 label="深度思考",
                 initial=False
             ),
+            Switch(
+                id="Hedging",
+                label="对冲请求（首令牌过慢时同时请求备用模型）",
+                initial=False
+            ),
+            Switch(
+                id="CompletionCache",
+                label="回复缓存（温度为 0 时相同问题直接返回缓存的回复）",
+                initial=False
+            ),
+            Switch(
+                id="ToolSelection",
+                label="工具筛选（每次只提供最相关的工具，减少提示词令牌，但工具列表变化会使提示词缓存失效）",
+                initial=False
+            ),
             Slider(
                 id="Temperature",
                 label="温度",
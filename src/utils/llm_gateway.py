@@ -0,0 +1,183 @@
+"""
+File   : llm_gateway.py
+Desc   : 模型服务网关：按服务商维护共享的 HTTP 连接池（长连接、启动预热），瞬时错误带抖动重试
+Date   : 2026/02/28
+Author : Tianyu Chen
+"""
+
+import os
+import time
+import asyncio
+from contextlib import AbstractContextManager, nullcontext
+from typing import Any, Callable, Dict, Optional, Tuple
+import httpx
+import openai
+from openai import AsyncOpenAI
+from loguru import logger
+
+from src.utils.mcp_health import backoff_delay
+from src.utils.admission import admission_controller
+from src.utils.telemetry import llm_retries
+
+# 服务商配置：API Key / Base URL 的环境变量名与连接池参数（未配置的参数使用下方默认值）
+# 服务商的环境变量未设置时回退到 OPENAI_API_KEY / OPENAI_BASE_URL；指向同一地址的服务商共用一个连接池
+LLM_PROVIDERS = {
+    "openai": {"api_key_env": "OPENAI_API_KEY", "base_url_env": "OPENAI_BASE_URL"},
+    "dashscope": {"api_key_env": "DASHSCOPE_API_KEY", "base_url_env": "DASHSCOPE_BASE_URL"},
+    "deepseek": {"api_key_env": "DEEPSEEK_API_KEY", "base_url_env": "DEEPSEEK_BASE_URL"},
+}
+# 模型所属的服务商，未列出的模型使用 "openai"
+MODEL_PROVIDERS = {
+    "qwen-plus": "dashscope",
+    "qwen3-max": "dashscope",
+    "deepseek-v3.2": "deepseek",
+}
+DEFAULT_PROVIDER = "openai"
+# 连接池默认参数：最大连接数、最大空闲长连接数、空闲长连接保持时间（秒）
+LLM_MAX_CONNECTIONS = 100
+LLM_MAX_KEEPALIVE_CONNECTIONS = 20
+LLM_KEEPALIVE_EXPIRY = 120
+# 建立连接与读取响应的超时时间（秒）；读取超时针对相邻两个数据块之间的间隔
+LLM_CONNECT_TIMEOUT = 10
+LLM_READ_TIMEOUT = 120
+# 启动时每个连接池预先建立的连接数与预热超时时间（秒）
+LLM_WARMUP_CONNECTIONS = 2
+LLM_WARMUP_TIMEOUT = 5
+# 瞬时错误的最大重试次数与退避参数（指数退避 + 抖动，秒）；之后由模型路由切换到同级模型
+LLM_MAX_RETRIES = 2
+LLM_RETRY_BACKOFF_BASE = 0.5
+LLM_RETRY_BACKOFF_MAX = 8
+
+# 可重试的瞬时错误（连接失败 / 超时、限流、服务端错误）
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """读取限流响应的 Retry-After 头（秒），无法解析时返回 None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMGateway:
+    """
+    模型服务网关（全局单例，所有会话共用）
+
+    - 每个服务商地址只创建一个 AsyncOpenAI Client，底层 httpx 连接池跨会话复用 TCP / TLS 长连接
+    - app_init 中预热连接池，首个用户请求无需建立连接
+    - 每次发出请求（含重试）前经准入控制按模型限流，排队过长时抛出 ServerBusyError；
+      模型路由在开始首令牌计时前自行调用 admit()，排队时间不计入首令牌时间与超时
+    - 连接错误、限流与服务端错误按指数退避 + 抖动重试（限流时遵循 Retry-After），
+      重试仍失败时抛给模型路由切换模型；SDK 自带的重试关闭，避免与此处的重试叠加
+    流式请求只在收到响应头之前重试，已经开始输出的流不会重放。
+    """
+
+    def __init__(self, providers: Dict[str, Dict] = LLM_PROVIDERS, model_providers: Dict[str, str] = MODEL_PROVIDERS):
+        self.providers = providers
+        self.model_providers = model_providers
+        # (base_url, api_key) -> Client，同一地址的服务商共用
+        self._clients: Dict[Tuple[Optional[str], Optional[str]], AsyncOpenAI] = {}
+        # Client 底层的 httpx 连接池（用于预热）
+        self._http_clients: Dict[Tuple[Optional[str], Optional[str]], httpx.AsyncClient] = {}
+
+    def _endpoint(self, provider: str) -> Tuple[Optional[str], Optional[str]]:
+        config = self.providers.get(provider) or self.providers[DEFAULT_PROVIDER]
+        default = self.providers[DEFAULT_PROVIDER]
+        base_url = os.environ.get(config["base_url_env"]) or os.environ.get(default["base_url_env"])
+        api_key = os.environ.get(config["api_key_env"]) or os.environ.get(default["api_key_env"])
+        return base_url, api_key
+
+    def client_for(self, model: str) -> AsyncOpenAI:
+        """获取模型所属服务商的共享 Client"""
+        return self._provider_client(self.model_providers.get(model, DEFAULT_PROVIDER))
+
+    def _provider_client(self, provider: str) -> AsyncOpenAI:
+        """获取服务商的共享 Client（首次使用时创建）"""
+        key = self._endpoint(provider)
+        if key not in self._clients:
+            config = self.providers.get(provider) or {}
+            limits = httpx.Limits(
+                max_connections=config.get("max_connections", LLM_MAX_CONNECTIONS),
+                max_keepalive_connections=config.get("max_keepalive_connections", LLM_MAX_KEEPALIVE_CONNECTIONS),
+                keepalive_expiry=config.get("keepalive_expiry", LLM_KEEPALIVE_EXPIRY),
+            )
+            timeout = httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+            self._http_clients[key] = httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True)
+            self._clients[key] = AsyncOpenAI(
+                base_url=key[0],
+                api_key=key[1],
+                max_retries=0,
+                timeout=timeout,
+                http_client=self._http_clients[key],
+            )
+            logger.info(f"[LLMGateway] Created client for provider {provider} ({key[0] or 'default endpoint'}), max_connections={limits.max_connections}")
+        return self._clients[key]
+
+    async def admit(self, request: Dict):
+        """等待准入控制放行一次请求；排队过长时抛出 ServerBusyError"""
+        await admission_controller.acquire(request["model"], request)
+
+    async def create(self, admitted: bool = False, pause: Optional[Callable[[], AbstractContextManager]] = None, **request) -> Any:
+        """
+        代替 client.chat.completions.create：使用共享 Client 发起请求，瞬时错误带抖动重试
+        admitted：调用方已为首次请求调用过 admit()（重试仍会重新排队）
+        pause：返回上下文管理器，包裹每次排队与重试退避，调用方据此暂停首令牌计时与超时
+        """
+        client = self.client_for(request["model"])
+        attempt = 0
+        while True:
+            if not admitted:
+                with pause() if pause is not None else nullcontext():
+                    await self.admit(request)
+            admitted = False
+            try:
+                return await client.chat.completions.create(**request)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= LLM_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, LLM_RETRY_BACKOFF_BASE, LLM_RETRY_BACKOFF_MAX)
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = min(LLM_RETRY_BACKOFF_MAX, max(delay, retry_after))
+                attempt += 1
+                llm_retries.inc(model=request["model"], error=type(e).__name__)
+                logger.warning(f"[LLMGateway] {request['model']} request failed ({type(e).__name__}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+                with pause() if pause is not None else nullcontext():
+                    await asyncio.sleep(delay)
+
+    async def warmup(self):
+        """预热连接池：为每个服务商地址预先建立若干条长连接（任意 HTTP 响应均可，失败不影响启动）"""
+        for provider in self.providers:
+            self._provider_client(provider)
+
+        async def touch(http_client: httpx.AsyncClient, client: AsyncOpenAI):
+            # 请求 /models 仅用于建立连接，不关心状态码
+            response = await http_client.get(str(client.base_url.join("models")), headers={"Authorization": f"Bearer {client.api_key}"})
+            await response.aread()
+
+        for key, client in self._clients.items():
+            started = time.perf_counter()
+            try:
+                async with asyncio.timeout(LLM_WARMUP_TIMEOUT):
+                    await asyncio.gather(*(touch(self._http_clients[key], client) for _ in range(LLM_WARMUP_CONNECTIONS)))
+                logger.info(f"[LLMGateway] Warmed up {LLM_WARMUP_CONNECTIONS} connections to {client.base_url} in {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                logger.warning(f"[LLMGateway] Warmup of {client.base_url} failed: {type(e).__name__}: {e}")
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+        self._http_clients.clear()
+
+
+# 全局单例
+llm_gateway = LLMGateway()
@@ -0,0 +1,140 @@
+"""
+File   : mcp_cache.py
+Desc   : MCP 调用结果缓存（LRU + TTL）与进行中请求去重（singleflight）
+Date   : 2026/01/08
+Author : Tianyu Chen
+"""
+
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+# 工具结果缓存的默认有效期（秒）
+DEFAULT_TOOL_CACHE_TTL = 60
+# 工具结果缓存的最大条目数
+TOOL_CACHE_MAX_ENTRIES = 1024
+
+
+def make_cache_key(name: str, arguments: Optional[dict]) -> Tuple[str, str]:
+    """
+    生成缓存键：名称 + 规范化后的参数
+    参数按 key 排序、去除多余空白，保证语义相同的参数得到同一个键
+    """
+    canonical_args = json.dumps(arguments or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return name, canonical_args
+
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存
+    """
+
+    def __init__(self, max_entries: int = TOOL_CACHE_MAX_ENTRIES, default_ttl: float = DEFAULT_TOOL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # key -> (过期时间, 值)
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]):
+        """删除所有满足条件的 key"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """
+    进行中请求去重：相同 key 的并发调用共享同一次上游请求
+    上游请求在独立的 Task 中执行，单个调用方被取消不会影响其他等待者
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._on_done(key, f))
+        return await asyncio.shield(future)
+
+    def _on_done(self, key: Hashable, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # 所有调用方都已取消时，避免出现 "Task exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+
+class ToolCachePolicy:
+    """
+    单个 Server 的工具缓存策略（在 server_config.json 中与 Server 配置并列声明）
+
+        "cache": {
+            "ttl": 60,               # 有效期（秒）
+            "tools": ["*"],          # 可缓存的工具（不含 Server 前缀），"*" 表示全部
+            "exclude": ["write_file"] # 不缓存的工具，优先级高于 tools
+        }
+
+    未声明 "cache" 的 Server 默认不缓存（工具可能有副作用）
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TOOL_CACHE_TTL, tools: Iterable[str] = ("*",), exclude: Iterable[str] = ()):
+        self.ttl = ttl
+        self.tools = set(tools)
+        self.exclude = set(exclude)
+
+    @classmethod
+    def from_config(cls, server_config: dict) -> Optional["ToolCachePolicy"]:
+        cache_config = server_config.get("cache")
+        if not cache_config:
+            return None
+        return cls(
+            ttl=cache_config.get("ttl", DEFAULT_TOOL_CACHE_TTL),
+            tools=cache_config.get("tools", ["*"]),
+            exclude=cache_config.get("exclude", []),
+        )
+
+    def is_cacheable(self, tool_name: str) -> bool:
+        if tool_name in self.exclude:
+            return False
+        return "*" in self.tools or tool_name in self.tools
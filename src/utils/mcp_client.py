@@ -1,18 +1,49 @@
 import os
 import json
+import time
 import asyncio
-from contextlib import AsyncExitStack
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Any, Optional, Tuple, TypeVar
 from loguru import logger
 
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from mcp.client.sse import sse_client
-from mcp.client.streamable_http import streamablehttp_client
-from mcp.types import Prompt
+from mcp import ClientSession
+from mcp.types import (
+    Prompt, ServerNotification, ResourceUpdatedNotification,
+    ToolListChangedNotification, PromptListChangedNotification, ResourceListChangedNotification,
+)
+from mcp.shared.exceptions import McpError
+
+from src.utils.mcp_connection import MCPServerConnection
+from src.utils.mcp_pool import MCPServerPool
+from src.utils.mcp_cache import TTLCache, SingleFlight, ToolCachePolicy, make_cache_key
+from src.utils.mcp_router import CapabilityRouter, CapabilityRegistry, ToolRoute
+from src.utils.mcp_snapshot import CapabilitySnapshot, config_fingerprint
+from src.utils.mcp_health import (
+    CircuitBreaker, CircuitOpenError, backoff_delay,
+    HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TIMEOUT,
+)
+from src.utils.telemetry import tracer, tool_duration, resource_duration, mcp_reconnects
+
+# 资源缓存的默认有效期（秒），用于不支持订阅的 Server，可在 server_config.json 中通过 "resource_ttl" 覆盖
+DEFAULT_RESOURCE_CACHE_TTL = 60
+# 已订阅资源的缓存有效期（秒），正常情况下由 resources/updated 通知精确失效，TTL 仅作兜底
+SUBSCRIBED_RESOURCE_CACHE_TTL = 3600
+# 资源缓存的最大条目数
+RESOURCE_CACHE_MAX_ENTRIES = 256
+# 单次请求（调用工具 / 读取资源 / 获取 Prompt）的默认超时时间（秒），可在 server_config.json 中通过 "request_timeout" 覆盖
+DEFAULT_REQUEST_TIMEOUT = 120
+# 配置文件变化检测间隔（秒）
+CONFIG_WATCH_INTERVAL = 2
+# Server 配置变化或被移除后，等待其进行中请求完成的最长时间（秒）
+DRAIN_TIMEOUT = 30
+
+T = TypeVar("T")
 
 # 分隔符配置
 SPLIT_SERVER_TOOL_NAME_WITH = "-"
+# 单个 Server 连接（含能力注册）的默认超时时间（秒），可在 server_config.json 中通过 "timeout" 覆盖
+DEFAULT_CONNECT_TIMEOUT = 30
+# 单个 Server 的默认最大并发工具调用数，可在 server_config.json 中通过 "max_concurrency" 覆盖
+DEFAULT_MAX_CONCURRENCY = 4
 
 class MCPClientManager:
     _instance = None
@@ -26,91 +57,507 @@ class MCPClientManager:
     def __init__(self):
         if self.initialized:
             return
-        self.exit_stack = AsyncExitStack()
-        
-        # 核心存储：映射 名称/URI -> Session
-        self.sessions: Dict[str, ClientSession] = {} 
-        
-        # 功能注册表
-        self.tool_definitions: List[Dict] = []  # OpenAI 格式
-        self.available_prompts: List[Dict] = [] # 简单描述格式
-        self.available_resources: List[str] = [] # URI 列表
+        # 已连接的 Server：名称 -> 会话副本池
+        self.servers: Dict[str, MCPServerPool] = {}
+        # 配置文件中的 Server 顺序（用于保持能力注册表顺序稳定）
+        self.server_order: List[str] = []
+        # 各 Server 的连接耗时（秒）
+        self.connect_durations: Dict[str, float] = {}
+        # 各 Server 的并发限制：名称 -> 信号量
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        # 各 Server 的熔断器
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # 进行中的重连任务：名称 -> Task
+        self._reconnect_tasks: Dict[str, asyncio.Task] = {}
+        # 各 Server 的工具缓存策略：名称 -> 策略（未配置则不缓存）
+        self.cache_policies: Dict[str, ToolCachePolicy] = {}
+        # 工具结果缓存 与 进行中调用去重
+        self.tool_cache = TTLCache()
+        self._tool_flights = SingleFlight()
+        # 资源内容缓存：URI -> 内容
+        self.resource_cache = TTLCache(max_entries=RESOURCE_CACHE_MAX_ENTRIES, default_ttl=DEFAULT_RESOURCE_CACHE_TTL)
+        self._resource_flights = SingleFlight()
+        # 各 Server 的资源缓存有效期
+        self.resource_ttls: Dict[str, float] = {}
+        # 已订阅更新通知的资源 URI
+        self.subscribed_resources: set = set()
+        # 资源版本号（收到更新通知时递增，防止进行中的读取写入过期内容）
+        self._resource_versions: Dict[str, int] = {}
+        # 应用启动预取完成后，后台接入的 Server 接入时自动预取其资源
+        self._prefetch_on_attach = False
+        # 后台连接任务（慢速 Server 在应用就绪后继续接入）
+        self._background_tasks: set = set()
+        # 进行中的能力刷新任务（收到 list_changed 通知时触发）：名称 -> Task
+        self._refresh_tasks: Dict[str, asyncio.Task] = {}
+        # 刷新进行中又收到通知的 Server，刷新结束后再补一次
+        self._refresh_pending: set = set()
+
+        # 配置文件路径及其修改时间（用于热加载）
+        self.config_path: Optional[str] = None
+        self._config_mtime: Optional[int] = None
+        self._reload_lock = asyncio.Lock()
+        # 各 Server 的配置：名称 -> 配置
+        self.server_configs: Dict[str, dict] = {}
+        # 各 Server 的能力注册信息：名称 -> {"tools", "prompts", "resources", "resource_templates"}
+        self._capabilities: Dict[str, Dict[str, list]] = {}
+        # 能力列表快照（热启动时先用快照填充注册表）
+        self.snapshot = CapabilitySnapshot()
+
+        # 功能注册表（含路由表：工具名 / Prompt 名 / 资源 URI -> Server 名称），能力变化时整体替换
+        self.registry = CapabilityRegistry(0, CapabilityRouter(), [], [], [])
         
         self.initialized = True
 
+    @property
+    def router(self) -> CapabilityRouter:
+        return self.registry.router
+
+    @property
+    def tool_definitions(self) -> List[Dict]:
+        return self.registry.tool_definitions
+
+    @property
+    def available_prompts(self) -> List[Dict]:
+        return self.registry.prompts
+
+    @property
+    def available_resources(self) -> List[str]:
+        return self.registry.resources
+
+    def _load_config(self, config_path: str) -> Dict[str, dict]:
+        """读取配置文件中的 Server 配置"""
+        with open(config_path, "r") as file:
+            data = json.load(file)
+        return data.get("mcpServers", {})
+
     async def initialize(self, config_path: str = "configs/server_config.json"):
-        """初始化连接并加载所有能力（Tools, Prompts, Resources）"""
+        """
+        并发连接所有 Server 并加载能力（Tools, Prompts, Resources）
+        有快照的 Server 立即从快照恢复能力列表并在后台校验；
+        否则任意一个 Server 就绪即返回，其余 Server 在后台继续接入
+        """
         try:
             if not os.path.exists(config_path):
                 logger.error(f"Config file not found: {config_path}")
                 return
 
             logger.info(f"Loading config from {config_path}")
-            with open(config_path, "r") as file:
-                data = json.load(file)
-            
-            servers = data.get("mcpServers", {})
+            self.config_path = config_path
+            self._config_mtime = os.stat(config_path).st_mtime_ns
+            servers = self._load_config(config_path)
+            watch_task = asyncio.create_task(self._watch_config(), name="mcp-config-watch")
+            self._background_tasks.add(watch_task)
+            watch_task.add_done_callback(self._background_tasks.discard)
+
+            self.server_order = list(servers.keys())
+            self.server_configs = servers
+            if not servers:
+                logger.warning("No MCP servers configured.")
+                return
+
+            startup_time = time.perf_counter()
+
+            # 1. 从快照恢复能力列表（配置未变化的 Server）
+            self.snapshot.load()
+            restored = []
             for server_name, server_config in servers.items():
-                await self._connect_to_server(server_name, server_config)
-            
-            logger.success(f"MCP Client Ready. Tools: {len(self.tool_definitions)}, Prompts: {len(self.available_prompts)}, Resources: {len(self.available_resources)}")
+                capabilities = self.snapshot.get(server_name, server_config)
+                if capabilities:
+                    self._capabilities[server_name] = capabilities
+                    restored.append(server_name)
+            if restored:
+                self._rebuild_registry()
+                logger.info(f"Restored capabilities from snapshot in {(time.perf_counter() - startup_time) * 1000:.1f}ms: {restored}")
+
+            # 2. 并发连接（有快照的按需启动 Server 直到首次使用才拉起）
+            pending = set()
+            for server_name, server_config in servers.items():
+                pool = self._create_pool(server_name, server_config)
+                if pool.lazy and server_name in restored:
+                    continue
+                pending.add(asyncio.create_task(self._attach_server(server_name), name=f"attach-{server_name}"))
+            attach_tasks = set(pending)
+            self._background_tasks.update(attach_tasks)
+            for task in attach_tasks:
+                task.add_done_callback(self._background_tasks.discard)
+
+            # 3. 没有快照时，等待第一个连接成功的 Server（或全部失败）
+            while pending and not restored:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if any(task.result() for task in done):
+                    break
+
+            health_task = asyncio.create_task(self._health_check_loop(), name="mcp-health-check")
+            self._background_tasks.add(health_task)
+            health_task.add_done_callback(self._background_tasks.discard)
+
+            logger.success(f"MCP Client Ready in {time.perf_counter() - startup_time:.2f}s. Tools: {len(self.tool_definitions)}, Prompts: {len(self.available_prompts)}, Resources: {len(self.available_resources)}")
+
+            if pending:
+                logger.info(f"Servers still connecting in background: {[task.get_name()[len('attach-'):] for task in pending]}")
+            report_task = asyncio.create_task(self._report_startup(attach_tasks, startup_time))
+            self._background_tasks.add(report_task)
+            report_task.add_done_callback(self._background_tasks.discard)
             
         except Exception as e:
             logger.exception(f"Error loading server config: {e}")
             raise
 
-    async def _connect_to_server(self, server_name: str, server_config: dict):
-        """连接到单个 MCP 服务器并注册其能力"""
-        try:
-            read, write = None, None
-            
-            # 1. 建立传输层
-            if 'url' in server_config:
-                url = server_config['url']
-                if 'sse' in url:
-                    logger.debug(f"Connecting to {server_name} via SSE: {url}")
-                    sse_transport = await self.exit_stack.enter_async_context(
-                        sse_client(url=url)
-                    )
-                    read, write = sse_transport
-                elif 'mcp' in url:
-                    logger.debug(f"Connecting to {server_name} via Streamable HTTP: {url}")
-                    streamable_transport = await self.exit_stack.enter_async_context(
-                        streamablehttp_client(url=url)
-                    )
-                    read, write, *_ = streamable_transport
+    async def _report_startup(self, attach_tasks: set, startup_time: float):
+        """所有 Server 接入完成（或失败）后，汇总报告各 Server 的连接耗时"""
+        await asyncio.gather(*attach_tasks, return_exceptions=True)
+        lines = []
+        for server_name in self.server_order:
+            duration = self.connect_durations.get(server_name)
+            if duration is not None:
+                status = f"{duration:.2f}s"
+            elif self._is_lazy(server_name):
+                status = "lazy (from snapshot)"
             else:
-                logger.debug(f"Connecting to {server_name} via Stdio")
-                server_params = StdioServerParameters(**server_config)
-                stdio_transport = await self.exit_stack.enter_async_context(
-                    stdio_client(server_params)
-                )
-                read, write = stdio_transport
-
-            # 2. 初始化 Session
-            session = await self.exit_stack.enter_async_context(
-                ClientSession(read, write)
-            )
-            await session.initialize()
+                status = "failed"
+            lines.append(f"  - {server_name}: {status}")
+        logger.info(
+            f"MCP startup finished in {time.perf_counter() - startup_time:.2f}s "
+            f"({len(self.connect_durations)}/{len(self.server_order)} servers connected)\n" + "\n".join(lines)
+        )
 
-            # 3. 注册所有能力
-            await self._register_capabilities(server_name, session)
-            
+    def _create_pool(self, server_name: str, server_config: dict) -> MCPServerPool:
+        """创建 Server 的副本池（此时不连接）及其并发限制、缓存策略"""
+        message_handler = self._make_message_handler(server_name)
+        pool = MCPServerPool(
+            server_name, server_config,
+            connection_factory=lambda: MCPServerConnection(server_name, server_config, message_handler=message_handler),
+            on_spawn=lambda session: self._refresh_capabilities(server_name, session),
+        )
+        self.servers[server_name] = pool
+        self.semaphores[server_name] = asyncio.Semaphore(server_config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY))
+        self.breakers[server_name] = CircuitBreaker(server_name)
+        cache_policy = ToolCachePolicy.from_config(server_config)
+        if cache_policy:
+            self.cache_policies[server_name] = cache_policy
+        self.resource_ttls[server_name] = server_config.get("resource_ttl", DEFAULT_RESOURCE_CACHE_TTL)
+        return pool
+
+    async def _attach_server(self, server_name: str) -> bool:
+        """连接到单个 MCP 服务器并注册（或校验快照中的）能力，返回是否成功"""
+        server_config = self.server_configs[server_name]
+        pool = self.servers[server_name]
+        timeout = server_config.get("timeout", DEFAULT_CONNECT_TIMEOUT)
+        start_time = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout):
+                session = await pool.start()
+                await self._refresh_capabilities(server_name, session)
+        except TimeoutError:
+            logger.error(f"Failed to connect to server '{server_name}': timed out after {timeout}s")
+            self._on_connect_failed(server_name)
+            return False
+        except asyncio.CancelledError:
+            await pool.stop()
+            raise
         except Exception as e:
             logger.error(f"Failed to connect to server '{server_name}': {e}")
+            self._on_connect_failed(server_name)
+            return False
+
+        duration = time.perf_counter() - start_time
+        self.connect_durations[server_name] = duration
+        logger.success(f"[{server_name}] Connected in {duration:.2f}s (handshake {pool.primary.connect_duration:.2f}s)")
+
+        if pool.lazy:
+            # 按需启动的 Server：保留能力列表，关闭进程直到首次使用
+            await pool.shutdown_idle()
+            return True
+
+        # 只在主副本上订阅资源更新（所有副本共享同一个通知处理函数）
+        await self._subscribe_resources(server_name, session)
+        if self._prefetch_on_attach:
+            await self.prefetch_resources(self._capabilities[server_name]["resources"])
+        return True
+
+    def _on_connect_failed(self, server_name: str):
+        """首次连接失败：熔断（隐藏快照中的工具）并在后台按退避策略重连"""
+        self.breakers[server_name].trip()
+        self._schedule_reconnect(server_name)
+
+    def _schedule_reconnect(self, server_name: str):
+        task = self._reconnect_tasks.get(server_name)
+        if task and not task.done():
+            return
+        task = asyncio.create_task(self._reconnect(server_name), name=f"reconnect-{server_name}")
+        self._reconnect_tasks[server_name] = task
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _reconnect(self, server_name: str):
+        """按指数退避重连，直到成功"""
+        attempt = 0
+        while server_name in self.servers:
+            delay = backoff_delay(attempt)
+            logger.info(f"[{server_name}] Reconnecting in {delay:.1f}s (attempt {attempt + 1})")
+            # 退避期间到达的请求可能已按需拉起副本，副本就绪后立即结束等待，由 pool.start() 直接返回其会话
+            if not self.servers[server_name].ready_connections:
+                await self.servers[server_name].wait_replica(delay)
+            pool = self.servers.get(server_name)
+            if pool is None:
+                return
+            timeout = self.server_configs[server_name].get("timeout", DEFAULT_CONNECT_TIMEOUT)
+            try:
+                async with asyncio.timeout(timeout):
+                    session = await pool.start()
+                    await self._refresh_capabilities(server_name, session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                attempt += 1
+                mcp_reconnects.inc(server=server_name, result="failure")
+                self.breakers[server_name].record_failure()
+                logger.warning(f"[{server_name}] Reconnect failed: {e or type(e).__name__}")
+                continue
+
+            self.breakers[server_name].record_success()
+            mcp_reconnects.inc(server=server_name, result="success")
+            self.connect_durations.setdefault(server_name, pool.primary.connect_duration or 0)
+            logger.success(f"[{server_name}] Reconnected after {attempt + 1} attempts")
+            if pool.lazy:
+                await pool.shutdown_idle()
+            else:
+                await self._on_primary_changed(server_name)
+            return
+
+    async def _on_primary_changed(self, server_name: str):
+        """主副本变化（重连或原主副本失效）：失效该 Server 的资源缓存（可能错过了更新通知）并重新订阅"""
+        self.resource_cache.invalidate_where(lambda uri: self.router.route_resource(uri) == server_name)
+        pool = self.servers.get(server_name)
+        if pool and pool.primary:
+            await self._subscribe_resources(server_name, pool.primary.session)
+
+    async def _health_check_loop(self):
+        """定期 ping 所有副本，移除失效副本；非按需模式的 Server 没有可用副本时自动重连"""
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            await asyncio.gather(
+                *(self._check_server(server_name) for server_name in list(self.servers)),
+                return_exceptions=True,
+            )
+
+    async def _check_server(self, server_name: str):
+        pool = self.servers.get(server_name)
+        reconnect_task = self._reconnect_tasks.get(server_name)
+        if pool is None or (reconnect_task and not reconnect_task.done()):
+            return
+        breaker = self.breakers[server_name]
+        primary = pool.primary
+
+        async def ping(connection: MCPServerConnection) -> bool:
+            try:
+                async with asyncio.timeout(HEALTH_CHECK_TIMEOUT):
+                    await connection.session.send_ping()
+                return True
+            except Exception as e:
+                logger.warning(f"[{server_name}] Health check failed: {e or type(e).__name__}")
+                await pool.discard(connection)
+                return False
+
+        connections = pool.ready_connections
+        results = await asyncio.gather(*(ping(connection) for connection in connections))
+        if any(results):
+            breaker.record_success()
+        elif results:
+            breaker.record_failure()
+
+        if not pool.replicas and not pool.lazy:
+            self._schedule_reconnect(server_name)
+        elif pool.primary is not primary and pool.primary is not None:
+            await self._on_primary_changed(server_name)
+
+    async def _watch_config(self):
+        """定期检查配置文件，修改后热加载"""
+        while True:
+            await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+            try:
+                mtime = os.stat(self.config_path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime == self._config_mtime:
+                continue
+            self._config_mtime = mtime
+            try:
+                await self.reload_config()
+            except Exception as e:
+                logger.error(f"Failed to reload config {self.config_path}, keeping current servers: {e}")
+
+    async def reload_config(self):
+        """
+        重新加载配置文件，只连接新增的 Server、断开被移除的 Server、重连配置变化的 Server，
+        其他 Server 的连接与缓存不受影响
+        """
+        async with self._reload_lock:
+            servers = self._load_config(self.config_path)
+            previous = self.server_configs
+            removed = [name for name in previous if name not in servers]
+            added = [name for name in servers if name not in previous]
+            changed = [
+                name for name in servers
+                if name in previous and config_fingerprint(servers[name]) != config_fingerprint(previous[name])
+            ]
+            if not (removed or added or changed) and list(servers) == self.server_order:
+                return
+            logger.info(f"Config changed, reloading servers: added={added}, removed={removed}, changed={changed}")
+
+            self.server_configs = servers
+            self.server_order = list(servers)
+            for server_name in removed:
+                self._detach_server(server_name)
+                self.snapshot.remove(server_name)
+            for server_name in changed + added:
+                # 配置变化的 Server 保留原有能力列表，直到新连接刷新能力，期间的请求会等待新副本就绪
+                self._retire_pool(server_name)
+                self._create_pool(server_name, servers[server_name])
+                task = asyncio.create_task(self._attach_server(server_name), name=f"attach-{server_name}")
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+            self._rebuild_registry()
+            if removed:
+                await asyncio.to_thread(self.snapshot.save)
 
-    async def _register_capabilities(self, server_name: str, session: ClientSession):
-        """一次性注册 Tools, Prompts, Resources"""
+    def _detach_server(self, server_name: str):
+        """断开 Server 并从注册表中移除其能力"""
+        self._retire_pool(server_name)
+        for state in (self.semaphores, self.breakers, self.cache_policies, self.resource_ttls, self.connect_durations):
+            state.pop(server_name, None)
+        if self._capabilities.pop(server_name, None) is not None:
+            self._rebuild_registry()
+
+    def _retire_pool(self, server_name: str):
+        """将 Server 的副本池移出服务（不再接收新请求），等待进行中的请求完成后关闭，并清理相关缓存"""
+        for tasks in (self._reconnect_tasks, self._refresh_tasks):
+            task = tasks.pop(server_name, None)
+            if task:
+                task.cancel()
+        tool_prefix = f"{server_name}{SPLIT_SERVER_TOOL_NAME_WITH}"
+        self.tool_cache.invalidate_where(lambda key: key[0].startswith(tool_prefix))
+        self.resource_cache.invalidate_where(lambda uri: self.router.route_resource(uri) == server_name)
+        pool = self.servers.pop(server_name, None)
+        if pool is None:
+            return
+        task = asyncio.create_task(self._drain_pool(pool), name=f"drain-{server_name}")
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _drain_pool(self, pool: MCPServerPool):
+        try:
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while pool.outstanding and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        finally:
+            await pool.stop()
+            logger.info(f"[{pool.server_name}] Retired")
+
+    def _schedule_refresh(self, server_name: str):
+        """
+        收到 list_changed 通知后在后台刷新 Server 的能力列表
+        （不能在消息处理回调中直接请求 Server，否则会阻塞该会话的消息接收）
+        """
+        task = self._refresh_tasks.get(server_name)
+        if task and not task.done():
+            self._refresh_pending.add(server_name)
+            return
+        task = asyncio.create_task(self._refresh_server(server_name), name=f"refresh-{server_name}")
+        self._refresh_tasks[server_name] = task
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _refresh_server(self, server_name: str):
+        """重新拉取单个 Server 的能力列表，只更新该 Server 在注册表中的部分"""
+        while True:
+            self._refresh_pending.discard(server_name)
+            pool = self.servers.get(server_name)
+            if pool is None or pool.primary is None:
+                return
+            previous = self._capabilities.get(server_name, {})
+            try:
+                async with pool.session() as session:
+                    await self._refresh_capabilities(server_name, session)
+            except Exception as e:
+                logger.warning(f"[{server_name}] Failed to refresh capabilities: {e}")
+                return
+
+            # 资源列表变化：失效被移除资源的缓存，订阅新增资源
+            previous_resources = set(previous.get("resources", []))
+            current_resources = set(self._capabilities[server_name]["resources"])
+            for uri in previous_resources - current_resources:
+                self.subscribed_resources.discard(uri)
+                self._invalidate_resource(uri)
+            new_resources = [uri for uri in self._capabilities[server_name]["resources"] if uri not in previous_resources]
+            if new_resources and pool.primary and not pool.lazy:
+                await self._subscribe_resources(server_name, pool.primary.session, new_resources)
+
+            if server_name not in self._refresh_pending:
+                return
+
+    async def _refresh_capabilities(self, server_name: str, session: ClientSession):
+        """从 Server 拉取最新能力列表，更新注册表与快照"""
+        capabilities = await self._list_capabilities(server_name, session)
+        if server_name not in self.server_configs:
+            # 拉取期间 Server 已从配置中移除
+            return
+        self._capabilities[server_name] = capabilities
+        # 后台接入的 Server 与其他 Server 并发注册，统一按配置顺序重建注册表
+        self._rebuild_registry()
+        if self.snapshot.put(server_name, self.server_configs[server_name], capabilities):
+            logger.info(f"[{server_name}] Capabilities changed, snapshot updated")
+            await asyncio.to_thread(self.snapshot.save)
+
+    def _make_message_handler(self, server_name: str):
+        """创建处理 Server 推送消息的回调"""
+        async def handle_message(message):
+            if isinstance(message, Exception):
+                logger.warning(f"[{server_name}] Session error: {message}")
+                return
+            if not isinstance(message, ServerNotification):
+                return
+            notification = message.root
+            if isinstance(notification, ResourceUpdatedNotification):
+                uri = str(notification.params.uri)
+                self._invalidate_resource(uri)
+                logger.debug(f"[{server_name}] Resource updated, cache invalidated: {uri}")
+            elif isinstance(notification, (ToolListChangedNotification, PromptListChangedNotification, ResourceListChangedNotification)):
+                logger.info(f"[{server_name}] Received {notification.method}, refreshing capabilities")
+                self._schedule_refresh(server_name)
+        return handle_message
+
+    async def _subscribe_resources(self, server_name: str, session: ClientSession, uris: Optional[List[str]] = None):
+        """若 Server 支持资源订阅，则订阅其资源（默认为全部资源）的更新通知"""
+        capabilities = session.get_server_capabilities()
+        if not capabilities or not capabilities.resources or not capabilities.resources.subscribe:
+            return
+        subscribed = 0
+        for uri in self._capabilities[server_name]["resources"] if uris is None else uris:
+            try:
+                await session.subscribe_resource(uri)
+                self.subscribed_resources.add(uri)
+                subscribed += 1
+            except Exception as e:
+                logger.warning(f"[{server_name}] Failed to subscribe resource {uri}: {e}")
+        logger.debug(f"[{server_name}] Subscribed to {subscribed} resources")
+
+    def _invalidate_resource(self, uri: str):
+        self._resource_versions[uri] = self._resource_versions.get(uri, 0) + 1
+        self.resource_cache.invalidate(uri)
+
+    async def _list_capabilities(self, server_name: str, session: ClientSession) -> Dict[str, list]:
+        """一次性拉取 Tools, Prompts, Resources（结果只包含 JSON 基本类型，可直接写入快照）"""
+        tool_definitions, available_prompts, available_resources, resource_templates = [], [], [], []
         
         # --- Tools ---
         try:
             tools_resp = await session.list_tools()
             for tool in tools_resp.tools:
                 full_name = f"{server_name}{SPLIT_SERVER_TOOL_NAME_WITH}{tool.name}"
-                self.sessions[full_name] = session # 注册 Tool 路由
                 
                 input_schema = tool.inputSchema if tool.inputSchema else {}
-                self.tool_definitions.append({
+                tool_definitions.append({
                     "type": "function",
                     "function": {
                         "name": full_name,
@@ -130,14 +577,12 @@ class MCPClientManager:
             prompts_resp = await session.list_prompts()
             if prompts_resp and prompts_resp.prompts:
                 for prompt in prompts_resp.prompts:
-                    self.available_prompts.append({
+                    available_prompts.append({
                         "name": prompt.name,
                         "description": prompt.description,
-                        "arguments": prompt.arguments,
+                        "arguments": [argument.model_dump(exclude_none=True) for argument in prompt.arguments or []],
                         "server": server_name
                     })
-                    # 将 Prompt 名字也注册到 Session，方便查找
-                    self.sessions[f"prompt:{prompt.name}"] = session
         except Exception:
             pass # 某些 Server 可能不支持 Prompts
 
@@ -147,56 +592,203 @@ class MCPClientManager:
             if res_resp and res_resp.resources:
                 for resource in res_resp.resources:
                     uri_str = str(resource.uri)
-                    self.available_resources.append(uri_str)
-                    # 将 URI 注册到 Session
-                    self.sessions[uri_str] = session
+                    available_resources.append(uri_str)
         except Exception:
             pass # 某些 Server 可能不支持 Resources
 
+        # --- Resource Templates (如 papers://{topic}) ---
+        try:
+            templates_resp = await session.list_resource_templates()
+            if templates_resp and templates_resp.resourceTemplates:
+                resource_templates = [template.uriTemplate for template in templates_resp.resourceTemplates]
+        except Exception:
+            pass # 某些 Server 可能不支持 Resource Templates
+
+        return {
+            "tools": tool_definitions,
+            "prompts": available_prompts,
+            "resources": available_resources,
+            "resource_templates": resource_templates,
+        }
+
+    def _rebuild_registry(self):
+        """按配置文件中的 Server 顺序重建功能注册表与路由表"""
+        tool_definitions, available_prompts, available_resources = [], [], []
+        router = CapabilityRouter()
+        for server_name in self.server_order:
+            capabilities = self._capabilities.get(server_name)
+            if not capabilities:
+                continue
+            tool_definitions.extend(capabilities["tools"])
+            available_prompts.extend(capabilities["prompts"])
+            available_resources.extend(capabilities["resources"])
+            tool_prefix = f"{server_name}{SPLIT_SERVER_TOOL_NAME_WITH}"
+            router.add_server(
+                server_name,
+                tools={
+                    definition["function"]["name"]: ToolRoute(server_name, definition["function"]["name"][len(tool_prefix):])
+                    for definition in capabilities["tools"]
+                },
+                prompts=[prompt["name"] for prompt in capabilities["prompts"]],
+                resources=capabilities["resources"],
+                resource_templates=capabilities["resource_templates"],
+            )
+        self.registry = CapabilityRegistry(
+            self.registry.version + 1, router, tool_definitions, available_prompts, available_resources
+        )
+        logger.debug(f"Capability registry v{self.registry.version}: {len(tool_definitions)} tools, {len(available_prompts)} prompts, {len(available_resources)} resources")
+
+    def _is_lazy(self, server_name: Optional[str]) -> bool:
+        pool = self.servers.get(server_name) if server_name else None
+        return pool is not None and pool.lazy
+
+    def _is_prefetchable(self, server_name: Optional[str]) -> bool:
+        pool = self.servers.get(server_name) if server_name else None
+        return pool is not None and not pool.lazy and bool(pool.ready_connections)
+
+    async def _request(self, server_name: str, operation: Callable[[ClientSession], Awaitable[T]]) -> T:
+        """
+        从 Server 的副本池中取出一个会话执行请求（带超时），并记录熔断器状态
+        Server 处于熔断状态时直接失败，不再等待
+        """
+        pool = self.servers.get(server_name)
+        if pool is None:
+            raise ConnectionError(f"Server '{server_name}' is not connected.")
+        breaker = self.breakers[server_name]
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Server '{server_name}' is temporarily unavailable (circuit open).")
+
+        timeout = self.server_configs.get(server_name, {}).get("request_timeout", DEFAULT_REQUEST_TIMEOUT)
+        try:
+            async with asyncio.timeout(timeout):
+                async with pool.session() as session:
+                    result = await operation(session)
+        except McpError:
+            # Server 正常返回的 JSON-RPC 错误（如参数错误），不计入熔断
+            breaker.record_success()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
     # ================= 对外接口 =================
 
     def get_tools_definitions(self) -> List[Dict]:
-        """获取 OpenAI 格式的工具定义"""
-        return self.tool_definitions
+        """获取 OpenAI 格式的工具定义（隐藏处于熔断状态的 Server 的工具）"""
+        registry = self.registry
+        open_servers = {server_name for server_name, breaker in self.breakers.items() if breaker.is_open}
+        if not open_servers:
+            return registry.tool_definitions
+        return [
+            definition for definition in registry.tool_definitions
+            if registry.router.route_tool(definition["function"]["name"]).server_name not in open_servers
+        ]
+
+    def get_pinned_tools(self) -> List[str]:
+        """
+        获取固定提供给模型的工具（不参与相关度筛选），在 server_config.json 中通过 "pinned_tools" 声明，
+        如 ["read_file"]（不含 Server 前缀），"*" 表示该 Server 的全部工具
+        """
+        pinned = []
+        for full_name, (server_name, tool_name) in self.router.tools.items():
+            pinned_tools = self.server_configs.get(server_name, {}).get("pinned_tools", [])
+            if "*" in pinned_tools or tool_name in pinned_tools:
+                pinned.append(full_name)
+        return pinned
+
+    def is_read_only_tool(self, tool_name: str) -> bool:
+        """
+        工具是否只读（无副作用）：即在 server_config.json 的 "cache" 中声明为可缓存的工具，
+        只读工具可以在模型输出结束前提前执行，重复或多余的执行不会产生副作用
+        """
+        route = self.router.route_tool(tool_name)
+        if route is None:
+            return False
+        cache_policy = self.cache_policies.get(route.server_name)
+        return cache_policy is not None and cache_policy.is_cacheable(route.tool_name)
 
     def get_available_prompts(self) -> List[Dict]:
         """获取所有可用 Prompt 列表"""
         return self.available_prompts
 
-    async def call_tool(self, tool_name: str, arguments: dict) -> str:
-        """执行工具"""
-        if tool_name not in self.sessions:
+    async def call_tool(self, tool_name: str, arguments: dict, timeout: Optional[float] = None) -> str:
+        """
+        执行工具（可缓存的工具优先读取缓存，相同的进行中调用共享一次请求）
+        timeout 为调用方的时限（如单轮对话的剩余预算），超时后取消调用；共享的请求会继续为其他调用方执行
+        """
+        route = self.router.route_tool(tool_name)
+        if route is None:
             raise ValueError(f"Tool {tool_name} not found.")
+        server_name, real_tool_name = route
 
-        session = self.sessions[tool_name]
-        real_tool_name = tool_name.split(SPLIT_SERVER_TOOL_NAME_WITH, 1)[1] if SPLIT_SERVER_TOOL_NAME_WITH in tool_name else tool_name
+        status = "ok"
+        with tracer.span("mcp.tool", **{"mcp.server": server_name, "mcp.tool": real_tool_name}) as span:
+            try:
+                async with asyncio.timeout(timeout):
+                    cache_policy = self.cache_policies.get(server_name)
+                    if not cache_policy or not cache_policy.is_cacheable(real_tool_name):
+                        content, is_error = await self._execute_tool(server_name, real_tool_name, arguments)
+                        status = "tool_error" if is_error else status
+                        return content
 
-        try:
+                    cache_key = make_cache_key(tool_name, arguments)
+                    cached = self.tool_cache.get(cache_key)
+                    if cached is not None:
+                        logger.info(f"Tool cache hit: {tool_name} args: {arguments}")
+                        status = "cache_hit"
+                        return cached
+
+                    async def fetch() -> str:
+                        content, is_error = await self._execute_tool(server_name, real_tool_name, arguments)
+                        if not is_error:
+                            self.tool_cache.set(cache_key, content, ttl=cache_policy.ttl)
+                        return content
+
+                    return await self._tool_flights.do(cache_key, fetch)
+            except TimeoutError:
+                status = "timeout"
+                span.set_error("timeout")
+                logger.error(f"Tool execution timed out: {tool_name}")
+                return f"Error: Tool {tool_name} timed out."
+            except Exception as e:
+                status = "error"
+                span.set_error(f"{type(e).__name__}: {e}")
+                logger.error(f"Tool execution failed: {e}")
+                return f"Error: {str(e)}"
+            finally:
+                span.set_attribute("mcp.status", status)
+                tool_duration.observe(span.duration, server=server_name, status=status)
+
+    async def _execute_tool(self, server_name: str, real_tool_name: str, arguments: dict) -> Tuple[str, bool]:
+        """向 Server 发起工具调用，返回 (文本内容, 是否为错误结果)"""
+        semaphore = self.semaphores.setdefault(server_name, asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY))
+        if semaphore.locked():
+            logger.debug(f"[{server_name}] Concurrency limit reached, waiting for a free slot...")
+        async with semaphore:
             logger.info(f"Executing tool: {real_tool_name} args: {arguments}")
-            result = await session.call_tool(name=real_tool_name, arguments=arguments)
-            
-            content = []
-            if result.content:
-                for item in result.content:
-                    if hasattr(item, 'text'):
-                        content.append(item.text)
-                    else:
-                        content.append(str(item))
-            return "\n".join(content)
-        except Exception as e:
-            logger.error(f"Tool execution failed: {e}")
-            return f"Error: {str(e)}"
+            result = await self._request(server_name, lambda session: session.call_tool(name=real_tool_name, arguments=arguments))
+
+        content = []
+        if result.content:
+            for item in result.content:
+                if hasattr(item, 'text'):
+                    content.append(item.text)
+                else:
+                    content.append(str(item))
+        return "\n".join(content), bool(result.isError)
 
     async def get_prompt(self, prompt_name: str, arguments: dict) -> str:
         """执行/获取 Prompt 模板内容"""
-        # 查找对应的 session
-        session = self.sessions.get(f"prompt:{prompt_name}")
-        if not session:
+        # 查找对应的 Server
+        server_name = self.router.route_prompt(prompt_name)
+        if not server_name:
             return f"Prompt '{prompt_name}' not found."
 
         try:
             logger.info(f"Fetching prompt: {prompt_name}")
-            result = await session.get_prompt(name=prompt_name, arguments=arguments)
+            result = await self._request(server_name, lambda session: session.get_prompt(name=prompt_name, arguments=arguments))
             if result and result.messages:
                 # 简单处理：将 Prompt 的所有消息内容合并为一个字符串返回
                 # 实际场景中可能直接返回 messages 列表给 LLM，这里为了通用性转为文本
@@ -208,30 +800,70 @@ class MCPClientManager:
 
     async def read_resource(self, uri: str) -> str:
         """读取资源内容"""
-        session = self.sessions.get(uri)
-        
-        # 模糊匹配 Session (例如 papers://folders 可能没有精确注册，但 papers:// 在)
-        if not session:
-            for known_key, sess in self.sessions.items():
-                if uri.startswith(known_key) or ("://" in known_key and uri.startswith(known_key.split("://")[0])):
-                    session = sess
-                    break
-        
-        if not session:
+        # 按 URI 前缀树路由（支持 URI 模板，如 papers://{topic}）
+        server_name = self.router.route_resource(uri)
+        if not server_name:
             return f"Resource not found: {uri}"
 
-        try:
+        cached = self.resource_cache.get(uri)
+        if cached is not None:
+            logger.info(f"Resource cache hit: {uri}")
+            resource_duration.observe(0, server=server_name, status="cache_hit")
+            return cached
+
+        async def fetch() -> str:
+            version = self._resource_versions.get(uri, 0)
             logger.info(f"Reading resource: {uri}")
-            result = await session.read_resource(uri=uri)
+            result = await self._request(server_name, lambda session: session.read_resource(uri=uri))
             if result and result.contents:
-                return result.contents[0].text
+                content = result.contents[0].text
+                # 读取期间收到了更新通知，则不写入缓存
+                if self._resource_versions.get(uri, 0) == version:
+                    ttl = SUBSCRIBED_RESOURCE_CACHE_TTL if uri in self.subscribed_resources else self.resource_ttls.get(server_name, DEFAULT_RESOURCE_CACHE_TTL)
+                    self.resource_cache.set(uri, content, ttl=ttl)
+                return content
             return "Empty resource."
-        except Exception as e:
-            logger.error(f"Failed to read resource: {e}")
-            return str(e)
+
+        with tracer.span("mcp.resource", **{"mcp.server": server_name, "mcp.uri": uri}) as span:
+            try:
+                content = await self._resource_flights.do(uri, fetch)
+                resource_duration.observe(span.duration, server=server_name, status="ok")
+                return content
+            except Exception as e:
+                span.set_error(f"{type(e).__name__}: {e}")
+                resource_duration.observe(span.duration, server=server_name, status="error")
+                logger.error(f"Failed to read resource: {e}")
+                return str(e)
+
+    async def prefetch_resources(self, uris: Optional[List[str]] = None):
+        """
+        并发预取资源内容到缓存（默认预取所有已注册的资源）
+        调用后，后台接入的 Server 也会在接入时自动预取
+        """
+        self._prefetch_on_attach = True
+        uris = self.available_resources if uris is None else uris
+        # 只预取已有就绪副本的 Server：快照中仍在连接的 Server 接入后再预取，不阻塞应用启动；
+        # 跳过按需启动的 Server，避免预取时把进程拉起来
+        uris = [uri for uri in uris if self._is_prefetchable(self.router.route_resource(uri))]
+        if not uris:
+            return
+        start_time = time.perf_counter()
+        await asyncio.gather(*(self.read_resource(uri) for uri in uris))
+        logger.info(f"Prefetched {len(uris)} resources in {time.perf_counter() - start_time:.2f}s")
 
     async def cleanup(self):
-        await self.exit_stack.aclose()
+        for task in list(self._background_tasks):
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await asyncio.gather(*(pool.stop() for pool in self.servers.values()), return_exceptions=True)
+        self.servers.clear()
+        self.registry = CapabilityRegistry(0, CapabilityRouter(), [], [], [])
+        self.tool_cache.clear()
+        self.resource_cache.clear()
+        self.subscribed_resources.clear()
+        self.breakers.clear()
+        self._reconnect_tasks.clear()
+        self._refresh_tasks.clear()
         logger.info("Connections closed.")
 
 # 全局单例
@@ -0,0 +1,110 @@
+"""
+File   : mcp_connection.py
+Desc   : 单个 MCP Server 连接的生命周期管理
+Date   : 2026/01/05
+Author : Tianyu Chen
+"""
+
+import time
+import asyncio
+from contextlib import AsyncExitStack
+from typing import Optional, Callable, Awaitable, Any
+from loguru import logger
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+
+# StdioServerParameters 支持的字段（server_config.json 中的其他字段为客户端自身的配置项）
+STDIO_PARAM_KEYS = ("command", "args", "env", "cwd", "encoding", "encoding_error_handler")
+
+
+class MCPServerConnection:
+    """
+    单个 MCP Server 的连接
+
+    传输层和 ClientSession 都基于 anyio 的 TaskGroup，必须在同一个 Task 中进入和退出，
+    因此每个连接由一个独立的后台 Task 持有：建立连接 -> 通知就绪 -> 等待停止信号 -> 关闭连接。
+    """
+
+    def __init__(self, server_name: str, server_config: dict, message_handler: Optional[Callable[[Any], Awaitable[None]]] = None):
+        self.server_name = server_name
+        self.server_config = server_config
+        # Server 主动推送的消息（如 notifications/resources/updated）的处理函数
+        self.message_handler = message_handler
+        self.session: Optional[ClientSession] = None
+        self.connect_duration: Optional[float] = None
+
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._error: Optional[BaseException] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.session is not None
+
+    async def start(self) -> ClientSession:
+        """启动连接 Task 并等待就绪，连接失败时抛出异常"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"mcp-{self.server_name}")
+        await self._ready.wait()
+        if self.session is None:
+            raise self._error or ConnectionError(f"Server '{self.server_name}' closed during startup")
+        return self.session
+
+    async def stop(self):
+        """关闭连接（在持有连接的 Task 中退出上下文）"""
+        if self._task is None:
+            return
+        if not self._ready.is_set():
+            # 仍在握手中，无法响应停止信号，直接取消
+            self._task.cancel()
+        self._stop.set()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def _run(self):
+        start_time = time.perf_counter()
+        try:
+            async with AsyncExitStack() as stack:
+                read, write = await self._open_transport(stack)
+                session = await stack.enter_async_context(ClientSession(read, write, message_handler=self.message_handler))
+                await session.initialize()
+
+                self.connect_duration = time.perf_counter() - start_time
+                self.session = session
+                self._ready.set()
+
+                await self._stop.wait()
+        except asyncio.CancelledError:
+            self._error = self._error or asyncio.CancelledError()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def _open_transport(self, stack: AsyncExitStack):
+        """建立传输层，支持 SSE, Streamable HTTP 和 Stdio"""
+        server_name, server_config = self.server_name, self.server_config
+        if 'url' in server_config:
+            url = server_config['url']
+            if 'sse' in url:
+                logger.debug(f"Connecting to {server_name} via SSE: {url}")
+                read, write = await stack.enter_async_context(sse_client(url=url))
+            elif 'mcp' in url:
+                logger.debug(f"Connecting to {server_name} via Streamable HTTP: {url}")
+                read, write, *_ = await stack.enter_async_context(streamablehttp_client(url=url))
+            else:
+                raise ValueError(f"Unsupported server url: {url}")
+        else:
+            logger.debug(f"Connecting to {server_name} via Stdio")
+            server_params = StdioServerParameters(
+                **{k: v for k, v in server_config.items() if k in STDIO_PARAM_KEYS}
+            )
+            read, write = await stack.enter_async_context(stdio_client(server_params))
+        return read, write
@@ -0,0 +1,86 @@
+"""
+File   : mcp_health.py
+Desc   : MCP Server 健康检查相关：熔断器与重连退避策略
+Date   : 2026/01/24
+Author : Tianyu Chen
+"""
+
+import time
+import random
+from enum import Enum
+from loguru import logger
+
+# 健康检查间隔（秒）
+HEALTH_CHECK_INTERVAL = 15
+# 单次 ping 的超时时间（秒）
+HEALTH_CHECK_TIMEOUT = 5
+# 连续失败多少次后熔断
+CIRCUIT_FAILURE_THRESHOLD = 3
+# 熔断后多久（秒）允许一次试探请求
+CIRCUIT_RECOVERY_TIMEOUT = 30
+# 重连退避：初始间隔与最大间隔（秒）
+RECONNECT_BACKOFF_BASE = 1
+RECONNECT_BACKOFF_MAX = 60
+
+
+class CircuitOpenError(ConnectionError):
+    """Server 处于熔断状态，请求被快速拒绝"""
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"        # 正常
+    OPEN = "open"            # 熔断：快速失败，并从工具列表中隐藏
+    HALF_OPEN = "half_open"  # 试探：允许一个请求通过，成功则恢复
+
+
+class CircuitBreaker:
+    """
+    单个 Server 的熔断器
+    连续失败达到阈值后熔断；熔断一段时间后放行一个试探请求，成功则恢复，失败则继续熔断
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, recovery_timeout: float = CIRCUIT_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        """熔断中且尚未到试探时间；到期后视为可用，以便工具重新出现并触发一次试探请求（空闲的懒加载 Server 只能靠请求恢复）"""
+        return self.state == CircuitState.OPEN and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def allow_request(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self.state = CircuitState.HALF_OPEN
+            logger.info(f"[{self.name}] Circuit half-open, allowing a trial request")
+            return True
+        # 半开状态下只放行一个试探请求
+        return False
+
+    def record_success(self):
+        if self.state != CircuitState.CLOSED:
+            logger.success(f"[{self.name}] Circuit closed, server recovered")
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        """立即熔断"""
+        if self.state != CircuitState.OPEN:
+            logger.warning(f"[{self.name}] Circuit opened after {self.failures} failures")
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+
+
+def backoff_delay(attempt: int, base: float = RECONNECT_BACKOFF_BASE, max_delay: float = RECONNECT_BACKOFF_MAX) -> float:
+    """指数退避 + 抖动（full jitter），避免多个 Worker 同时重连"""
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
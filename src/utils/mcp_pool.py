@@ -0,0 +1,226 @@
+"""
+File   : mcp_pool.py
+Desc   : MCP Server 会话副本池（最少未完成请求负载均衡 + 排队扩容 + 空闲缩容 + 按需启动）
+Date   : 2026/01/15
+Author : Tianyu Chen
+"""
+
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+from loguru import logger
+
+from mcp import ClientSession
+
+from src.utils.mcp_connection import MCPServerConnection
+
+# 默认最少 / 最多副本数，可在 server_config.json 的 "pool" 中通过 "min_replicas" / "max_replicas" 覆盖
+DEFAULT_MIN_REPLICAS = 1
+DEFAULT_MAX_REPLICAS = 1
+# 所有副本的未完成请求数都达到该值时扩容，可通过 "scale_up_at" 覆盖
+DEFAULT_SCALE_UP_AT = 1
+# 副本空闲多久（秒）后缩容，可通过 "idle_timeout" 覆盖
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class _Replica:
+    __slots__ = ("connection", "outstanding", "last_used")
+
+    def __init__(self, connection: MCPServerConnection):
+        self.connection = connection
+        self.outstanding = 0
+        self.last_used = time.monotonic()
+
+
+class MCPServerPool:
+    """
+    单个 MCP Server 的会话副本池
+
+    - 负载均衡：每次请求选择未完成请求数最少的副本
+    - 扩容：所有副本都在处理请求（排队）且未达到上限时，后台启动新副本
+    - 缩容：超过最少副本数的副本空闲超过 idle_timeout 后关闭
+    - 按需启动（"lazy": true）：最少副本数为 0，首次使用时启动，所有副本空闲超时后全部关闭
+    首个副本为主副本（用于注册能力和订阅资源），非按需模式下不参与缩容。
+    Streamable HTTP / SSE Server 共享一个会话即可并发，默认只有一个副本；
+    Stdio Server 的单个子进程会串行处理所有调用，可按需配置更多副本。
+    """
+
+    def __init__(
+        self,
+        server_name: str,
+        server_config: dict,
+        connection_factory: Callable[[], MCPServerConnection],
+        on_spawn: Optional[Callable[[ClientSession], Awaitable[None]]] = None,
+    ):
+        self.server_name = server_name
+        pool_config = server_config.get("pool", {})
+        self.lazy = bool(server_config.get("lazy", False))
+        self.min_replicas = 0 if self.lazy else max(1, pool_config.get("min_replicas", DEFAULT_MIN_REPLICAS))
+        self.max_replicas = max(self.min_replicas, 1, pool_config.get("max_replicas", DEFAULT_MAX_REPLICAS))
+        self.scale_up_at = pool_config.get("scale_up_at", DEFAULT_SCALE_UP_AT)
+        self.idle_timeout = pool_config.get("idle_timeout", DEFAULT_IDLE_TIMEOUT)
+        # 按需启动时等待副本就绪的超时时间
+        self.connect_timeout = server_config.get("timeout")
+
+        self._connection_factory = connection_factory
+        # 按需模式下，从 0 个副本重新拉起 Server 时的回调（如重新校验能力列表）
+        self._on_spawn = on_spawn
+        self.replicas: List[_Replica] = []
+        self._starting: List[asyncio.Task] = []
+        self._reaper_task: Optional[asyncio.Task] = None
+        self._callback_tasks: set = set()
+        # 有副本启动完成时置位（供重连退避等待）
+        self._replica_started = asyncio.Event()
+        self._closed = False
+
+    @property
+    def primary(self) -> Optional[MCPServerConnection]:
+        return self.replicas[0].connection if self.replicas else None
+
+    @property
+    def ready_connections(self) -> List[MCPServerConnection]:
+        return [replica.connection for replica in self.replicas if replica.connection.is_ready]
+
+    @property
+    def outstanding(self) -> int:
+        return sum(replica.outstanding for replica in self.replicas)
+
+    async def start(self) -> ClientSession:
+        """
+        启动主副本（以及最少副本数要求的其他副本），返回主副本会话，连接失败时抛出异常
+        启动期间到达的请求会等待主副本就绪，不会重复拉起进程
+        已有就绪副本（如重连退避期间由请求按需拉起）时直接返回其会话；已达副本上限但有副本正在启动时等待其就绪
+        """
+        self._start_reaper()
+        # 移除已断开的副本（不占用副本上限）
+        self.replicas = [replica for replica in self.replicas if replica.connection.is_ready]
+        ready = self.ready_connections
+        if ready:
+            return ready[0].session
+        primary = self._scale_up()
+        if primary is None:
+            if not self._starting:
+                raise ConnectionError(f"Server '{self.server_name}' cannot start more replicas (max_replicas={self.max_replicas}).")
+            # 进行中的启动任务可能还有其他请求在等待，当前调用超时取消时不应连带取消它
+            primary = asyncio.shield(self._starting[0])
+        connection = await primary
+        for _ in range(self.min_replicas - 1):
+            self._scale_up()
+        return connection.session
+
+    async def wait_replica(self, timeout: float) -> bool:
+        """等待任一副本启动完成（最多 timeout 秒），超时返回 False"""
+        self._replica_started.clear()
+        try:
+            async with asyncio.timeout(timeout):
+                await self._replica_started.wait()
+            return True
+        except TimeoutError:
+            return False
+
+    def _start_reaper(self):
+        if self._reaper_task is None and self.max_replicas > self.min_replicas:
+            self._reaper_task = asyncio.create_task(self._reap_idle_replicas(), name=f"pool-reaper-{self.server_name}")
+
+    async def stop(self):
+        self._closed = True
+        if self._reaper_task:
+            self._reaper_task.cancel()
+        for task in self._starting:
+            task.cancel()
+        await asyncio.gather(*self._starting, return_exceptions=True)
+        await asyncio.gather(*(replica.connection.stop() for replica in self.replicas), return_exceptions=True)
+        self.replicas.clear()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[ClientSession]:
+        """从池中取出一个会话（未完成请求数最少的副本）"""
+        replica = await self._acquire()
+        replica.outstanding += 1
+        try:
+            yield replica.connection.session
+        finally:
+            replica.outstanding -= 1
+            replica.last_used = time.monotonic()
+
+    async def _acquire(self) -> _Replica:
+        if self._closed:
+            raise ConnectionError(f"Server '{self.server_name}' has been shut down.")
+        # 移除已断开的副本
+        self.replicas = [replica for replica in self.replicas if replica.connection.is_ready]
+
+        if self.replicas:
+            replica = min(self.replicas, key=lambda r: r.outstanding)
+            if replica.outstanding >= self.scale_up_at:
+                self._scale_up()
+            return replica
+
+        # 没有可用副本（按需模式或副本已断开）：启动一个新副本并等待就绪
+        if not self._starting:
+            logger.info(f"[{self.server_name}] Spawning replica on demand...")
+            self._start_reaper()
+            self._scale_up(spawn=True)
+        await asyncio.wait(list(self._starting), timeout=self.connect_timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not self.replicas:
+            raise ConnectionError(f"Server '{self.server_name}' has no available replicas.")
+        return self.replicas[0]
+
+    def _scale_up(self, spawn: bool = False) -> Optional[asyncio.Task]:
+        """后台启动新副本（不阻塞当前请求）"""
+        if len(self.replicas) + len(self._starting) >= self.max_replicas:
+            return None
+        task = asyncio.create_task(self._start_replica(spawn), name=f"pool-scale-up-{self.server_name}")
+        self._starting.append(task)
+        task.add_done_callback(self._on_replica_started)
+        return task
+
+    def _on_replica_started(self, task: asyncio.Task):
+        self._starting.remove(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"[{self.server_name}] Failed to start replica: {task.exception()}")
+
+    async def _start_replica(self, spawn: bool = False) -> MCPServerConnection:
+        connection = self._connection_factory()
+        start_time = time.perf_counter()
+        try:
+            session = await connection.start()
+        except BaseException:
+            await connection.stop()
+            raise
+        self.replicas.append(_Replica(connection))
+        self._replica_started.set()
+        logger.info(f"[{self.server_name}] Scaled up to {len(self.replicas)} replicas ({time.perf_counter() - start_time:.2f}s)")
+        if spawn and self._on_spawn:
+            callback_task = asyncio.create_task(self._on_spawn(session))
+            self._callback_tasks.add(callback_task)
+            callback_task.add_done_callback(self._callback_tasks.discard)
+        return connection
+
+    async def _reap_idle_replicas(self):
+        """定期关闭空闲超时的副本"""
+        interval = max(1.0, min(self.idle_timeout / 2, 30))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            candidates = self.replicas if self.lazy else self.replicas[1:]
+            idle = [
+                replica for replica in candidates
+                if replica.outstanding == 0 and now - replica.last_used > self.idle_timeout
+            ]
+            await self._close_replicas(idle[:max(0, len(self.replicas) - self.min_replicas)])
+
+    async def discard(self, connection: MCPServerConnection):
+        """移除并关闭一个失效的副本（如健康检查失败）"""
+        await self._close_replicas([replica for replica in self.replicas if replica.connection is connection])
+
+    async def shutdown_idle(self):
+        """立即关闭所有空闲副本（按需模式下注册完能力后调用，直到首次使用前不占用进程）"""
+        await self._close_replicas([replica for replica in self.replicas if replica.outstanding == 0])
+
+    async def _close_replicas(self, replicas: List[_Replica]):
+        if not replicas:
+            return
+        self.replicas = [replica for replica in self.replicas if replica not in replicas]
+        await asyncio.gather(*(replica.connection.stop() for replica in replicas), return_exceptions=True)
+        logger.info(f"[{self.server_name}] Scaled down to {len(self.replicas)} replicas")
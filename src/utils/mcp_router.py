@@ -0,0 +1,149 @@
+"""
+File   : mcp_router.py
+Desc   : MCP 能力路由表（Tools, Prompts, Resources）
+Date   : 2026/01/12
+Author : Tianyu Chen
+"""
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+from loguru import logger
+
+
+class ToolRoute(NamedTuple):
+    """工具路由：对外暴露的工具名 -> (Server 名称, Server 内的工具名)"""
+    server_name: str
+    tool_name: str
+
+
+def split_uri(uri: str) -> List[str]:
+    """
+    将 URI 切分为路由段：scheme 作为第一段，其余按 "/" 切分
+    例如 papers://ai/2024 -> ["papers://", "ai", "2024"]
+    """
+    if "://" in uri:
+        scheme, rest = uri.split("://", 1)
+        return [f"{scheme}://"] + rest.split("/")
+    return uri.split("/")
+
+
+class _UriNode:
+    __slots__ = ("children", "wildcard", "tail_server", "server", "servers")
+
+    def __init__(self):
+        self.children: Dict[str, "_UriNode"] = {}
+        # 单段模板变量，如 {topic}
+        self.wildcard: Optional["_UriNode"] = None
+        # 多段模板变量（匹配剩余所有段），如 {+path} / {path*}
+        self.tail_server: Optional[str] = None
+        # 精确匹配到此节点的 Server
+        self.server: Optional[str] = None
+        # 子树中注册过的所有 Server（用于无歧义的前缀路由）
+        self.servers: Set[str] = set()
+
+
+def _is_tail_variable(segment: str) -> bool:
+    return segment.startswith(("{+", "{/")) or segment.endswith("*}")
+
+
+class UriTrie:
+    """
+    资源 URI 前缀树，支持精确 URI 与 URI 模板（RFC 6570 的简单变量）
+    查找开销与 URI 的段数成正比，与已注册资源的数量无关
+
+    匹配优先级：精确段 > 单段模板变量 > 多段模板变量 > 最长的无歧义前缀
+    （前缀对应的子树只属于一个 Server 时才路由，多个 Server 共享同一前缀时视为歧义）
+    """
+
+    def __init__(self):
+        self._root = _UriNode()
+
+    def insert(self, uri_or_template: str, server_name: str):
+        node = self._root
+        node.servers.add(server_name)
+        for segment in split_uri(uri_or_template):
+            if "{" in segment:
+                if _is_tail_variable(segment):
+                    node.tail_server = node.tail_server or server_name
+                    return
+                node.wildcard = node.wildcard or _UriNode()
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(segment, _UriNode())
+            node.servers.add(server_name)
+        if node.server and node.server != server_name:
+            logger.warning(f"Resource '{uri_or_template}' is provided by both '{node.server}' and '{server_name}', keeping '{node.server}'")
+            return
+        node.server = server_name
+
+    def match(self, uri: str) -> Optional[str]:
+        node = self._root
+        prefix_server: Optional[str] = None
+        for segment in split_uri(uri):
+            if node.tail_server:
+                prefix_server = node.tail_server
+            elif len(node.servers) == 1:
+                prefix_server = next(iter(node.servers))
+
+            next_node = node.children.get(segment) or node.wildcard
+            if next_node is None:
+                return node.tail_server or prefix_server
+            node = next_node
+
+        if node.server:
+            return node.server
+        if len(node.servers) == 1:
+            return next(iter(node.servers))
+        return prefix_server
+
+
+class CapabilityRouter:
+    """
+    能力路由表：Tools、Prompts、Resources 分别建立索引，只记录对应的 Server 名称
+    （Server 重连后会话对象会变化，因此路由表不直接持有会话）
+    """
+
+    def __init__(self):
+        self.tools: Dict[str, ToolRoute] = {}
+        self.prompts: Dict[str, str] = {}
+        self.resources = UriTrie()
+
+    def add_server(
+        self,
+        server_name: str,
+        tools: Dict[str, ToolRoute],
+        prompts: Iterable[str] = (),
+        resources: Iterable[str] = (),
+        resource_templates: Iterable[str] = (),
+    ):
+        """注册单个 Server 的能力（先注册的 Server 优先，重名时保留先注册者）"""
+        for full_name, route in tools.items():
+            self.tools.setdefault(full_name, route)
+        for prompt_name in prompts:
+            owner = self.prompts.setdefault(prompt_name, server_name)
+            if owner != server_name:
+                logger.warning(f"Prompt '{prompt_name}' is provided by both '{owner}' and '{server_name}', keeping '{owner}'")
+        for uri in resources:
+            self.resources.insert(uri, server_name)
+        for template in resource_templates:
+            self.resources.insert(template, server_name)
+
+    def route_tool(self, tool_name: str) -> Optional[ToolRoute]:
+        return self.tools.get(tool_name)
+
+    def route_prompt(self, prompt_name: str) -> Optional[str]:
+        return self.prompts.get(prompt_name)
+
+    def route_resource(self, uri: str) -> Optional[str]:
+        return self.resources.match(uri)
+
+
+class CapabilityRegistry(NamedTuple):
+    """
+    某一版本的完整能力注册表
+    能力变化时整体构建新版本并替换（不修改旧版本），进行中的 ReAct 轮次始终看到一致的视图
+    """
+    version: int
+    router: CapabilityRouter
+    tool_definitions: List[Dict]    # OpenAI 格式
+    prompts: List[Dict]             # 简单描述格式
+    resources: List[str]            # URI 列表
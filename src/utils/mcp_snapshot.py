@@ -0,0 +1,79 @@
+"""
+File   : mcp_snapshot.py
+Desc   : MCP 能力列表快照（用于热启动）
+Date   : 2026/01/20
+Author : Tianyu Chen
+"""
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+from loguru import logger
+
+# 快照文件路径
+SNAPSHOT_PATH = ".cache/mcp_capabilities.json"
+
+
+def config_fingerprint(server_config: dict) -> str:
+    """Server 配置的指纹，配置变化后快照自动失效"""
+    canonical = json.dumps(server_config, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CapabilitySnapshot:
+    """
+    各 Server 能力列表（Tools, Prompts, Resources）的本地快照
+    启动时先用快照填充注册表，再在后台连接 Server 校验并刷新快照
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = Path(path)
+        # Server 名称 -> {"fingerprint", "saved_at", "capabilities"}
+        self._entries: Dict[str, dict] = {}
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self._entries = json.load(file)
+            logger.debug(f"Loaded capability snapshot from {self.path} ({len(self._entries)} servers)")
+        except Exception as e:
+            logger.warning(f"Failed to load capability snapshot {self.path}: {e}")
+            self._entries = {}
+
+    def get(self, server_name: str, server_config: dict) -> Optional[dict]:
+        """获取与当前配置匹配的能力列表，配置已变化或无快照时返回 None"""
+        entry = self._entries.get(server_name)
+        if not entry or entry.get("fingerprint") != config_fingerprint(server_config):
+            return None
+        return entry["capabilities"]
+
+    def put(self, server_name: str, server_config: dict, capabilities: dict) -> bool:
+        """更新单个 Server 的快照，返回能力列表是否发生变化"""
+        previous = self._entries.get(server_name)
+        fingerprint = config_fingerprint(server_config)
+        changed = not previous or previous.get("fingerprint") != fingerprint or previous.get("capabilities") != capabilities
+        self._entries[server_name] = {
+            "fingerprint": fingerprint,
+            "saved_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            "capabilities": capabilities,
+        }
+        return changed
+
+    def remove(self, server_name: str):
+        self._entries.pop(server_name, None)
+
+    def save(self):
+        """原子写入（先写临时文件再替换），避免多进程同时启动时读到半个文件"""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self._entries, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Failed to save capability snapshot {self.path}: {e}")
@@ -0,0 +1,151 @@
+"""
+File   : spill_store.py
+Desc   : 大体积工具结果的本地存储（历史记录中只保留预览 + 句柄，模型按需分页读取）
+Date   : 2026/02/03
+Author : Tianyu Chen
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import uuid
+from pathlib import Path
+from typing import Optional
+from loguru import logger
+
+# 存储目录
+SPILL_DIR = ".cache/spill"
+# 工具结果超过该长度（字符数）时写入存储，历史记录中只保留预览
+SPILL_THRESHOLD_CHARS = 4000
+# 预览长度（字符数）
+PREVIEW_CHARS = 1500
+# 分页读取的默认 / 最大长度（字符数）
+DEFAULT_PAGE_CHARS = 4000
+MAX_PAGE_CHARS = 16000
+# 存储文件的保留时间（秒），过期文件在写入时顺带清理
+SPILL_RETENTION = 24 * 3600
+# 清理间隔（秒）
+PRUNE_INTERVAL = 600
+
+# 句柄前缀
+HANDLE_PREFIX = "spill:"
+
+# 内置的分页读取工具（OpenAI 格式），与 MCP 工具一起提供给模型
+SPILL_TOOL_NAME = "read_tool_output"
+SPILL_TOOL_DEFINITION = {
+    "type": "function",
+    "function": {
+        "name": SPILL_TOOL_NAME,
+        "description": (
+            "Read part of a large tool output that was truncated in the conversation. "
+            "Use the handle shown in the truncated output, and page through it with offset and limit."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": f"Handle of the stored output, e.g. \"{HANDLE_PREFIX}1a2b3c4d5e6f7a8b\""},
+                "offset": {"type": "integer", "description": "Character offset to start reading from (default 0)"},
+                "limit": {"type": "integer", "description": f"Number of characters to read (default {DEFAULT_PAGE_CHARS}, max {MAX_PAGE_CHARS})"},
+            },
+            "required": ["handle"],
+        },
+    },
+}
+
+
+class SpillStore:
+    """
+    大体积工具结果的本地存储
+
+    工具结果按内容的 sha256 寻址写入磁盘（相同内容只存一份），历史记录中只保留预览和句柄，
+    后续每一轮请求不再重复发送完整内容；模型需要更多内容时通过 read_tool_output 分页读取。
+    """
+
+    def __init__(self, directory: str = SPILL_DIR, threshold: int = SPILL_THRESHOLD_CHARS, preview_chars: int = PREVIEW_CHARS):
+        self.directory = Path(directory)
+        self.threshold = threshold
+        self.preview_chars = preview_chars
+        self._last_prune = 0.0
+
+    async def spill(self, content: str) -> str:
+        """内容超过阈值时写入存储并返回 预览 + 句柄，否则原样返回"""
+        if len(content) <= self.threshold:
+            return content
+        try:
+            handle = await asyncio.to_thread(self._write, content)
+        except Exception as e:
+            logger.warning(f"Failed to spill tool output, keeping it inline: {e}")
+            return content
+        logger.info(f"Spilled tool output ({len(content)} chars) to {handle}")
+        return (
+            f"[Large output: {len(content)} chars, showing the first {self.preview_chars}]\n"
+            f"{content[:self.preview_chars]}\n"
+            f"...\n"
+            f"[Full output stored as \"{handle}\". Call {SPILL_TOOL_NAME} with this handle and "
+            f"offset={self.preview_chars} to read more.]"
+        )
+
+    async def read(self, handle: str, offset: int = 0, limit: Optional[int] = None) -> str:
+        """分页读取存储的内容"""
+        path = self._path(handle)
+        if path is None or not path.exists():
+            return f"Error: Unknown or expired handle: {handle}"
+        content = await asyncio.to_thread(path.read_text, encoding="utf-8")
+        offset = max(0, int(offset or 0))
+        limit = min(MAX_PAGE_CHARS, max(1, int(limit or DEFAULT_PAGE_CHARS)))
+        end = min(len(content), offset + limit)
+        page = f"[{handle}: chars {offset}-{end} of {len(content)}]\n{content[offset:end]}"
+        if end < len(content):
+            page += f"\n[More available, continue with offset={end}]"
+        return page
+
+    def stub(self, page: str) -> str:
+        """模型读过的分页内容只保留范围说明（首行），之后的请求不再重复发送"""
+        header, _, body = page.partition("\n")
+        if not body:
+            return page
+        return f"{header}\n[Page already read; call {SPILL_TOOL_NAME} again if it is needed]"
+
+    def _path(self, handle: str) -> Optional[Path]:
+        digest = handle.strip().removeprefix(HANDLE_PREFIX)
+        # 只接受十六进制摘要，防止路径穿越
+        if not digest or not all(c in "0123456789abcdef" for c in digest):
+            return None
+        return self.directory / f"{digest}.txt"
+
+    def _write(self, content: str) -> str:
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        path = self.directory / f"{digest}.txt"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            # 刷新修改时间，避免被清理
+            path.touch()
+        else:
+            # 临时文件名唯一：相同结果可能被多个线程 / Worker 同时写入
+            temp_path = path.with_suffix(f".{os.getpid()}.{uuid.uuid4().hex}.tmp")
+            temp_path.write_text(content, encoding="utf-8")
+            os.replace(temp_path, path)
+        self._prune()
+        return f"{HANDLE_PREFIX}{digest}"
+
+    def _prune(self):
+        """清理过期的存储文件"""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        removed = 0
+        for path in self.directory.glob("*.txt"):
+            try:
+                if now - path.stat().st_mtime > SPILL_RETENTION:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.debug(f"Pruned {removed} expired spilled outputs")
+
+
+# 全局单例
+spill_store = SpillStore()
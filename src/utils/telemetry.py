@@ -0,0 +1,371 @@
+"""
+File   : telemetry.py
+Desc   : 链路追踪与指标：对话 -> 轮次 -> 模型调用 / 工具调用 / 资源读取 的 Span 导出为 OTLP JSON 文件，指标以 Prometheus 文本格式暴露
+Date   : 2026/02/24
+Author : Tianyu Chen
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from loguru import logger
+
+# Span 导出文件（每行一个 OTLP/JSON ExportTraceServiceRequest，可由 OpenTelemetry Collector 的 otlpjsonfile 接收器读取）
+TRACE_FILE = ".cache/traces/spans.otlp.jsonl"
+# 缓冲的 Span 数达到该值，或距上次导出超过该时间（秒）时导出
+TRACE_EXPORT_BATCH = 64
+TRACE_EXPORT_INTERVAL = 5
+# 导出文件超过该大小（字节）时轮转为 .1
+TRACE_FILE_MAX_BYTES = 50 * 1024 * 1024
+SERVICE_NAME = "super-agent-app"
+
+# 直方图分桶
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Span 状态（OTLP StatusCode）
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """一次操作的时间区间与属性（对话、轮次、模型调用、工具调用等）"""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Optional[Dict] = None, start_ns: Optional[int] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes: Dict = dict(attributes or {})
+        self.events: List[Tuple[str, int, Dict]] = []
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+
+    @property
+    def duration(self) -> float:
+        """耗时（秒），未结束的 Span 返回到当前为止的耗时"""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def set_error(self, message: str):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def end(self, end_ns: Optional[int] = None):
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            if self.status == STATUS_UNSET:
+                self.status = STATUS_OK
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [
+                {"name": name, "timeUnixNano": str(timestamp), "attributes": _otlp_attributes(attributes)}
+                for name, timestamp, attributes in self.events
+            ],
+            "status": {"code": self.status, "message": self.status_message} if self.status_message else {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Tracer:
+    """
+    链路追踪
+
+    span() 上下文管理器创建当前上下文的子 Span（通过 contextvar 传递，asyncio.create_task 创建的任务继承父 Span）；
+    已结束的 Span 批量导出到 OTLP/JSON 文件，写文件在线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str = TRACE_FILE, batch_size: int = TRACE_EXPORT_BATCH, interval: float = TRACE_EXPORT_INTERVAL):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.interval = interval
+        self._buffer: List[Span] = []
+        self._last_export = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.set_error("cancelled")
+            raise
+        except Exception as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+            self._export(span)
+
+    def record_span(self, name: str, start_ns: int, end_ns: Optional[int] = None, error: Optional[str] = None, **attributes) -> Span:
+        """记录一个已结束的子 Span（没有子操作的操作，如一次模型调用，可在结束后一次性记录）"""
+        span = Span(name, _current_span.get(), attributes, start_ns=start_ns)
+        if error:
+            span.set_error(error)
+        span.end(end_ns)
+        self._export(span)
+        return span
+
+    def _export(self, span: Span):
+        self._buffer.append(span)
+        if len(self._buffer) < self.batch_size and time.monotonic() - self._last_export < self.interval:
+            return
+        spans, self._buffer = self._buffer, []
+        self._last_export = time.monotonic()
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write, spans)
+        except RuntimeError:
+            self._write(spans)
+
+    def flush(self):
+        """导出缓冲区中的所有 Span（应用关闭时调用）"""
+        spans, self._buffer = self._buffer, []
+        if spans:
+            self._write(spans)
+
+    def _write(self, spans: List[Span]):
+        request = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+        line = json.dumps(request, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if self.path.exists() and self.path.stat().st_size > TRACE_FILE_MAX_BYTES:
+                    os.replace(self.path, self.path.with_suffix(self.path.suffix + ".1"))
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(line)
+        except OSError as e:
+            logger.warning(f"[Telemetry] Failed to export {len(spans)} spans: {e}")
+
+
+# ==================== 指标（Prometheus 文本格式） ====================
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f"{key}=\"{value}\"" for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple((name, str(labels.get(name, ""))) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各分桶计数（非累计）..., +Inf 计数, 总和]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple((name, str(labels.get(name, ""))) for name in self.labelnames)
+        counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        counts[index] += 1
+        counts[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_number(bound)))} {_format_number(cumulative)}")
+            cumulative += counts[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {_format_number(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {_format_number(cumulative)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        # 导出时求值的指标（如进程内存、内存中的会话数）
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple((name, str(labels.get(name, ""))) for name in self.labelnames)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = function
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.debug(f"[Metrics] Failed to evaluate gauge {self.name}: {e}")
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_number(value)}")
+        return lines
+
+
+def _resident_memory() -> float:
+    """当前进程的常驻内存（字节）：Linux 读取 /proc/self/statm，其他平台退化为峰值常驻内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource  # 仅 Unix 可用
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._metrics.setdefault(name, Gauge(name, documentation, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局单例
+tracer = Tracer()
+metrics = MetricsRegistry()
+
+turn_duration = metrics.histogram("agent_turn_duration_seconds", "Duration of a user turn", ["agent"])
+turn_rounds = metrics.histogram("agent_turn_rounds", "Model rounds per user turn", ["agent"], COUNT_BUCKETS)
+ui_updates = metrics.histogram("agent_ui_updates_per_turn", "UI message sends, updates and streamed deltas per user turn", ["agent"], COUNT_BUCKETS)
+llm_call_duration = metrics.histogram("llm_call_duration_seconds", "Duration of a model call including the whole stream", ["model", "status"])
+llm_time_to_first_token = metrics.histogram("llm_time_to_first_token_seconds", "Time from request to the first streamed chunk", ["model"])
+llm_stream_duration = metrics.histogram("llm_stream_duration_seconds", "Time from the first to the last streamed chunk", ["model"])
+llm_tokens = metrics.counter("llm_tokens_total", "Tokens reported by the model API", ["model", "type"])
+tool_duration = metrics.histogram("mcp_tool_duration_seconds", "Duration of MCP tool calls", ["server", "status"])
+resource_duration = metrics.histogram("mcp_resource_read_duration_seconds", "Duration of MCP resource reads", ["server", "status"])
+llm_fallbacks = metrics.counter("llm_fallbacks_total", "Requests served by a fallback model", ["requested", "served"])
+llm_hedges = metrics.counter("llm_hedged_requests_total", "Hedged request outcomes per model", ["model", "result"])
+llm_retries = metrics.counter("llm_retries_total", "Model requests retried after a transient error", ["model", "error"])
+admission_wait = metrics.histogram("llm_admission_wait_seconds", "Time a model request waited in the admission queue", ["model"])
+admission_rejections = metrics.counter("llm_admission_rejections_total", "Model requests rejected because the admission queue was too long", ["model", "reason"])
+mcp_reconnects = metrics.counter("mcp_reconnect_attempts_total", "MCP server reconnect attempts", ["server", "result"])
+process_memory = metrics.gauge("process_resident_memory_bytes", "Resident memory of this worker process")
+process_memory.set_function(_resident_memory)
+session_count = metrics.gauge("session_store_sessions", "Conversation histories held by the session store", ["state"])
+session_memory = metrics.gauge("session_store_memory_bytes", "Serialized size of the conversation histories held in memory")
+session_history_bytes = metrics.histogram("session_history_bytes", "Serialized size of a session's conversation history when saved", [], BYTES_BUCKETS)
+session_offloads = metrics.counter("session_store_offloads_total", "Conversation histories written to disk and dropped from memory", ["reason"])
+session_loads = metrics.counter("session_store_loads_total", "Conversation history lookups by where they were found", ["source"])
+
+
+def record_llm_call(model: str, start_ns: int, first_token_ns: Optional[int], usage=None, chunks: int = 0, error: Optional[str] = None, **attributes) -> Span:
+    """记录一次模型调用：Span（首令牌时间、流式时长、令牌数）与对应的直方图 / 计数器"""
+    end_ns = time.time_ns()
+    ttft = (first_token_ns - start_ns) / 1e9 if first_token_ns else None
+    stream_duration = (end_ns - first_token_ns) / 1e9 if first_token_ns else None
+    prompt_tokens = getattr(usage, "prompt_tokens", None) if usage else None
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage else None
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    cached_tokens = getattr(details, "cached_tokens", None) if details else None
+
+    llm_call_duration.observe((end_ns - start_ns) / 1e9, model=model, status="error" if error else "ok")
+    if ttft is not None:
+        llm_time_to_first_token.observe(ttft, model=model)
+        llm_stream_duration.observe(stream_duration, model=model)
+    for token_type, count in (("prompt", prompt_tokens), ("completion", completion_tokens), ("cached", cached_tokens)):
+        if count:
+            llm_tokens.inc(count, model=model, type=token_type)
+    return tracer.record_span(
+        "llm.call", start_ns, end_ns, error=error, **{
+            "llm.model": model, "llm.ttft": ttft, "llm.stream_duration": stream_duration, "llm.chunks": chunks,
+            "llm.prompt_tokens": prompt_tokens, "llm.completion_tokens": completion_tokens, "llm.cached_tokens": cached_tokens,
+            **attributes,
+        }
+    )
@@ -0,0 +1,138 @@
+"""
+File   : tool_selector.py
+Desc   : 工具筛选：基于 BM25 的本地工具索引，每轮对话只向模型提供最相关的 top-k 个工具
+Date   : 2026/02/06
+Author : Tianyu Chen
+"""
+
+import re
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+from loguru import logger
+
+# 每轮对话最多提供的工具数（不含固定工具），工具总数不超过该值时不做筛选，0 表示不筛选
+TOOL_SELECTION_TOP_K = 8
+# 参与检索的近期历史消息数（除当前用户问题外）
+RECENT_CONTEXT_MESSAGES = 4
+# 每条历史消息参与检索的最大字符数
+RECENT_CONTEXT_CHARS = 500
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[一-鿿]+")
+_CAMEL_RE = re.compile(r"([a-z0-9])([A-Z])")
+_STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "for", "and", "or", "is", "are", "be", "by",
+    "with", "from", "this", "that", "it", "as", "at", "if", "use", "get", "return", "returns",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：英文按单词切分（拆分驼峰与下划线，去除停用词和复数 s），中文按单字 + 双字切分
+    """
+    tokens = []
+    for word in _TOKEN_RE.findall(_CAMEL_RE.sub(r"\1 \2", text or "").lower()):
+        if "一" <= word[0] <= "鿿":
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        elif word not in _STOPWORDS:
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            tokens.append(word)
+    return tokens
+
+
+def tool_document(definition: Dict) -> str:
+    """工具的检索文本：名称 + 描述 + 参数名与参数描述"""
+    function = definition["function"]
+    parts = [function["name"].replace("-", " ").replace("_", " "), function.get("description") or ""]
+    for name, schema in function.get("parameters", {}).get("properties", {}).items():
+        parts.append(name.replace("_", " "))
+        if isinstance(schema, dict):
+            parts.append(schema.get("description") or "")
+    return " ".join(parts)
+
+
+def recent_context(messages: List[Dict], limit: int = RECENT_CONTEXT_MESSAGES) -> str:
+    """取最近几条用户 / 助手消息的正文，作为检索的补充上下文"""
+    texts = []
+    for message in reversed(messages):
+        if len(texts) >= limit:
+            break
+        if message.get("role") in ("user", "assistant") and isinstance(message.get("content"), str) and message["content"]:
+            texts.append(message["content"][:RECENT_CONTEXT_CHARS])
+    return "\n".join(reversed(texts))
+
+
+class ToolIndex:
+    """工具定义的 BM25 倒排索引"""
+
+    def __init__(self, definitions: List[Dict]):
+        self.names = [definition["function"]["name"] for definition in definitions]
+        documents = [Counter(tokenize(tool_document(definition))) for definition in definitions]
+        self._lengths = [sum(document.values()) for document in documents]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        # 词 -> [(文档序号, 词频)]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc_id, document in enumerate(documents):
+            for term, frequency in document.items():
+                self._postings.setdefault(term, []).append((doc_id, frequency))
+        total = len(documents)
+        self._idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """返回得分最高的 k 个工具（只包含得分大于 0 的工具）"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, frequency in self._postings[term]:
+                norm = 1 - BM25_B + BM25_B * self._lengths[doc_id] / (self._avg_length or 1)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.names[doc_id], score) for doc_id, score in ranked if score > 0]
+
+
+class ToolSelector:
+    """
+    按相关度筛选工具
+
+    - 以当前用户问题 + 近期历史为查询，在工具名称、描述、参数上做 BM25 检索，取 top-k
+    - 固定工具（配置的 pinned_tools、本轮已调用过的工具）始终保留
+    - 没有任何工具命中（如中文问题与英文工具描述无交集）时回退到全部工具
+    索引按工具列表缓存，注册表或可用工具变化时重建
+    """
+
+    def __init__(self, top_k: int = TOOL_SELECTION_TOP_K):
+        self.top_k = top_k
+        self._index_key: Optional[tuple] = None
+        self._index: Optional[ToolIndex] = None
+
+    def select(self, tools: List[Dict], query: str, pinned: Iterable[str] = ()) -> List[Dict]:
+        if self.top_k <= 0 or len(tools) <= self.top_k:
+            return tools
+        hits = self._get_index(tools).search(query, self.top_k)
+        if not hits:
+            logger.debug(f"[ToolSelector] No relevant tools matched, falling back to all {len(tools)} tools")
+            return tools
+        selected = {name for name, _ in hits} | set(pinned)
+        logger.debug(f"[ToolSelector] Selected {len(selected)}/{len(tools)} tools: {[name for name, _ in hits]}")
+        return [tool for tool in tools if tool["function"]["name"] in selected]
+
+    def _get_index(self, tools: List[Dict]) -> ToolIndex:
+        key = tuple((tool["function"]["name"], tool["function"].get("description")) for tool in tools)
+        if self._index is None or self._index_key != key:
+            self._index = ToolIndex(tools)
+            self._index_key = key
+        return self._index
+
+
+# 全局单例
+tool_selector = ToolSelector()